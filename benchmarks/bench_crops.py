@@ -0,0 +1,108 @@
+"""
+Compare the crops from `vampires_control.crop_optimizer` with the previous bounding-box crops.
+
+For a few MBI and standard layouts, prints the crop of each method, its size, the frame rate
+predicted by the ORCA-Quest readout model, and whether it contains every field stop window. Then
+counts how often each method clips a window for random sub-pixel PSF positions.
+
+    python benchmarks/bench_crops.py --readout FAST
+"""
+
+import argparse
+
+import numpy as np
+
+from vampires_control.crop_optimizer import (
+    FIELDSTOP_SIZE,
+    READOUT_MODELS,
+    optimize_crop,
+    window_bounds,
+)
+from vampires_control.strehl import MBI_FIELDS, _mbi_field_center
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("--readout", default="FAST", choices=list(READOUT_MODELS))
+parser.add_argument("--ntrials", type=int, default=1000, help="Number of random layouts")
+parser.add_argument("--seed", type=int, default=4796)
+
+TINT = 1e-3
+
+
+def legacy_crop(centers):
+    """Bounding-box crop of `hotspot._generate_mbi_crop` before the optimizer"""
+    centers = np.atleast_2d(centers)
+    pad_size = FIELDSTOP_SIZE / 2
+    min_y, min_x = centers.min(axis=0) - pad_size
+    max_y, max_x = centers.max(axis=0) + pad_size
+    x0 = np.floor(min_x / 4) * 4
+    y0 = np.floor(min_y / 4) * 4
+    range_x = np.ceil((max_x - x0) / 4) * 4
+    range_y = np.ceil((max_y - y0) / 4) * 4
+    return {"x0": int(x0), "x1": int(x0 + range_x - 1), "y0": int(y0), "y1": int(y0 + range_y - 1)}
+
+
+def legacy_standard_crop(center):
+    """Fixed 536 px crop of `hotspot.generate_standard_crop_config` before the optimizer"""
+    pad_size = FIELDSTOP_SIZE / 2
+    y0, x0 = np.floor((np.asarray(center) - pad_size) / 4) * 4
+    size = FIELDSTOP_SIZE
+    return {"x0": int(x0), "x1": int(x0 + size - 1), "y0": int(y0), "y1": int(y0 + size - 1)}
+
+
+def contains(crop, centers) -> bool:
+    bounds = window_bounds(centers)
+    return bool(
+        np.all(bounds[:, 0] >= crop["y0"])
+        and np.all(bounds[:, 1] <= crop["y1"])
+        and np.all(bounds[:, 2] >= crop["x0"])
+        and np.all(bounds[:, 3] <= crop["x1"])
+    )
+
+
+def mbi_centers(offset, fields=MBI_FIELDS, shape=(1100, 2200)):
+    return np.array([_mbi_field_center(shape, 2, f) for f in fields]) + offset
+
+
+def layouts(rng):
+    center = np.array((1152, 2048))
+    mbi_offset = center - np.array((1100, 2200)) / 2 + rng.uniform(0, 1, 2)
+    return {
+        "MBI (centered)": mbi_centers(mbi_offset),
+        "MBI (+300 rows)": mbi_centers(mbi_offset + (300, 0)),
+        "MBIR (centered)": mbi_centers(mbi_offset, fields=MBI_FIELDS[1:]),
+        "standard (centered)": [center + rng.uniform(0, 1, 2)],
+        "standard (+400 rows)": [center + (400, -200) + rng.uniform(0, 1, 2)],
+    }
+
+
+def describe(label, crop, centers, model):
+    ny = crop["y1"] - crop["y0"] + 1
+    nx = crop["x1"] - crop["x0"] + 1
+    fps = float(model.fps(crop["y0"], crop["y1"], tint=TINT))
+    print(
+        f"  {label:>9s}: x={crop['x0']:4d}-{crop['x1']:4d} y={crop['y0']:4d}-{crop['y1']:4d}"
+        f" ({nx:4d} x {ny:4d}) {fps:7.1f} fps, contains windows: {contains(crop, centers)}"
+    )
+
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    model = READOUT_MODELS[args.readout]
+    for name, centers in layouts(rng).items():
+        centers = np.atleast_2d(centers)
+        print(name)
+        legacy = legacy_crop(centers) if len(centers) > 1 else legacy_standard_crop(centers[0])
+        describe("previous", legacy, centers, model)
+        describe("optimized", optimize_crop(centers, model=model, tint=TINT), centers, model)
+
+    clipped = {"previous": 0, "optimized": 0}
+    for _ in range(args.ntrials):
+        centers = mbi_centers(rng.uniform(300, 700, 2))
+        clipped["previous"] += not contains(legacy_crop(centers), centers)
+        clipped["optimized"] += not contains(optimize_crop(centers, model=model), centers)
+    print(f"MBI crops clipping a field stop window in {args.ntrials} random layouts: {clipped}")
+
+
+if __name__ == "__main__":
+    main()
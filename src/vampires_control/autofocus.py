@@ -1,6 +1,9 @@
 import logging
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Final
 
 import click
 import numpy as np
@@ -10,7 +13,31 @@ from numpy.polynomial import Polynomial
 from pyMilk.interfacing.isio_shmlib import SHM
 from swmain.network.pyroclient import connect
 
-from .strehl import measure_strehl_shm
+from .focus_history import LENS_DEPENDENT, MAX_SEARCH_WIDTH, FocusHistory, bench_state, search_width
+from .focus_metrics import FOCUS_METRICS, focus_metric
+from .focus_search import FocusSearchResult, adaptive_focus_search
+from .strehl import (
+    StrehlStream,
+    capture_strehl_frames,
+    get_strehl_reference,
+    measure_strehl_capture,
+    measure_strehl_frames,
+    measure_strehl_otf_cube,
+    measure_strehl_shm,
+)
+from .synthpsf import pupil_angle_from_keywords
+
+# tolerance and polling interval for the focus stages to reach a target, in mm and s
+POSITION_TOL: Final[float] = 5e-3
+POSITION_POLL: Final[float] = 0.01
+# Strehl estimators, the other focus metrics are the sharpness metrics of `FOCUS_METRICS`
+STREHL_METRICS: Final[tuple[str, ...]] = ("peak", "otf")
+# a continuous sweep must populate this many focus bins with at least `MIN_BIN_FRAMES` frames
+# each, otherwise the stage moved too fast for the frame rate and a stepped scan is used instead
+MIN_FOCUS_BINS: Final[int] = 7
+MIN_BIN_FRAMES: Final[int] = 3
+# time for the stage to report the end of a sweep after the move returned, in s
+SETTLE_TIMEOUT: Final[float] = 2
 
 # set up logging
 formatter = logging.Formatter("%(asctime)s|%(name)s|%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
@@ -25,7 +52,7 @@ logger.addHandler(stream_handler)
 class Autofocuser:
     # only get 30 fps over zmq, don't waste our time here
     DEFAULT_NUM_FRAMES = 10
-    DEFAULT_SLEEP = 0.1
+    FOCUS_DEVICE = "VAMPIRES_FOCUS"
 
     """
         Autofocuser
@@ -43,54 +70,400 @@ class Autofocuser:
     3. beamsplitter in, narrowband in, focus camera 1 and 2 using lens ("sdi")
     4. beampslitter out, focus camera 1 using camfocus ("single")
     5. TODO beamsplitter out, pupil lens in, focus camera 1 using camfocus ("pupil")
+
+    The focus metric is either a Strehl estimator (`STREHL_METRICS`) or, when a cheaper or more
+    robust metric is needed, one of the sharpness metrics of `FOCUS_METRICS`.
     """
 
-    def __init__(self):
+    def __init__(self, metric: str = "peak", history: FocusHistory | None = None):
+        self.metric = metric
+        self.history = history
         self.cameras = {1: connect("VCAM1"), 2: connect("VCAM2")}
         self.shms = {1: SHM("vcam1"), 2: SHM("vcam2")}
-        self.focus_stage = connect("VAMPIRES_FOCUS")
-
-    def autofocus_lens(self, shm, start_point, num_frames=10):
-        focus_range = _focus_range(start_point)
-        strehls = []
-        pbar = tqdm.tqdm(focus_range, desc="Scanning lens", leave=False)
-        for _i, position in enumerate(pbar):
-            pbar.write(f"Moving lens focus to {position:4.02f} mm", end=" | ")
-            self.focus_stage.move_absolute("lens", position)
-            time.sleep(self.DEFAULT_SLEEP)
-            cur_strehl = measure_metric(shm, num_frames)
-            strehls.append(cur_strehl)
+        self.focus_stage = connect(self.FOCUS_DEVICE)
+
+    def autofocus_lens(self, shm, start_point, num_frames=10, width=MAX_SEARCH_WIDTH):
+        return self.autofocus_stepped(shm, "lens", start_point, num_frames=num_frames, width=width)
+
+    def autofocus_camfocus(self, shm, start_point, num_frames=10, width=MAX_SEARCH_WIDTH):
+        return self.autofocus_stepped(shm, "cam", start_point, num_frames=num_frames, width=width)
+
+    def record(self, shm, stage: str, focus: float, strehl: float, method: str):
+        """Add an autofocus result and the current bench state to the history, if any"""
+        if self.history is None:
+            return
+        if self.metric not in STREHL_METRICS:
+            strehl = None
+        cam = shm.get_keywords()["U_CAMERA"]
+        state = self.bench_state(stage, cam)
+        self.history.add(stage, cam, state, focus, strehl=strehl, method=method)
+
+    def bench_state(self, stage: str, cam: int) -> dict:
+        """Bench state (see `bench_state`), plus the lens position for `LENS_DEPENDENT` stages"""
+        state = bench_state(cam)
+        if stage in LENS_DEPENDENT:
+            state["lens"] = self.focus_stage.get_position("lens")
+        return state
+
+    def _format(self, value: float) -> str:
+        if self.metric in STREHL_METRICS:
+            return f"Strehl ratio {value * 1e2:04.01f}%"
+        return f"{self.metric} {value:.3e}"
+
+    def move_to(self, stage: str, position: float, timeout: float = 2):
+        """
+        Move a focus stage and wait until it reports the target position (within
+        `POSITION_TOL`), or until `timeout` s
+        """
+        self.focus_stage.move_absolute(stage, position)
+        deadline = time.monotonic() + timeout
+        while abs(self.focus_stage.get_position(stage) - position) > POSITION_TOL:
+            if time.monotonic() > deadline:
+                logger.warning(f"{stage} stage did not reach {position:4.02f} mm in {timeout} s")
+                break
+            time.sleep(POSITION_POLL)
+
+    def autofocus_stepped(
+        self, shm, stage: str, start_point, num_frames=10, width=MAX_SEARCH_WIDTH
+    ):
+        """
+        Focus scan stepping through the focus range.
+
+        The scan is pipelined: the frames for each position are captured as soon as the stage
+        reports its target, and their Strehl ratio (or sharpness) is measured in a worker thread
+        while the stage moves on to the next position. The scan then takes about the motion plus
+        exposure time, the PSF models and measurements are hidden behind it.
+        """
+        focus_range = _focus_range(start_point, width)
+        pbar = tqdm.tqdm(focus_range, desc=f"Scanning {stage}", leave=False)
+        timings = {"motion": 0, "capture": 0, "metric": 0}
+        if self.metric in STREHL_METRICS:
+
+            def capture():
+                return capture_strehl_frames(shm.FNAME, nave=num_frames, metric=self.metric)
+
+            def evaluate(frames):
+                return _strehl_dict(shm.FNAME, measure_strehl_capture(frames))
+
+        else:
+            # the mean sharpness of the frames of each field
+            reader = FrameStrehls(shm.FNAME, metric=self.metric, batch=num_frames)
+
+            def capture():
+                return reader.stream.read()[0]
+
+            def evaluate(cubes):
+                return {k: float(np.mean(v)) for k, v in reader.measure(cubes).items()}
+
+        def measure(position, frames):
+            t0 = time.monotonic()
+            cur_strehl = evaluate(frames)
+            timings["metric"] += time.monotonic() - t0
             strehl_val = cur_strehl["F720"] if len(cur_strehl) > 1 else list(cur_strehl.values())[0]
-            pbar.write(f"Strehl ratio: {strehl_val*1e2:04.01f}%")
+            pbar.write(f"{stage} focus {position:4.02f} mm | {self._format(strehl_val)}")
+            return cur_strehl
+
+        t0 = time.monotonic()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            futures = []
+            for position in pbar:
+                t1 = time.monotonic()
+                self.move_to(stage, position)
+                # the exposure of the next frame may have started while moving
+                shm.get_data(check=True)
+                t2 = time.monotonic()
+                frames = capture()
+                timings["motion"] += t2 - t1
+                timings["capture"] += time.monotonic() - t2
+                futures.append(pool.submit(measure, position, frames))
+            results = [future.result() for future in futures]
+        logger.info(
+            f"Scanned {len(focus_range)} positions in {time.monotonic() - t0:.1f} s"
+            f" (motion {timings['motion']:.1f} s, capture {timings['capture']:.1f} s,"
+            f" metric {timings['metric']:.1f} s in parallel)"
+        )
 
-        strehl_table = pd.DataFrame(strehls)
+        strehl_table = pd.DataFrame(results)
         best_fit, best_value = fit_optimal_focus(focus_range, strehl_table)
-        logger.info(f"Best Strehl - {best_value * 1e2:04.01f}% - focus= {best_fit:4.02f} mm")
-        self.focus_stage.move_absolute("lens", best_fit)
+        if _outside(best_fit, focus_range, width):
+            logger.warning("Best focus is outside of the narrowed range, scanning the full range")
+            best_sample = focus_range[np.argmax(strehl_table.mean(axis=1))]
+            return self.autofocus_stepped(shm, stage, best_sample, num_frames=num_frames)
+        logger.info(f"Best {self._format(best_value)} - focus= {best_fit:4.02f} mm")
+        self.focus_stage.move_absolute(stage, best_fit)
+        self.record(shm, stage, best_fit, best_value, "stepped")
         return best_fit
 
-    def autofocus_camfocus(self, shm, start_point, num_frames=10):
-        focus_range = _focus_range(start_point)
-        strehls = []
-        pbar = tqdm.tqdm(focus_range, desc="Scanning camfocus", leave=False)
-        for _i, position in enumerate(pbar):
-            pbar.write(f"Moving camera focus to {position:4.02f} mm", end=" | ")
-            self.focus_stage.move_absolute("cam", position)
-            time.sleep(self.DEFAULT_SLEEP)
-            cur_strehl = measure_metric(shm, num_frames)
-            strehls.append(cur_strehl)
-            strehl_val = cur_strehl["F720"] if len(cur_strehl) > 1 else list(cur_strehl.values())[0]
-            pbar.write(f"Strehl ratio: {strehl_val*1e2:04.01f}%")
+    def autofocus_continuous(
+        self,
+        shm,
+        stage: str,
+        start_point,
+        batch: int = 50,
+        bin_width: float = 0.01,
+        width=MAX_SEARCH_WIDTH,
+    ):
+        """
+        Focus scan with the stage sweeping continuously through the focus range.
 
-        strehl_table = pd.DataFrame(strehls)
-        best_fit, best_value = fit_optimal_focus(focus_range, strehl_table)
-        logger.info(f"Best Strehl - {best_value * 1e2:04.01f}% - focus= {best_fit:4.02f} mm")
-        self.focus_stage.move_absolute("cam", best_fit)
+        The stage moves in a worker thread while frames are read in batches and the per-frame
+        Strehl ratio is measured until the stage reports the end of the range (moves may return
+        before the stage arrives), at least one batch. The stage position is polled in the background and interpolated
+        onto the frame receive times, giving a dense focus curve in a single pass. The curve is
+        binned by `bin_width` mm (median) before fitting the optimum. Bins with fewer than
+        `MIN_BIN_FRAMES` frames are dropped, and if fewer than `MIN_FOCUS_BINS` bins remain (the
+        sweep was too fast for the frame rate, or it ended before enough frames were read) a
+        stepped scan is done instead.
+
+        Parameters
+        ----------
+        shm : SHM
+            Camera stream used for the focus metric
+        stage : str
+            Focus stage axis, "lens" or "cam"
+        start_point : float
+            Center of the focus range, in mm
+        batch : int
+            Number of frames read (and measured) at once, by default 50
+        bin_width : float
+            Bin size of the focus curve, in mm, by default 0.01
+        width : float
+            Width of the focus range, in mm, by default `MAX_SEARCH_WIDTH`
+        """
+        focus_range = _focus_range(start_point, width)
+        reader = FrameStrehls(shm.FNAME, metric=self.metric, batch=batch)
+
+        self.move_to(stage, focus_range[0])
+        sampler = PositionSampler(self.FOCUS_DEVICE, stage)
+        times = []
+        metrics = {field: [] for field in reader.fields}
+        t0 = time.monotonic()
+        sampler.start()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            move = pool.submit(_move_absolute, self.FOCUS_DEVICE, stage, focus_range[-1])
+            deadline = None
+            while True:
+                frame_times, frame_strehls = reader.read()
+                times.append(frame_times)
+                for field, values in frame_strehls.items():
+                    metrics[field].append(values)
+                if not move.done():
+                    continue
+                if sampler.reached(focus_range[-1]):
+                    break
+                # the move returned, but the stage hasn't reported the target yet
+                if deadline is None:
+                    deadline = time.monotonic() + SETTLE_TIMEOUT
+                elif time.monotonic() > deadline:
+                    logger.warning(f"{stage} stage did not reach {focus_range[-1]:4.02f} mm")
+                    break
+            move.result()
+            move_time = time.monotonic() - t0
+        sampler.stop()
+        scan_time = time.monotonic() - t0
+
+        nframes = sum(len(t) for t in times)
+        if nframes < MIN_FOCUS_BINS * MIN_BIN_FRAMES:
+            logger.warning(
+                f"Continuous scan only read {nframes} frames, too few to populate"
+                f" {MIN_FOCUS_BINS} bins, scanning in steps"
+            )
+            return self.autofocus_stepped(
+                shm, stage, start_point, num_frames=self.DEFAULT_NUM_FRAMES, width=width
+            )
+        times = np.concatenate(times)
+        positions = sampler.interpolate(times)
+        strehl_table = bin_focus_curve(
+            positions,
+            pd.DataFrame({k: np.concatenate(v) for k, v in metrics.items()}),
+            bin_width,
+            min_frames=MIN_BIN_FRAMES,
+        )
+        if len(strehl_table) < MIN_FOCUS_BINS:
+            logger.warning(
+                f"Continuous scan of {len(times)} frames populated only {len(strehl_table)} bins"
+                f" of {bin_width} mm with at least {MIN_BIN_FRAMES} frames, scanning in steps"
+            )
+            return self.autofocus_stepped(
+                shm, stage, start_point, num_frames=self.DEFAULT_NUM_FRAMES, width=width
+            )
+        best_fit, best_value = fit_optimal_focus(strehl_table.index.values, strehl_table)
+        if _outside(best_fit, focus_range, width):
+            logger.warning("Best focus is outside of the narrowed range, scanning the full range")
+            best_sample = strehl_table.index.values[np.argmax(strehl_table.mean(axis=1))]
+            return self.autofocus_continuous(shm, stage, best_sample, batch, bin_width)
+        logger.info(f"Best {self._format(best_value)} - focus= {best_fit:4.02f} mm")
+
+        # a stepped scan moves between, and captures (plus a skipped frame) at every position
+        step_time = move_time / (len(focus_range) - 1)
+        frame_time = np.median(np.diff(times)) if len(times) > 1 else 0
+        stepped_time = len(focus_range) * (step_time + (self.DEFAULT_NUM_FRAMES + 1) * frame_time)
+        logger.info(
+            f"Continuous scan: {len(times)} frames in {scan_time:.1f} s"
+            f" (stepped scan of {len(focus_range)} positions: at least {stepped_time:.1f} s)"
+        )
+        self.focus_stage.move_absolute(stage, best_fit)
+        self.record(shm, stage, best_fit, best_value, "continuous")
         return best_fit
 
+    def autofocus_adaptive(
+        self, shm, stage: str, start_point, num_frames=10, tol: float = 0.01, width=MAX_SEARCH_WIDTH
+    ) -> FocusSearchResult:
+        """
+        Focus with an adaptive search (see `adaptive_focus_search`) instead of a fixed scan.
+
+        The metric of each measurement is the per-frame Strehl ratio or sharpness (averaged over
+        the fields) of `num_frames` frames, whose scatter sets the noise of the estimate. The
+        stage must already be at `start_point`.
+        """
+        reader = FrameStrehls(shm.FNAME, metric=self.metric, batch=num_frames)
+
+        def move(position):
+            logger.info(f"Moving {stage} focus to {position:6.03f} mm")
+            self.move_to(stage, position)
+
+        def measure():
+            _, frame_strehls = reader.read()
+            return np.mean(list(frame_strehls.values()), axis=0)
+
+        result = adaptive_focus_search(
+            move, measure, start_point, width=width, bounds=(0, 23), tol=tol
+        )
+        logger.info(f"Best {self._format(result.value)} - {result.summary()}")
+        self.focus_stage.move_absolute(stage, result.position)
+        self.record(shm, stage, result.position, result.value, "adaptive")
+        return result
+
+
+class FrameStrehls:
+    """
+    Per-frame Strehl ratios (or sharpness) of each field of a camera stream, read in batches.
+
+    Parameters
+    ----------
+    shm_name : str
+        Camera stream
+    metric : str
+        Strehl estimator, "peak" or "otf", or a sharpness metric of `FOCUS_METRICS`, by default
+        "peak"
+    batch : int
+        Number of frames per read, by default 50
+    """
+
+    def __init__(self, shm_name: str, metric: str = "peak", batch: int = 50):
+        self.metric = metric
+        self.stream = StrehlStream(shm_name, batch=batch)
+        shmkwds = self.stream.shm.get_keywords()
+        self.stream.update_model(shmkwds)
+        pupil_angle = pupil_angle_from_keywords(shmkwds)
+        self.references = {
+            field: get_strehl_reference(field, pxscale=self.stream.pxscale, pupil_angle=pupil_angle)
+            for field in self.stream.fields
+        }
+        self.flip = shmkwds["U_CAMERA"] == 1
+
+    @property
+    def fields(self):
+        return tuple(self.stream.fields)
+
+    def read(self) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+        """Receive times and per-frame Strehl ratio of each field for the next batch"""
+        cubes, times = self.stream.read()
+        return times, self.measure(cubes)
+
+    def measure(self, cubes: dict) -> dict[str, np.ndarray]:
+        """Per-frame Strehl ratio (or sharpness) of the cube of each field"""
+        strehls = {}
+        for field, (_, norm_peak) in self.stream.fields.items():
+            if self.metric in FOCUS_METRICS:
+                strehls[field] = focus_metric(cubes[field], self.metric)
+            elif self.metric == "otf":
+                strehls[field] = measure_strehl_otf_cube(
+                    cubes[field], self.references[field], flip=self.flip
+                )
+            else:
+                strehls[field] = measure_strehl_frames(
+                    cubes[field], norm_peak, pxscale=self.stream.pxscale
+                )["strehl"]
+        return strehls
+
+
+class PositionSampler(threading.Thread):
+    """
+    Poll the position of a stage axis in the background.
+
+    The thread uses its own device proxy, since proxies can't be shared between threads. Each
+    sample is timestamped at the midpoint of the request.
+
+    Parameters
+    ----------
+    device : str
+        Name of the device
+    axis : str
+        Stage axis to poll
+    interval : float
+        Time between requests, in s, by default 0.02
+    """
+
+    def __init__(self, device: str, axis: str, interval: float = 0.02):
+        super().__init__(daemon=True)
+        self.device = device
+        self.axis = axis
+        self.interval = interval
+        self.times = []
+        self.positions = []
+        self._done = threading.Event()
+
+    def run(self):
+        stage = connect(self.device)
+        while not self._done.is_set():
+            t0 = time.time()
+            position = stage.get_position(self.axis)
+            self.times.append((t0 + time.time()) / 2)
+            self.positions.append(position)
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def reached(self, position: float, tol: float = POSITION_TOL) -> bool:
+        """Whether the last sample is within `tol` of `position`"""
+        return len(self.positions) > 0 and abs(self.positions[-1] - position) <= tol
+
+    def interpolate(self, times) -> np.ndarray:
+        """
+        Stage positions at the given unix times, held at the first (last) sample before (after)
+        the samples, when the stage is at rest
+        """
+        return np.interp(times, self.times, self.positions)
+
+
+def _move_absolute(device: str, axis: str, position: float):
+    # blocking move from a worker thread, with its own proxy
+    connect(device).move_absolute(axis, position)
+
 
-def _focus_range(start_point: float):
-    search_width = 1.5  # mm
+def bin_focus_curve(
+    positions, metrics: pd.DataFrame, width: float, min_frames: int = 1
+) -> pd.DataFrame:
+    """
+    Median of the per-frame metrics in bins of stage position, indexed by bin center. Bins with
+    fewer than `min_frames` frames are dropped.
+    """
+    bins = np.round(np.asarray(positions) / width) * width
+    groups = metrics.groupby(bins)
+    binned = groups.median()[groups.size() >= min_frames]
+    return binned.dropna()
+
+
+def _outside(best_fit: float, focus_range, width: float) -> bool:
+    # whether the fit of a narrowed scan is outside of the scanned range (or failed)
+    inside = focus_range[0] <= best_fit <= focus_range[-1]
+    return width < MAX_SEARCH_WIDTH and not inside
+
+
+def _focus_range(start_point: float, search_width: float = MAX_SEARCH_WIDTH):
     step_size = 0.05  # mm
     focus_range = np.arange(
         max(0, start_point - search_width / 2), min(23, start_point + search_width / 2), step_size
@@ -98,14 +471,18 @@ def _focus_range(start_point: float):
     return focus_range
 
 
-def measure_metric(shm: SHM, num_frames: int, **kwargs) -> dict[str, float]:
-    """Get multiple frames, collapse, and measure focus metric"""
-    strehls = measure_strehl_shm(shm.FNAME, nave=num_frames, **kwargs)
+def measure_metric(shm: SHM, num_frames: int, metric: str = "peak", **kwargs) -> dict[str, float]:
+    """Get multiple frames and measure focus metric ("peak" or "otf" Strehl ratio)"""
+    strehls = measure_strehl_shm(shm.FNAME, nave=num_frames, metric=metric, **kwargs)
+    return _strehl_dict(shm.FNAME, strehls)
+
+
+def _strehl_dict(shm_name: str, strehls) -> dict[str, float]:
     if isinstance(strehls, dict):
         # optimize over F720 field
         return strehls
     # otherwise strehls is just a float
-    return {shm.FNAME: strehls}
+    return {shm_name: strehls}
 
 
 def fit_optimal_focus(focus, metrics: pd.DataFrame, plot: bool = True) -> tuple[float, float]:
@@ -175,7 +552,29 @@ def fit_optimal_focus(focus, metrics: pd.DataFrame, plot: bool = True) -> tuple[
     help="Number of frames to coadd for each measurement",
     show_default=True,
 )
-def main(stage: str, camera: int, num_frames: int):
+@click.option(
+    "-m",
+    "--metric",
+    default="peak",
+    type=click.Choice([*STREHL_METRICS, *FOCUS_METRICS]),
+    help="Strehl estimator or sharpness metric used as focus metric",
+    show_default=True,
+)
+@click.option(
+    "-s",
+    "--scan",
+    default="stepped",
+    type=click.Choice(["stepped", "continuous", "adaptive"]),
+    help="Fixed steps, a continuous sweep measuring every frame, or an adaptive search",
+    show_default=True,
+)
+@click.option(
+    "--prior/--no-prior",
+    default=True,
+    help="Start from the focus predicted by the autofocus history and narrow the search",
+    show_default=True,
+)
+def main(stage: str, camera: int, num_frames: int, metric: str, scan: str, prior: bool):
     if os.environ.get("WHICHCOMP", "") != "5":
         msg = "WARNING: this script should be ran on scexao5"
         raise ValueError(msg)
@@ -188,28 +587,38 @@ def main(stage: str, camera: int, num_frames: int):
     click.secho(f"Optimizing {stage.upper()} stage using VCAM{camera:.0f}", bold=True)
 
     # instantiate class
-    af = Autofocuser()
+    af = Autofocuser(metric=metric, history=FocusHistory())
     # get SHM to fit
     shm = af.shms[camera]
 
-    if stage == "lens":
-        focus_posn = click.prompt(
-            "Please enter starting position for lens stage",
-            default=af.focus_stage.get_position("lens"),
-            type=float,
+    # start from the focus predicted by previous runs in the same configuration
+    state = af.bench_state(stage, camera)
+    prediction = af.history.predict(stage, camera, state) if prior else None
+    width = search_width(prediction)
+    if prediction is None:
+        default = af.focus_stage.get_position(stage)
+    else:
+        default = round(prediction.focus, 3)
+        click.echo(
+            f"Predicted focus from {prediction.nsamples} previous runs: {prediction.focus:.3f}"
+            f" +- {prediction.uncertainty:.3f} mm, searching {width:.2f} mm around it"
         )
-        af.focus_stage.move_absolute("lens", focus_posn)
-        click.confirm("Adjust camera settings and proceed when ready", abort=True, default=True)
-        result = af.autofocus_lens(shm, start_point=focus_posn, num_frames=num_frames)
-    elif stage == "cam":
-        camfocus_posn = click.prompt(
-            "Please enter starting position for camera stage",
-            default=af.focus_stage.get_position("cam"),
-            type=float,
+    stage_name = "lens" if stage == "lens" else "camera"
+    focus_posn = click.prompt(
+        f"Please enter starting position for {stage_name} stage", default=default, type=float
+    )
+    af.move_to(stage, focus_posn)
+    click.confirm("Adjust camera settings and proceed when ready", abort=True, default=True)
+    if scan == "continuous":
+        result = af.autofocus_continuous(shm, stage, start_point=focus_posn, width=width)
+    elif scan == "adaptive":
+        result = af.autofocus_adaptive(
+            shm, stage, start_point=focus_posn, num_frames=num_frames, width=width
+        ).position
+    else:
+        result = af.autofocus_stepped(
+            shm, stage, start_point=focus_posn, num_frames=num_frames, width=width
         )
-        af.focus_stage.move_absolute("cam", camfocus_posn)
-        click.confirm("Adjust camera settings and proceed when ready", abort=True, default=True)
-        result = af.autofocus_camfocus(shm, start_point=camfocus_posn, num_frames=num_frames)
     click.echo("Autofocus finished")
     return result
 
@@ -7,6 +7,10 @@ from numpy.polynomial import Polynomial
 from pyMilk.interfacing.isio_shmlib import SHM
 from swmain.network.pyroclient import connect
 
+from .focus_metrics import FOCUS_METRICS, FocusMetric, focus_metric
+from .focus_search import FocusSearchResult, adaptive_focus_search
+from .shm_roi import ROIReader
+
 # set up logging
 formatter = logging.Formatter("%(asctime)s|%(name)s|%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 logger = logging.getLogger("autofocus")
@@ -25,28 +29,51 @@ class AutofocuserFieldstop:
         AutofocuserFieldstop
 
     The fieldstop can be auto-focused by using a flat field image of the corongraph masks and maximizing sharpness.
+    The sharpness `metric` is one of `FOCUS_METRICS`, by default the normalized variance.
     """
 
-    def __init__(self):
+    def __init__(self, metric: FocusMetric = "normvar"):
+        self.metric = metric
         self.cameras = {1: connect("VCAM1"), 2: connect("VCAM2")}
         self.shms = {1: SHM("vcam1"), 2: SHM("vcam2")}
         self.fieldstop_stage = connect("VAMPIRES_FIELDSTOP")
 
-    def autofocus(self, shm, start_point, num_frames=10):
+    def autofocus(self, shm, start_point, num_frames=10, coadd="median"):
         focus_range = _focus_range(start_point)
         metrics = np.empty_like(focus_range)
         pbar = tqdm.tqdm(focus_range, desc="Scanning lens", leave=False)
         for i, position in enumerate(pbar):
             pbar.write(f"Moving fieldstop focus to {position:4.02f} mm", end=" | ")
             self.fieldstop_stage.move_absolute("f", position)
-            metrics[i] = measure_metric(shm, num_frames)
-            pbar.write(f"normalized variance: {metrics[i]:3.02e} (adu)")
+            metrics[i] = measure_metric(shm, num_frames, coadd=coadd, metric=self.metric)
+            pbar.write(f"{self.metric}: {metrics[i]:3.02e}")
 
         best_fit = fit_optimal_focus(focus_range, metrics)
         logger.info(f"Best-fit focus was {best_fit:4.02f} mm")
         self.fieldstop_stage.move_absolute("f", best_fit)
         return best_fit
 
+    def autofocus_adaptive(
+        self, shm, start_point, num_frames=10, tol: float = 0.01
+    ) -> FocusSearchResult:
+        """
+        Focus with an adaptive search (see `adaptive_focus_search`) instead of a fixed scan, using
+        the metric of each of `num_frames` frames. The stage must already be at `start_point`.
+        """
+        reader = ROIReader(shm)
+
+        def move(position):
+            logger.info(f"Moving fieldstop focus to {position:6.03f} mm")
+            self.fieldstop_stage.move_absolute("f", position)
+
+        def measure():
+            return autofocus_metric(reader.read(num_frames)["frame"], self.metric)
+
+        result = adaptive_focus_search(move, measure, start_point, bounds=(0, 13), tol=tol)
+        logger.info(result.summary())
+        self.fieldstop_stage.move_absolute("f", result.position)
+        return result
+
 
 def _focus_range(start_point: float):
     search_width = 1.5  # mm
@@ -57,19 +84,18 @@ def _focus_range(start_point: float):
     return focus_range
 
 
-def measure_metric(shm: SHM, num_frames: int, **kwargs):
-    """Get multiple frames, collapse, and measure focus metric"""
-    cube = shm.multi_recv_data(num_frames, output_as_cube=True, **kwargs)
-    frame = np.median(cube, axis=0, overwrite_input=True)
-    return autofocus_metric(frame)
+def measure_metric(shm: SHM, num_frames: int, coadd="median", metric: FocusMetric = "normvar"):
+    """Get multiple frames, collapse (streaming), and measure focus metric"""
+    frame = ROIReader(shm).read_frame(num_frames, coadd=coadd)
+    return autofocus_metric(frame, metric)
 
 
-def autofocus_metric(frame):
-    """Return the autofocus metric (to maximize) from a single frame"""
-    # calculate normalized variance
-    var = np.var(frame)
-    mean = np.mean(frame)
-    return var / mean
+def autofocus_metric(frame, metric: FocusMetric = "normvar"):
+    """
+    Return the autofocus metric (to maximize) from a single frame, or each frame of a cube (see
+    `focus_metric`)
+    """
+    return focus_metric(frame, metric)
 
 
 def fit_optimal_focus(focus, metrics) -> float:
@@ -100,7 +126,31 @@ def fit_optimal_focus(focus, metrics) -> float:
     help="Number of frames to coadd for each measurement",
     show_default=True,
 )
-def main(camera: int, num_frames: int):
+@click.option(
+    "-k",
+    "--coadd",
+    default="median",
+    type=click.Choice(["median", "mean", "clipped"]),
+    help="Streaming coadd of the frames (median is approximate beyond 11 frames)",
+    show_default=True,
+)
+@click.option(
+    "-m",
+    "--metric",
+    default="normvar",
+    type=click.Choice(list(FOCUS_METRICS)),
+    help="Sharpness metric",
+    show_default=True,
+)
+@click.option(
+    "-s",
+    "--scan",
+    default="stepped",
+    type=click.Choice(["stepped", "adaptive"]),
+    help="Fixed steps or an adaptive search (using the metric of each frame)",
+    show_default=True,
+)
+def main(camera: int, num_frames: int, coadd: str, metric: str, scan: str):
     welcome = "Welcome to the VAMPIRES autofocusing scripts"
     click.echo("=" * len(welcome))
     click.echo(welcome)
@@ -109,7 +159,7 @@ def main(camera: int, num_frames: int):
     click.secho(f"Optimizing fieldstop focus using VCAM{camera:.0f}", bold=True)
 
     # instantiate class
-    af = AutofocuserFieldstop()
+    af = AutofocuserFieldstop(metric=metric)
     # get SHM to fit
     shm = af.shms[camera]
 
@@ -120,7 +170,10 @@ def main(camera: int, num_frames: int):
     )
     af.fieldstop_stage.move_absolute("f", focus_posn)
     click.confirm("Adjust camera settings and proceed when ready", abort=True, default=True)
-    result = af.autofocus(shm, start_point=focus_posn, num_frames=num_frames)
+    if scan == "adaptive":
+        result = af.autofocus_adaptive(shm, start_point=focus_posn, num_frames=num_frames).position
+    else:
+        result = af.autofocus(shm, start_point=focus_posn, num_frames=num_frames, coadd=coadd)
     click.echo("Autofocus finished")
     return result
 
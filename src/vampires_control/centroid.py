@@ -1,4 +1,6 @@
 import warnings
+from dataclasses import dataclass
+from typing import Final
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -167,7 +169,8 @@ def fit_moffat_psf(data, error=None, center=None, window=30, plot: bool = False)
 
     cutout = Cutout2D(data, center[::-1], window, mode="partial")
     bbox = cutout.bbox_original
-    model = ELL_MOFFAT
+    # copy the template so concurrent fits don't share parameters
+    model = ELL_MOFFAT.copy()
     model.x0 = center[-1]
     model.y0 = center[-2]
     model.amp = np.nanmax(cutout.data)
@@ -190,18 +193,500 @@ def fit_moffat_psf(data, error=None, center=None, window=30, plot: bool = False)
     return fit_model
 
 
+MOFFAT_PARAMS: Final[tuple[str, ...]] = (
+    "x0",
+    "y0",
+    "alpha",
+    "gammax",
+    "gammay",
+    "bkg",
+    "amp",
+    "theta",
+)
+# (lower, upper) bounds of the shape parameters, matching `ELL_MOFFAT`
+_MOFFAT_BOUNDS: Final[dict[str, tuple[float, float]]] = {
+    "alpha": (0.1, np.inf),
+    "gammax": (0.5, 20),
+    "gammay": (0.5, 20),
+    "amp": (0, np.inf),
+    "theta": (-np.pi / 4, np.pi / 4),
+}
+
+
+@dataclass
+class MoffatFit:
+    """
+    Elliptical Moffat parameters for a batch of cutouts, as arrays. Coordinates (`x0`, `y0`) are
+    in the frame the cutouts were taken from.
+    """
+
+    x0: np.ndarray
+    y0: np.ndarray
+    alpha: np.ndarray
+    gammax: np.ndarray
+    gammay: np.ndarray
+    bkg: np.ndarray
+    amp: np.ndarray
+    theta: np.ndarray
+    chi2: np.ndarray
+    niter: int
+
+    def get_fwhm(self) -> dict[str, np.ndarray]:
+        corr_fact = 2 * np.sqrt(2 ** (1 / self.alpha) - 1)
+        fwhmx = self.gammax * corr_fact
+        fwhmy = self.gammay * corr_fact
+        rms = np.sqrt(fwhmx**2 + fwhmy**2 + fwhmx * fwhmy)
+        return dict(x=fwhmx, y=fwhmy, rms=rms)
+
+    def get_flux(self) -> np.ndarray:
+        """Analytic total flux of the Moffat profile (infinite for alpha <= 1)"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            flux = self.amp * np.pi * self.gammax * self.gammay / (self.alpha - 1)
+        return np.where(self.alpha > 1, flux, np.inf)
+
+    @property
+    def centroid(self) -> np.ndarray:
+        """(n, 2) array of (y, x) centroids"""
+        return np.stack((self.y0, self.x0), axis=-1)
+
+
+def _moffat_jacobian(params, ys, xs, jacobian: bool = True):
+    """Elliptical Moffat model and its analytic derivatives for (n, 8) parameters"""
+    x0, y0, alpha, gammax, gammay, bkg, amp, theta = (p[:, None] for p in params.T)
+    costh = np.cos(theta)
+    sinth = np.sin(theta)
+    dx = xs - x0
+    dy = ys - y0
+    # rotated coordinates, u = 1 + A dx^2 + B dy^2 + C dx dy
+    rx = costh * dx + sinth * dy
+    ry = costh * dy - sinth * dx
+    igx2 = 1 / gammax**2
+    igy2 = 1 / gammay**2
+    u = 1 + rx**2 * igx2 + ry**2 * igy2
+    log_u = np.log(u)
+    profile = np.exp(-alpha * log_u)
+    model = bkg + amp * profile
+    if not jacobian:
+        return model, None
+    # chain rule through u
+    dmodel_du = -alpha * amp * profile / u
+    du_dx0 = -2 * (rx * costh * igx2 - ry * sinth * igy2)
+    du_dy0 = -2 * (rx * sinth * igx2 + ry * costh * igy2)
+    du_dgx = -2 * rx**2 * igx2 / gammax
+    du_dgy = -2 * ry**2 * igy2 / gammay
+    du_dth = 2 * rx * ry * (igx2 - igy2)
+    jac = np.stack(
+        (
+            dmodel_du * du_dx0,
+            dmodel_du * du_dy0,
+            -amp * profile * log_u,
+            dmodel_du * du_dgx,
+            dmodel_du * du_dgy,
+            np.ones_like(model),
+            profile,
+            dmodel_du * du_dth,
+        ),
+        axis=-1,
+    )
+    return model, jac
+
+
+def fit_moffat_cutouts(
+    cutouts, weights=None, offsets=None, maxiter: int = 100, tol: float = 1e-8
+) -> MoffatFit:
+    """
+    Fit an elliptical Moffat profile to every cutout of a (n, ny, nx) stack at once.
+
+    Uses Levenberg-Marquardt iterations with the analytic Jacobian of `EllMoffat`, vectorized
+    over cutouts (each cutout keeps its own damping), with the same parameter bounds as
+    `ELL_MOFFAT`. Non-finite pixels are ignored. This is pure NumPy and holds no shared state,
+    so it is safe to call concurrently.
+
+    Parameters
+    ----------
+    cutouts : ArrayLike
+        (n, ny, nx) stack of cutouts, or a single cutout
+    weights : ArrayLike, optional
+        Inverse errors for each pixel, by default uniform
+    offsets : ArrayLike, optional
+        (n, 2) array of the (y, x) index of each cutout's first pixel in the full frame
+    maxiter : int
+        Maximum number of iterations, by default 100
+    tol : float
+        Relative chi^2 improvement below which a fit is converged, by default 1e-8
+
+    Returns
+    -------
+    MoffatFit
+    """
+    cutouts = np.asarray(cutouts, dtype="f8")
+    stack = cutouts.reshape(-1, *cutouts.shape[-2:])
+    n, ny, nx = stack.shape
+    ys, xs = (idx.ravel().astype("f8") for idx in np.indices((ny, nx)))
+    data = stack.reshape(n, -1)
+    if weights is None:
+        weights = np.ones_like(data)
+    else:
+        weights = np.broadcast_to(np.asarray(weights, dtype="f8"), stack.shape).reshape(n, -1)
+    mask = np.isfinite(data) & np.isfinite(weights)
+    weights = np.where(mask, weights, 0)
+    data = np.where(mask, data, 0)
+
+    # initial guess from the brightest pixel, like `fit_moffat_psf`
+    peak = np.argmax(np.where(mask, data, -np.inf), axis=1)
+    bkg = np.nanmedian(np.where(mask, data, np.nan), axis=1)
+    params = np.zeros((n, len(MOFFAT_PARAMS)))
+    params[:, 0] = xs[peak]
+    params[:, 1] = ys[peak]
+    params[:, 2] = 2
+    params[:, 3] = 2
+    params[:, 4] = 2
+    params[:, 5] = bkg
+    params[:, 6] = np.maximum(data[np.arange(n), peak] - bkg, 0)
+    lower = np.array([0, 0] + [_MOFFAT_BOUNDS.get(k, (-np.inf,))[0] for k in MOFFAT_PARAMS[2:]])
+    upper = np.array(
+        [nx - 1, ny - 1] + [_MOFFAT_BOUNDS.get(k, (None, np.inf))[1] for k in MOFFAT_PARAMS[2:]]
+    )
+
+    def chi2_of(params, idx):
+        model, _ = _moffat_jacobian(params, ys, xs, jacobian=False)
+        return np.sum((weights[idx] * (data[idx] - model)) ** 2, axis=1)
+
+    lam = np.full(n, 1e-3)
+    chi2 = chi2_of(params, slice(None))
+    active = np.ones(n, dtype=bool)
+    niter = 0
+    while niter < maxiter:
+        niter += 1
+        # only iterate the fits which have not converged yet
+        idx = np.flatnonzero(active)
+        model, jac = _moffat_jacobian(params[idx], ys, xs)
+        wjac = jac * weights[idx, :, None]
+        resid = weights[idx] * (data[idx] - model)
+        wjac_t = wjac.transpose(0, 2, 1)
+        jtj = wjac_t @ wjac
+        jtr = (wjac_t @ resid[..., None])[..., 0]
+        diag = np.einsum("nii->ni", jtj)
+        damping = lam[idx, None] * np.maximum(diag, 1e-12)
+        damped = jtj + damping[:, :, None] * np.eye(len(MOFFAT_PARAMS))
+        try:
+            step = np.linalg.solve(damped, jtr[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            step = (np.linalg.pinv(damped) @ jtr[..., None])[..., 0]
+        trial = np.clip(params[idx] + step, lower, upper)
+        trial_chi2 = chi2_of(trial, idx)
+        improved = trial_chi2 < chi2[idx]
+        # converged when the accepted improvement is negligible
+        converged = improved & (chi2[idx] - trial_chi2 <= tol * chi2[idx])
+        params[idx[improved]] = trial[improved]
+        chi2[idx[improved]] = trial_chi2[improved]
+        lam[idx] = np.where(improved, lam[idx] / 10, lam[idx] * 10)
+        active[idx] = ~converged & (lam[idx] < 1e10)
+        if not np.any(active):
+            break
+
+    if offsets is not None:
+        offsets = np.broadcast_to(np.asarray(offsets, dtype="f8"), (n, 2))
+        params[:, 0] += offsets[:, 1]
+        params[:, 1] += offsets[:, 0]
+    shape = cutouts.shape[:-2]
+    values = {k: params[:, i].reshape(shape) for i, k in enumerate(MOFFAT_PARAMS)}
+    return MoffatFit(**values, chi2=chi2.reshape(shape), niter=niter)
+
+
+def fit_moffat_stack(frames, centers=None, window=30, **kwargs) -> MoffatFit:
+    """
+    Batched `fit_moffat_psf`: fit a (window, window) cutout around the (y, x) center of each
+    frame, by default the brightest pixel, with `fit_moffat_cutouts`.
+    """
+    frames = np.asarray(frames)
+    stack = frames.reshape(-1, *frames.shape[-2:])
+    n, ny, nx = stack.shape
+    if centers is None:
+        peaks = np.nanargmax(stack.reshape(n, -1), axis=1)
+        centers = np.stack(np.unravel_index(peaks, (ny, nx)), axis=-1)
+    centers = np.broadcast_to(np.round(np.asarray(centers)).astype(int), (n, 2))
+    # cutouts hang off the frame edges with NaNs, like `Cutout2D(..., mode="partial")`
+    lower = centers - window // 2
+    rows = lower[:, 0, None] + np.arange(window)
+    cols = lower[:, 1, None] + np.arange(window)
+    valid = ((rows >= 0) & (rows < ny))[:, :, None] & ((cols >= 0) & (cols < nx))[:, None, :]
+    cutouts = stack[
+        np.arange(n)[:, None, None],
+        np.clip(rows, 0, ny - 1)[:, :, None],
+        np.clip(cols, 0, nx - 1)[:, None, :],
+    ]
+    cutouts = np.where(valid, cutouts, np.nan)
+    return fit_moffat_cutouts(cutouts, offsets=lower, **kwargs)
+
+
 def model_centroid(data, center=None, **kwargs):
     model = fit_moffat_psf(data, center=center, **kwargs)
     return (model.y0.value, model.x0.value)
 
 
+def _upsampled_dft(spectrum, shifts, upsample_factor: int, size: int):
+    """
+    Evaluate the inverse DFT of each (n, ny, nx) spectrum on a (size, size) grid upsampled by
+    `upsample_factor` and centered on each (y, x) shift, using matrix products.
+    """
+    ny, nx = spectrum.shape[-2:]
+    offsets = (np.arange(size) - size // 2) / upsample_factor
+    # coordinates of the upsampled grid, per frame
+    ys = shifts[:, 0, None] + offsets
+    xs = shifts[:, 1, None] + offsets
+    ker_y = np.exp(2j * np.pi * ys[:, :, None] * np.fft.fftfreq(ny)[None, None, :])
+    ker_x = np.exp(2j * np.pi * np.fft.fftfreq(nx)[None, :, None] * xs[:, None, :])
+    return ker_y @ spectrum @ ker_x, offsets
+
+
+def _wrap_shifts(peak_y, peak_x, ny: int, nx: int):
+    # FFT indices of the cross-correlation peak to signed (y, x) shifts
+    shift_y = np.where(peak_y > ny // 2, peak_y - ny, peak_y)
+    shift_x = np.where(peak_x > nx // 2, peak_x - nx, peak_x)
+    return np.stack((shift_y, shift_x), axis=-1).astype("f8")
+
+
+def dft_offsets(cutouts, references, upsample_factor: int = 100):
+    """
+    Batched sub-pixel (y, x) offsets of each cutout relative to its reference from the peak of
+    their DFT-upsampled cross-correlation (Guizar-Sicairos et al. 2008).
+
+    Parameters
+    ----------
+    cutouts : ArrayLike
+        (n, ny, nx) stack of images
+    references : ArrayLike
+        (n, ny, nx) stack of references (e.g., PSF models), or a single (ny, nx) reference
+    upsample_factor : int
+        Upsampling factor, the offsets are accurate to 1 / upsample_factor pixels
+
+    Returns
+    -------
+    ndarray
+        (n, 2) array of (y, x) offsets
+    """
+    cutouts = np.nan_to_num(np.asarray(cutouts, dtype="f8"))
+    references = np.nan_to_num(np.asarray(references, dtype="f8"))
+    ny, nx = cutouts.shape[-2:]
+    spectrum = np.fft.fft2(cutouts) * np.conj(np.fft.fft2(references))
+    # whole-pixel shifts from the peak of the cross-correlation
+    xcorr = np.fft.ifft2(spectrum).real.reshape(len(cutouts), -1)
+    peak_y, peak_x = np.unravel_index(np.argmax(xcorr, axis=-1), (ny, nx))
+    shifts = _wrap_shifts(peak_y, peak_x, ny, nx)
+    # refine within 1.5 pixels of the whole-pixel peak
+    size = int(np.ceil(1.5 * upsample_factor))
+    upsampled, offsets = _upsampled_dft(spectrum, shifts, upsample_factor, size)
+    upsampled = upsampled.real.reshape(len(cutouts), -1)
+    sub_y, sub_x = np.unravel_index(np.argmax(upsampled, axis=-1), (size, size))
+    return shifts + np.stack((offsets[sub_y], offsets[sub_x]), axis=-1)
+
+
+def dft_centroids(frames, psfs, centers, window=20, upsample_factor=100):
+    """
+    Batched version of `dft_centroid` for several fields at once.
+
+    Parameters
+    ----------
+    frames : Sequence[ArrayLike]
+        Images (or views into a shared image) for each field
+    psfs : Sequence[ArrayLike]
+        PSF model for each field
+    centers : Sequence[tuple]
+        Approximate (y, x) center in each image
+
+    Returns
+    -------
+    ndarray
+        (n, 2) array of refined (y, x) centers
+    """
+    centers = np.asarray(centers, dtype="f8")
+    cutouts = [Cutout2D(d, c[::-1], window, mode="partial").data for d, c in zip(frames, centers)]
+    psf_cutouts = []
+    # position of each PSF relative to the lower corner of its cutout, as in `DFTCentroider`
+    template_offsets = []
+    for psf in psfs:
+        psf_center = np.array(psf.shape[-2:]) / 2 - 0.5
+        psf_cutouts.append(Cutout2D(psf, psf_center[::-1], window, mode="partial").data)
+        template_offsets.append(psf_center - _cutout_lower(psf_center, window))
+    offsets = dft_offsets(cutouts, psf_cutouts, upsample_factor=upsample_factor)
+    refined_centers = _cutout_lower(centers, window) + np.array(template_offsets) + offsets
+
+    if np.any(np.abs(refined_centers - centers) > 10):
+        msg = f"PSF centroid appears to have failed, got {refined_centers!r}"
+        warnings.warn(msg, stacklevel=2)
+    return refined_centers
+
+
+def _cutout_lower(centers, window: int):
+    # lower corner of (window, window) cutouts, matching the pixel placement of `Cutout2D`
+    return np.ceil(np.asarray(centers) - window / 2).astype(int)
+
+
+def center_of_mass(cutouts):
+    """
+    Background-subtracted (median) center of mass of each cutout of a stack, as (n, 2) (y, x)
+    pixel indices. Cutouts without positive signal return their center.
+    """
+    cutouts = np.nan_to_num(np.asarray(cutouts, dtype="f4").reshape(-1, *np.shape(cutouts)[-2:]))
+    n, ny, nx = cutouts.shape
+    background = np.median(cutouts.reshape(n, -1), axis=-1)
+    weights = np.maximum(cutouts - background[:, None, None], 0)
+    total = weights.sum(axis=(-2, -1), dtype="f8")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cy = np.einsum("nij,i->n", weights, np.arange(ny, dtype="f4")) / total
+        cx = np.einsum("nij,j->n", weights, np.arange(nx, dtype="f4")) / total
+    centers = np.stack((cy, cx), axis=-1)
+    default = (np.array((ny, nx)) - 1) / 2
+    return np.where(np.isfinite(centers), centers, default)
+
+
+class DFTCentroider:
+    """
+    Cross-correlation centroider bound to a PSF template and a window size.
+
+    The template spectrum and the upsampling DFT matrices are computed once, so registering a
+    stack of frames only costs one batched FFT, an elementwise phase ramp per frame, and two
+    batched matrix products. Errors come from the curvature of chi^2 at the best shift, with the
+    template amplitude and noise level fit per frame.
+
+    Parameters
+    ----------
+    psf : ArrayLike
+        PSF template
+    window : int
+        Size of the cutouts, by default 20
+    upsample_factor : int
+        Upsampling factor, the shifts are accurate to 1 / upsample_factor pixels, by default 100
+    center : ArrayLike, optional
+        (y, x) position of the PSF in `psf`, by default the center of the array
+
+    Examples
+    --------
+    >>> centroider = DFTCentroider(psf, window=20)
+    >>> centers, errors = centroider(frames, centers=(250, 260))
+    """
+
+    COARSE_FACTOR: Final[int] = 10
+
+    def __init__(self, psf, window: int = 20, upsample_factor: int = 100, center=None):
+        self.window = window
+        self.upsample_factor = upsample_factor
+        psf = np.asarray(psf, dtype="f8")
+        if center is None:
+            center = np.array(psf.shape[-2:]) / 2 - 0.5
+        center = np.asarray(center, dtype="f8")
+        template = np.nan_to_num(Cutout2D(psf, center[::-1], window, mode="partial").data)
+        # position of the PSF relative to the lower corner of the template
+        self.template_offset = center - self._lower(center)
+        self.template_spectrum = np.conj(np.fft.fft2(template))
+        self.template_energy = np.sum(template**2)
+        self.freqs = np.fft.fftfreq(window)
+        # upsample in two stages: a coarse grid within 1 pixel of the whole-pixel peak, then the
+        # full upsampling factor within one coarse step of the coarse peak
+        coarse = min(upsample_factor, self.COARSE_FACTOR)
+        grids = [np.arange(-coarse, coarse + 1) / coarse]
+        if upsample_factor > coarse:
+            half = int(np.ceil(upsample_factor / coarse))
+            grids.append(np.arange(-half, half + 1) / upsample_factor)
+        self._stages = []
+        for offsets in grids:
+            ker_y = np.exp(2j * np.pi * offsets[:, None] * self.freqs[None, :])
+            self._stages.append((offsets, ker_y, np.ascontiguousarray(ker_y.T)))
+
+    def _lower(self, centers):
+        return _cutout_lower(centers, self.window)
+
+    def cutouts(self, frames, centers):
+        """(window, window) cutouts around the (y, x) centers, zero outside of the frames"""
+        frames = np.asarray(frames)
+        stack = frames.reshape(-1, *frames.shape[-2:])
+        n, ny, nx = stack.shape
+        centers = np.broadcast_to(np.asarray(centers, dtype="f8"), (n, 2))
+        lower = self._lower(centers)
+        rows = lower[:, 0, None] + np.arange(self.window)
+        cols = lower[:, 1, None] + np.arange(self.window)
+        valid = ((rows >= 0) & (rows < ny))[:, :, None] & ((cols >= 0) & (cols < nx))[:, None, :]
+        cutouts = stack[
+            np.arange(n)[:, None, None],
+            np.clip(rows, 0, ny - 1)[:, :, None],
+            np.clip(cols, 0, nx - 1)[:, None, :],
+        ]
+        return np.nan_to_num(np.where(valid, cutouts, 0))
+
+    def register(self, cutouts):
+        """
+        Sub-pixel (y, x) shifts of each cutout relative to the template, and their 1-sigma errors.
+
+        Returns
+        -------
+        shifts, errors : ndarray
+            (n, 2) arrays
+        """
+        cutouts = np.asarray(cutouts, dtype="f8").reshape(-1, self.window, self.window)
+        n = len(cutouts)
+        npix = self.window**2
+        spectrum = np.fft.fft2(cutouts) * self.template_spectrum
+        xcorr = np.fft.ifft2(spectrum).real.reshape(n, -1)
+        peak_y, peak_x = np.unravel_index(np.argmax(xcorr, axis=-1), (self.window, self.window))
+        shifts = _wrap_shifts(peak_y, peak_x, self.window, self.window)
+        for offsets, ker_y, ker_x in self._stages:
+            # shift each spectrum to the current peak with a phase ramp, then upsample around it
+            # with the precomputed DFT matrices
+            ramp_y = np.exp(2j * np.pi * shifts[:, 0, None] * self.freqs)
+            ramp_x = np.exp(2j * np.pi * shifts[:, 1, None] * self.freqs)
+            ramped = spectrum * ramp_y[:, :, None] * ramp_x[:, None, :]
+            upsampled = (ker_y @ ramped @ ker_x).real / npix
+            flat_peak = np.argmax(upsampled.reshape(n, -1), axis=-1)
+            sub_y, sub_x = np.unravel_index(flat_peak, upsampled.shape[-2:])
+            shifts += np.stack((offsets[sub_y], offsets[sub_x]), axis=-1)
+        errors = self._errors(cutouts, upsampled, sub_y, sub_x)
+        return shifts, errors
+
+    def _errors(self, cutouts, upsampled, sub_y, sub_x):
+        n = len(cutouts)
+        idx = np.arange(n)
+        peak = upsampled[idx, sub_y, sub_x]
+        # chi^2(s) = sum(d^2) - 2 a CC(s) + a^2 sum(T^2), minimized over the amplitude a
+        amp = peak / self.template_energy
+        chi2_min = np.sum(cutouts**2, axis=(-2, -1)) - peak * amp
+        variance = np.maximum(chi2_min, 0) / (self.window**2 - 3)
+        # curvature of the cross-correlation from finite differences on the upsampled grid
+        size = upsampled.shape[-1]
+        ys = np.clip(sub_y, 1, size - 2)
+        xs = np.clip(sub_x, 1, size - 2)
+        center = upsampled[idx, ys, xs]
+        curv_y = upsampled[idx, ys + 1, xs] - 2 * center + upsampled[idx, ys - 1, xs]
+        curv_x = upsampled[idx, ys, xs + 1] - 2 * center + upsampled[idx, ys, xs - 1]
+        curvature = -np.stack((curv_y, curv_x), axis=-1) * self.upsample_factor**2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            errors = np.sqrt(variance[:, None] / (amp[:, None] * curvature))
+        return np.where(np.isfinite(errors), errors, np.nan)
+
+    def __call__(self, frames, centers=None):
+        """
+        Refined (y, x) centers and errors for each frame of a stack, starting from `centers`
+        (by default the brightest pixel of each frame).
+        """
+        frames = np.asarray(frames)
+        stack = frames.reshape(-1, *frames.shape[-2:])
+        if centers is None:
+            peaks = np.nanargmax(stack.reshape(len(stack), -1), axis=1)
+            centers = np.stack(np.unravel_index(peaks, stack.shape[-2:]), axis=-1)
+        centers = np.broadcast_to(np.asarray(centers, dtype="f8"), (len(stack), 2))
+        shifts, errors = self.register(self.cutouts(stack, centers))
+        return self._lower(centers) + self.template_offset + shifts, errors
+
+
 def dft_centroid(data, psf, center=None, window=20):
     if center is None:
         center = np.unravel_index(np.nanargmax(data), data.shape)
     cutout_data = Cutout2D(data, center[::-1], window, mode="partial")
     psf_center = np.array(psf.shape[-2:]) / 2 - 0.5
     cutout_psf = Cutout2D(psf, psf_center[::-1], window, mode="partial")
-    xoff, yoff = chi2_shift(cutout_psf.data, cutout_data.data, upsample_factor="auto", return_error=False)
+    xoff, yoff = chi2_shift(
+        cutout_psf.data, cutout_data.data, upsample_factor="auto", return_error=False
+    )
     dft_offset = np.array((yoff, xoff))
     refined_center = center + dft_offset
 
@@ -0,0 +1,196 @@
+from abc import ABC, abstractmethod
+from typing import Literal
+
+import numpy as np
+
+__all__ = ("CoaddMethod", "MeanCoadder", "MedianCoadder", "SigmaClipCoadder", "get_coadder")
+
+CoaddMethod = Literal["mean", "median", "clipped"]
+
+
+class Coadder(ABC):
+    """
+    Streaming coadd of frames added one at a time, with float32 accumulators allocated on the
+    first frame. The result is None until a frame was added.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    @abstractmethod
+    def add(self, frame):
+        pass
+
+    def extend(self, frames):
+        for frame in frames:
+            self.add(frame)
+
+    @abstractmethod
+    def result(self) -> np.ndarray | None:
+        pass
+
+
+class MeanCoadder(Coadder):
+    """Running mean and variance (Welford's algorithm)"""
+
+    def __init__(self):
+        super().__init__()
+        self.mean = None
+        self._m2 = None
+
+    def add(self, frame):
+        frame = np.asarray(frame, dtype="f4")
+        if self.mean is None:
+            self.mean = np.zeros(frame.shape, dtype="f4")
+            self._m2 = np.zeros(frame.shape, dtype="f4")
+        self.count += 1
+        delta = frame - self.mean
+        self.mean += delta / self.count
+        # delta * (frame - new mean), in place
+        delta *= frame - self.mean
+        self._m2 += delta
+
+    @property
+    def variance(self) -> np.ndarray:
+        return self._m2 / max(self.count - 1, 1)
+
+    def result(self) -> np.ndarray | None:
+        if self.count == 0:
+            return None
+        return self.mean
+
+
+class SigmaClipCoadder(Coadder):
+    """
+    Sigma-clipped running mean.
+
+    The first `nwarm` frames seed a robust center and scale per pixel (median and MAD). Each
+    pixel value more than `sigma` standard deviations from the center is rejected from the mean.
+    The center and scale are then updated with the value winsorized to the clipping limits, so
+    outliers (cosmic rays, readout glitches) can't inflate them and a low seed scale recovers
+    instead of rejecting ever more values. The scale is floored at `min_scale` so that quantized,
+    low-noise pixels don't reject every value but their mean.
+    """
+
+    def __init__(self, sigma: float = 3, nwarm: int = 5, min_scale: float = 1):
+        super().__init__()
+        self.sigma = sigma
+        self.nwarm = nwarm
+        self.min_scale = min_scale
+        self.nused = None
+        self._sum = None
+        self._center = None
+        self._m2 = None
+        self._warm = []
+
+    def add(self, frame):
+        frame = np.asarray(frame, dtype="f4")
+        if self._warm is not None:
+            self._warm.append(frame.copy())
+            if len(self._warm) >= self.nwarm:
+                self._seed()
+            return
+        scale = np.sqrt(self._m2 / max(self.count - 1, 1))
+        self._accumulate(frame, self._center.copy(), scale)
+
+    def _seed(self):
+        cube = np.array(self._warm)
+        self._warm = None
+        center = np.median(cube, axis=0)
+        scale = 1.4826 * np.median(np.abs(cube - center), axis=0)
+        self.nused = np.zeros(cube.shape[1:], dtype="f4")
+        self._sum = np.zeros_like(self.nused)
+        self._center = np.zeros_like(self.nused)
+        self._m2 = np.zeros_like(self.nused)
+        for frame in cube:
+            self._accumulate(frame, center, scale)
+
+    def _accumulate(self, frame, center, scale):
+        limit = self.sigma * np.maximum(scale, self.min_scale)
+        clipped = np.clip(frame, center - limit, center + limit)
+        accept = clipped == frame
+        self.nused += accept
+        self._sum += np.where(accept, frame, 0)
+        # running (Welford) statistics of the winsorized values set the next clipping limits
+        self.count += 1
+        delta = clipped - self._center
+        self._center += delta / self.count
+        delta *= clipped - self._center
+        self._m2 += delta
+
+    @property
+    def mean(self) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.nused > 0, self._sum / self.nused, self._center)
+
+    def result(self) -> np.ndarray | None:
+        if self._warm:
+            self._seed()
+        if self.count == 0:
+            return None
+        return self.mean
+
+
+class MedianCoadder(Coadder):
+    """
+    Approximate running median (the remedian, Rousseeuw & Bassett 1990).
+
+    Frames are buffered in groups of `base`. The median of each full group is pushed into the
+    buffer of the next level, so `n` frames only need `base * ceil(log_base(n))` buffered frames
+    (33 for 1000 frames). The result is the weighted median of the partially filled buffers,
+    which is exact up to `base` frames.
+    """
+
+    def __init__(self, base: int = 11):
+        super().__init__()
+        if base % 2 == 0:
+            msg = f"remedian base must be odd, got {base}"
+            raise ValueError(msg)
+        self.base = base
+        self._levels: list[np.ndarray] = []
+        self._counts: list[int] = []
+
+    def add(self, frame):
+        self.count += 1
+        self._push(0, np.asarray(frame))
+
+    def _push(self, level: int, frame):
+        if level == len(self._levels):
+            self._levels.append(np.empty((self.base, *frame.shape), dtype="f4"))
+            self._counts.append(0)
+        buffer = self._levels[level]
+        buffer[self._counts[level]] = frame
+        self._counts[level] += 1
+        if self._counts[level] == self.base:
+            self._counts[level] = 0
+            mid = self.base // 2
+            buffer.partition(mid, axis=0)
+            self._push(level + 1, buffer[mid])
+
+    def result(self) -> np.ndarray | None:
+        if self.count == 0:
+            return None
+        if self.count <= self.base:
+            return np.median(self._levels[0][: self.count], axis=0)
+        values = np.concatenate([buf[:n] for buf, n in zip(self._levels, self._counts)])
+        weights = np.concatenate(
+            [np.full(n, self.base**level) for level, n in enumerate(self._counts)]
+        )
+        # weighted median along the first axis
+        order = np.argsort(values, axis=0)
+        cumulative = np.cumsum(weights[order], axis=0)
+        index = np.argmax(cumulative >= cumulative[-1] / 2, axis=0)
+        return np.take_along_axis(values, np.take_along_axis(order, index[None], 0), 0)[0]
+
+
+def get_coadder(method: CoaddMethod, **kwargs) -> Coadder:
+    """Streaming coadder for a method name, keyword arguments are passed to its constructor"""
+    match method:
+        case "mean":
+            return MeanCoadder(**kwargs)
+        case "median":
+            return MedianCoadder(**kwargs)
+        case "clipped":
+            return SigmaClipCoadder(**kwargs)
+    msg = f"Invalid coadd method {method!r}"
+    raise ValueError(msg)
@@ -10,6 +10,7 @@ from pydantic import BaseModel
 from scxconf.pyrokeys import VAMPIRES
 from swmain.network.pyroclient import connect
 
+from vampires_control.focus_history import predict_focus_positions
 from vampires_control.helpers import Palette, color_to_rgb
 
 
@@ -33,6 +34,21 @@ class Configuration(BaseModel):
         else:
             return 0.0
 
+    def bench_state(self) -> dict[str, str]:
+        """
+        Target bench settings of this configuration for the focus model (see
+        `predict_focus_positions`), so the focus doesn't depend on which moves finished first
+        """
+        settings = {
+            "filter": self.filter,
+            "diff": self.diff,
+            "bs": self.bs,
+            "mbi": self.mbi,
+            "puplens": self.puplens,
+            "flc": self.flc,
+        }
+        return {k: str(v).strip() for k, v in settings.items() if v is not None}
+
     @classmethod
     def from_file(cls, filename):
         with Path(filename).open("rb") as fh:
@@ -67,8 +83,6 @@ class Configuration(BaseModel):
             promises += [move_diffwheel_async(self.diff)]
         if self.bs:
             promises += [move_bs_async(self.bs)]
-        if self.fcs:
-            promises += [move_fcs_async(self.fcs)]
         if self.puplens:
             promises += [move_puplens_async(self.puplens)]
         if self.mbi:
@@ -79,18 +93,31 @@ class Configuration(BaseModel):
             promises += [move_flc_async(self.flc)]
         if self.fieldstop:
             promises += [move_fieldstop_async(self.fieldstop)]
+        if self.fcs:
+            promises += [move_fcs_async(self.fcs, self.cam_defocus, state=self.bench_state())]
 
         asyncio.gather(*promises)
 
         click.secho(" Finished! ", bg=color_to_rgb(Palette.green), fg=color_to_rgb(Palette.white))
 
 
-async def move_fcs_async(conf):
+async def move_fcs_async(conf, cam_defocus=0, state: dict | None = None):
     fcs = connect(VAMPIRES.FOCUS)
-    click.echo(f" - Moving focus to {conf}")
-    fcs.move_configuration(conf)
-    if conf.cam_defocus != 0:
-        fcs.move_relative("cam", conf.cam_defocus)
+    if str(conf).lower() == "model":
+        # best focus predicted from the autofocus history for the target bench settings (`state`,
+        # the current settings otherwise) and lens position
+        state = {"lens": fcs.get_position("lens"), **({} if state is None else state)}
+        predictions = predict_focus_positions(state=state)
+        if not predictions:
+            click.echo(" - No focus prediction available, focus not moved")
+        for stage, prediction in predictions.items():
+            click.echo(f" - Moving {stage} focus to {prediction.focus:.3f} mm (model)")
+            fcs.move_absolute(stage, prediction.focus)
+    else:
+        click.echo(f" - Moving focus to {conf}")
+        fcs.move_configuration(conf)
+    if cam_defocus != 0:
+        fcs.move_relative("cam", cam_defocus)
 
 
 async def move_puplens_async(pos):
@@ -10,6 +10,9 @@ from swmain.network.pyroclient import connect
 from typing import Literal
 import matplotlib.pyplot as plt
 
+from .frame_calibration import FrameCalibrator
+from .shm_roi import ROIReader
+
 # set up logging
 formatter = logging.Formatter("%(asctime)s|%(name)s|%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 logger = logging.getLogger("autofocus")
@@ -25,17 +28,24 @@ class CorAlign:
     DEFAULT_NUM_FRAMES = 10
     FACTOR = 0.1 # clc3
     # FACTOR = 100 # clc2
+    MAX_RAD = 256
     def __init__(self, camera_num: Literal[1, 2]=1):
         self.camera = connect(f"VCAM{camera_num}")
         self.shm = SHM(f"vcam{camera_num}")
+        # only read the pixels used by `measure_quad_diffs`
+        self.reader = ROIReader(self.shm, windows={})
+        center = np.array(self.reader.shape) / 2 - 0.5
+        self.reader.set_window("quads", center, 2 * self.MAX_RAD + 2)
+        self.calibrator = FrameCalibrator(self.shm)
         self.fieldstop = connect("VAMPIRES_FIELDSTOP")
 
-    def run(self, num_frames=DEFAULT_NUM_FRAMES, max_niter=100):
+    def run(self, num_frames=DEFAULT_NUM_FRAMES, max_niter=100, coadd="median"):
         niter = 0
         while niter <= max_niter:
-            data_cube = self.shm.multi_recv_data(num_frames, output_as_cube=True).astype("f4")
-            mean_frame = np.nanmedian(data_cube - 200, axis=0, overwrite_input=True)
-            dx, dy = measure_quad_diffs(mean_frame)
+            self.calibrator.update()
+            mean_frame = self.reader.read_frame(num_frames, coadd=coadd, fill_value=np.nan)
+            self.calibrator(mean_frame)
+            dx, dy = measure_quad_diffs(mean_frame, max_rad=self.MAX_RAD)
             logger.info("Measured energy of dx=%.02g dy=%.02g", dx, dy)
 
             # to move left (-x) requires moving fieldstop stage +y
@@ -114,7 +124,15 @@ def measure_quad_diffs(mean_frame, max_rad: float=256):
     help="Number of frames to coadd for each measurement",
     show_default=True,
 )
-def main(camera: int, num_frames: int):
+@click.option(
+    "-k",
+    "--coadd",
+    default="median",
+    type=click.Choice(["median", "mean", "clipped"]),
+    help="Streaming coadd of the frames (median is approximate beyond 11 frames)",
+    show_default=True,
+)
+def main(camera: int, num_frames: int, coadd: str):
     welcome = "Welcome to the VAMPIRES coronagraph alignment scripts"
     click.echo("=" * len(welcome))
     click.echo(welcome)
@@ -123,7 +141,7 @@ def main(camera: int, num_frames: int):
 
     # instantiate class
     cor_align = CorAlign(camera)
-    cor_align.run(num_frames)
+    cor_align.run(num_frames, coadd=coadd)
 
     click.echo("Coronagraph alignment finished")
     return None
@@ -0,0 +1,132 @@
+from dataclasses import dataclass
+from typing import Final
+
+import numpy as np
+
+__all__ = ("FIELDSTOP_SIZE", "READOUT_MODELS", "ReadoutModel", "optimize_crop", "window_bounds")
+
+# ORCA-Quest sensor (rows, columns)
+SENSOR_SHAPE: Final[tuple[int, int]] = (2304, 4096)
+# crop origins and sizes must be multiples of 4 px
+CROP_STEP: Final[int] = 4
+# field stop window around each PSF, in px
+FIELDSTOP_SIZE: Final[int] = 536
+
+
+@dataclass(frozen=True)
+class ReadoutModel:
+    """
+    Rolling-shutter readout timing of the ORCA-Quest.
+
+    The two halves of the sensor are read out in parallel, row by row starting from the center,
+    so the readout time of a crop is set by the distance of its farthest row from the sensor
+    center, independent of the number of columns. The overhead is fit to the full-frame rate.
+
+    Parameters
+    ----------
+    line_time : float
+        Time to read one row of each half, in s
+    overhead_lines : int
+        Fixed overhead per frame, in line times
+    """
+
+    line_time: float
+    overhead_lines: int = 5
+    sensor_shape: tuple[int, int] = SENSOR_SHAPE
+
+    def nlines(self, y0, y1):
+        """Number of row pairs read out for crops spanning rows y0 to y1 (inclusive)"""
+        center = self.sensor_shape[0] // 2
+        y0 = np.asarray(y0)
+        y1 = np.asarray(y1)
+        return np.maximum(np.maximum(y1 + 1 - center, 0), np.maximum(center - y0, 0))
+
+    def readout_time(self, y0, y1):
+        return self.line_time * (self.nlines(y0, y1) + self.overhead_lines)
+
+    def fps(self, y0, y1, tint: float | None = None):
+        """Maximum frame rate for the crop, limited by the exposure time if given"""
+        frame_time = self.readout_time(y0, y1)
+        if tint is not None:
+            frame_time = np.maximum(frame_time, tint)
+        return 1 / frame_time
+
+
+# standard and ultra-quiet scans (120 and 5 fps full frame)
+READOUT_MODELS: Final[dict[str, ReadoutModel]] = {
+    "FAST": ReadoutModel(line_time=7.2e-6),
+    "SLOW": ReadoutModel(line_time=172.8e-6),
+}
+
+
+def window_bounds(centers, size: int = FIELDSTOP_SIZE) -> np.ndarray:
+    """
+    Inclusive (y0, y1, x0, x1) pixel bounds of `size` windows around (y, x) centers, with the
+    pixel placement of `Cutout2D`
+    """
+    centers = np.atleast_2d(centers)
+    lower = np.ceil(centers - size / 2).astype(int)
+    upper = lower + size - 1
+    return np.stack((lower[:, 0], upper[:, 0], lower[:, 1], upper[:, 1]), axis=-1)
+
+
+def _candidates(low: int, high: int, length: int, slack: int):
+    # aligned (start, end) pairs containing [low, high] within the sensor, extending up to
+    # `slack` px past the minimal range on either side
+    start_max = int(np.floor(max(low, 0) / CROP_STEP) * CROP_STEP)
+    starts = np.arange(start_max, max(start_max - slack, 0) - 1, -CROP_STEP)
+    sizes = np.arange(CROP_STEP, length + 1, CROP_STEP)
+    starts, sizes = np.meshgrid(starts, sizes, indexing="ij")
+    ends = starts + sizes - 1
+    valid = (ends >= min(high, length - 1)) & (ends < length) & (ends <= high + slack)
+    return starts[valid], ends[valid]
+
+
+def optimize_crop(
+    centers,
+    model: ReadoutModel = READOUT_MODELS["FAST"],
+    window: int = FIELDSTOP_SIZE,
+    tint: float | None = None,
+    slack: int = 64,
+) -> dict:
+    """
+    Find the crop with the highest frame rate containing the field stop window of every PSF.
+
+    Candidate crops are aligned to `CROP_STEP` and extend up to `slack` px beyond the bounding
+    box of the windows (clipped to the sensor). They are ranked by the frame rate predicted by
+    the readout `model`, then by their number of pixels.
+
+    Parameters
+    ----------
+    centers : ArrayLike
+        (y, x) detector positions of the PSFs
+    model : ReadoutModel
+        Readout timing, by default the standard scan
+    window : int
+        Size of the field stop windows, by default `FIELDSTOP_SIZE`
+    tint : float, optional
+        Exposure time, which limits the frame rate, in s
+
+    Returns
+    -------
+    dict
+        Inclusive crop bounds "x0", "x1", "y0", "y1", and the predicted "fps"
+    """
+    bounds = window_bounds(centers, window)
+    ymin, xmin = bounds[:, 0].min(), bounds[:, 2].min()
+    ymax, xmax = bounds[:, 1].max(), bounds[:, 3].max()
+    ny, nx = model.sensor_shape
+    y0, y1 = _candidates(ymin, ymax, ny, slack)
+    x0, x1 = _candidates(xmin, xmax, nx, slack)
+    # the readout time only depends on the rows, so the columns are simply the narrowest range
+    ix = np.argmin(x1 - x0)
+    fps = model.fps(y0, y1, tint=tint)
+    npix = (y1 - y0 + 1) * (x1[ix] - x0[ix] + 1)
+    iy = np.lexsort((npix, -fps))[0]
+    return {
+        "x0": int(x0[ix]),
+        "x1": int(x1[ix]),
+        "y0": int(y0[iy]),
+        "y1": int(y1[iy]),
+        "fps": float(fps[iy]),
+    }
@@ -0,0 +1,96 @@
+import json
+import logging
+import math
+import time
+import warnings
+from argparse import ArgumentParser
+
+from swmain.infra.badsystemd.aux import auto_register_to_watchers
+from swmain.redis import RDB
+
+from vampires_control.hotspot import HotspotTracker
+
+# set up logging
+formatter = logging.Formatter("%(asctime)s|%(name)s|%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger("hotspot_daemon")
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.INFO)
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+
+parser = ArgumentParser(
+    description="VAMPIRES hotspot daemon",
+    usage="Periodically fits the PSF positions of a camera stream and tracks their drift",
+)
+parser.add_argument("stream", choices=["vcam1", "vcam2"], help="Camera stream")
+parser.add_argument(
+    "-t", type=float, default=300, help="Time between fits in seconds, by default %(default)f s"
+)
+parser.add_argument(
+    "-n", "--num-frames", type=int, default=10, help="Frames per fit, by default %(default)d"
+)
+parser.add_argument(
+    "-m",
+    "--margin",
+    type=float,
+    default=20,
+    help="Minimum distance to the crop edges in px, by default %(default)f",
+)
+parser.add_argument(
+    "--horizon",
+    type=float,
+    default=1,
+    help="Alert when the margin would be reached within this many hours, by default %(default)f",
+)
+
+
+def hotspot_redis_key(stream: str) -> str:
+    """Redis hash where the hotspot daemon publishes the latest fits for the given stream"""
+    return f"U_HOTSPOT{stream[-1]}"
+
+
+def _json_safe(check: dict) -> dict:
+    # JSON has no infinity or NaN (e.g., `hours_to_exit` without drift), publish null instead
+    return {
+        k: None if isinstance(v, float) and not math.isfinite(v) else v for k, v in check.items()
+    }
+
+
+class RedisHotspotTracker(HotspotTracker):
+    """`HotspotTracker` which also publishes the latest fits and alerts to a redis hash"""
+
+    def __init__(self, shm_name: str, **kwargs):
+        super().__init__(shm_name, **kwargs)
+        self.redis_key = hotspot_redis_key(shm_name)
+
+    def publish(self, checks: dict[str, dict]):
+        mapping = {field: json.dumps(_json_safe(check)) for field, check in checks.items()}
+        mapping["time"] = time.time()
+        mapping["alert"] = int(any(check["alert"] for check in checks.values()))
+        # remove fields from a previous camera mode
+        with RDB.pipeline() as pipe:
+            pipe.delete(self.redis_key)
+            pipe.hset(self.redis_key, mapping=mapping)
+            pipe.execute()
+        super().publish(checks)
+
+
+def main():
+    args = parser.parse_args()
+    auto_register_to_watchers(f"HOTSPOT{args.stream[-1]}", "Hotspot drift tracker")
+    tracker = RedisHotspotTracker(
+        args.stream,
+        num_frames=args.num_frames,
+        cadence=args.t,
+        min_margin=args.margin,
+        horizon=args.horizon,
+    )
+    logger.info(f"Tracking hotspots of {args.stream} every {args.t} s")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        tracker.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import json
+import logging
+import time
+import warnings
+from argparse import ArgumentParser
+from typing import Final
+
+from swmain.infra.badsystemd.aux import auto_register_to_watchers
+from swmain.redis import RDB
+
+from vampires_control.strehl import StrehlStream, strehl_redis_key
+
+# set up logging
+formatter = logging.Formatter("%(asctime)s|%(name)s|%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger("strehl_daemon")
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.INFO)
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+
+# wait before retrying after a failed measurement, in s
+RETRY_DELAY: Final[float] = 1
+
+parser = ArgumentParser(
+    description="VAMPIRES Strehl daemon",
+    usage="Continuously measures the Strehl ratio from a camera stream and pushes summaries to redis",
+)
+parser.add_argument("stream", choices=["vcam1", "vcam2"], help="Camera stream")
+parser.add_argument(
+    "-t", type=float, default=0.5, help="Publishing time in seconds, by default %(default)f s"
+)
+parser.add_argument(
+    "-a", "--nave", type=int, default=1, help="Frames per coadd, by default %(default)d"
+)
+parser.add_argument(
+    "-b", "--batch", type=int, default=100, help="Frames per batch, by default %(default)d"
+)
+
+
+class RedisStrehlStream(StrehlStream):
+    """
+    Long-lived `StrehlStream` which keeps the SHM handle, PSF references, and peak-finding
+    kernels warm and publishes summaries to a redis hash (see `strehl_redis_key`).
+    """
+
+    def __init__(self, shm_name: str, **kwargs):
+        super().__init__(shm_name, **kwargs)
+        self.redis_key = strehl_redis_key(shm_name)
+
+    def publish(self, summaries: dict[str, dict]):
+        mapping = {field: json.dumps(summary) for field, summary in summaries.items()}
+        mapping["time"] = time.time()
+        # remove fields from a previous camera mode
+        with RDB.pipeline() as pipe:
+            pipe.delete(self.redis_key)
+            pipe.hset(self.redis_key, mapping=mapping)
+            pipe.execute()
+        super().publish(summaries)
+
+    def run(self, duration: float | None = None):
+        # a failed step (e.g., while the camera stream is being recreated) is logged and the
+        # stream reopened, so the daemon keeps running
+        start = last_summary = time.monotonic()
+        while duration is None or time.monotonic() - start < duration:
+            try:
+                self.step()
+                if time.monotonic() - last_summary >= self.summary_interval:
+                    self.publish(self.summary())
+                    last_summary = time.monotonic()
+            except Exception:
+                logger.exception(f"Strehl measurement from {self.shm_name} failed")
+                time.sleep(RETRY_DELAY)
+
+
+def main():
+    args = parser.parse_args()
+    auto_register_to_watchers(f"STREHL{args.stream[-1]}", "Strehl ratio redis updater")
+    strehl_stream = RedisStrehlStream(
+        args.stream, nave=args.nave, batch=args.batch, summary_interval=args.t
+    )
+    logger.info(f"Measuring Strehl ratio from {args.stream}")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        strehl_stream.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,19 @@
+import json
 import urllib
+import warnings
+from functools import lru_cache
+from pathlib import Path
 from typing import Final
 
 import astropy.units as u
+import click
 import numpy as np
+from astropy.table import Table
 from astropy.utils.data import download_file
-from synphot import SpectralElement
+from synphot import Empirical1D, SpectralElement
+
+from . import paths
+from .helpers import atomic_write
 
 VAMPIRES_STD_FILTERS: Final[set] = {
     "Open",
@@ -33,16 +42,15 @@ VAMPIRES_FILTER_URL: Final[
 ] = f"https://docs.google.com/spreadsheets/d/{VAMP_FILT_KEY}/gviz/tq?tqx=out:csv&sheet={VAMP_FILT_NAME}"
 
 
-def load_vampires_filter(name: str) -> SpectralElement:
-    if name not in VAMPIRES_FILTERS:
-        msg = f"VAMPIRES filter '{name}' not recognized"
-        raise ValueError(msg)
-    csv_path = download_file(VAMPIRES_FILTER_URL, cache=True)
-    return SpectralElement.from_file(csv_path, wave_unit="nm", include_names=["wave", name])
+# bump the version whenever the filter curves are re-measured
+FILTER_TABLE_VERSION: Final[int] = 1
+FILTER_TABLE_NAME: Final[str] = f"vampires_filters_v{FILTER_TABLE_VERSION}.npz"
+# the table shipped with the package, and a locally rebuilt table which takes precedence
+PACKAGED_FILTER_TABLE_PATH: Final[Path] = Path(__file__).parent / "data" / FILTER_TABLE_NAME
+FILTER_TABLE_PATH: Final[Path] = paths.DATA_DIR / FILTER_TABLE_NAME
 
 
-def get_filter_info_dict(filt_name: str) -> tuple[SpectralElement, dict]:
-    filt = load_vampires_filter(filt_name)
+def _filter_info(filt_name: str, filt: SpectralElement) -> dict:
     waves = filt.waveset
     through = filt.model.lookup_table
     above_50 = np.nonzero(through >= 0.5 * np.nanmax(through))
@@ -57,4 +65,95 @@ def get_filter_info_dict(filt_name: str) -> tuple[SpectralElement, dict]:
     info["DLAMLAM"] = info["WAVEFWHM"] / info["WAVEAVE"]
     info["DIAMETER"] = 7.92
     info["RESELEM"] = np.rad2deg(info["WAVEAVE"] * 1e-9 / info["DIAMETER"]) * 3.6e6
+    return {k: v if isinstance(v, str) else float(v) for k, v in info.items()}
+
+
+def build_filter_table(outfile: Path = FILTER_TABLE_PATH) -> Path:
+    """
+    Download the VAMPIRES filter curves and save them as a compact npz table.
+
+    The table stores the wavelength (nm) and throughput of every filter along with the
+    precomputed `get_filter_info_dict` summaries, so the curves are only downloaded once (when
+    neither the packaged nor a local table exists). Filters missing from the spreadsheet are skipped with a warning.
+    """
+    csv_path = download_file(VAMPIRES_FILTER_URL, cache=True)
+    table = Table.read(csv_path, format="ascii.csv")
+    arrays = {}
+    infos = {}
+    for name in sorted(VAMPIRES_FILTERS):
+        if name not in table.colnames:
+            msg = f"VAMPIRES filter '{name}' is missing from the filter curves"
+            warnings.warn(msg, stacklevel=2)
+            continue
+        waves = np.ma.filled(table["wave"].astype("f8"), np.nan)
+        through = np.ma.filled(table[name].astype("f8"), np.nan)
+        mask = np.isfinite(waves) & np.isfinite(through)
+        arrays[f"wave_{name}"] = waves[mask]
+        arrays[f"through_{name}"] = through[mask]
+        filt = _make_spectral_element(waves[mask], through[mask])
+        infos[name] = _filter_info(name, filt)
+    outfile = Path(outfile)
+
+    def writer(tmpname):
+        with Path(tmpname).open("wb") as fh:
+            np.savez_compressed(
+                fh,
+                version=FILTER_TABLE_VERSION,
+                info=json.dumps(infos),
+                url=VAMPIRES_FILTER_URL,
+                **arrays,
+            )
+
+    atomic_write(outfile, writer)
+    return outfile
+
+
+@lru_cache(maxsize=1)
+def _load_filter_table() -> dict:
+    for path in (FILTER_TABLE_PATH, PACKAGED_FILTER_TABLE_PATH):
+        if path.exists():
+            break
+    else:
+        # no table shipped or built yet, download the curves once and keep them locally
+        path = build_filter_table(FILTER_TABLE_PATH)
+    with np.load(path) as npz:
+        table = {k: npz[k] for k in npz.files}
+    table["info"] = json.loads(str(table["info"]))
+    return table
+
+
+def _make_spectral_element(waves, through) -> SpectralElement:
+    return SpectralElement(Empirical1D, points=waves * u.nm, lookup_table=through)
+
+
+@lru_cache(maxsize=None)
+def load_vampires_filter(name: str) -> SpectralElement:
+    if name not in VAMPIRES_FILTERS:
+        msg = f"VAMPIRES filter '{name}' not recognized"
+        raise ValueError(msg)
+    table = _load_filter_table()
+    if f"wave_{name}" not in table:
+        msg = f"VAMPIRES filter '{name}' is missing from the filter table"
+        raise ValueError(msg)
+    return _make_spectral_element(table[f"wave_{name}"], table[f"through_{name}"])
+
+
+def get_filter_info_dict(filt_name: str) -> tuple[SpectralElement, dict]:
+    filt = load_vampires_filter(filt_name)
+    info = _load_filter_table()["info"][filt_name].copy()
     return filt, info
+
+
+@click.command("vampires_filter_table")
+@click.option(
+    "--package/--local",
+    default=False,
+    help="Write the table shipped with the package instead of the local override",
+    show_default=True,
+)
+def update_filter_table(package: bool):
+    """Re-download the VAMPIRES filter curves and rebuild the filter table"""
+    outfile = build_filter_table(PACKAGED_FILTER_TABLE_PATH if package else FILTER_TABLE_PATH)
+    _load_filter_table.cache_clear()
+    load_vampires_filter.cache_clear()
+    click.echo(f"Saved VAMPIRES filter table to {outfile}")
@@ -0,0 +1,365 @@
+import sqlite3
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Final
+
+import click
+import numpy as np
+from swmain.redis import get_values
+
+from . import paths
+
+__all__ = (
+    "FocusHistory",
+    "FocusModel",
+    "FocusPrediction",
+    "bench_state",
+    "predict_focus_positions",
+    "search_width",
+)
+
+DEFAULT_DB: Final[Path] = paths.DATA_DIR / "autofocus.sqlite"
+# categorical bench state and the redis keys they are read from (the differential filter of each
+# camera is read from U_DIFFL1 or U_DIFFL2)
+CATEGORIES: Final[tuple[str, ...]] = ("filter", "diff", "bs", "mbi", "puplens", "flc")
+BENCH_KEYS: Final[dict[str, str]] = {
+    "filter": "U_FILTER",
+    "bs": "U_BS",
+    "mbi": "U_MBI",
+    "puplens": "U_PUPST",
+    "flc": "U_FLCST",
+    "flc_temp": "U_FLCTMP",
+}
+# the lens stage is focused on VCAM2 and the camera stage on VCAM1, see `Autofocuser`
+FOCUS_CAMERAS: Final[dict[str, int]] = {"lens": 2, "cam": 1}
+# stages whose best focus depends on the lens stage position, which is then recorded with the run
+LENS_DEPENDENT: Final[tuple[str, ...]] = ("cam",)
+# search window around a prediction, in units of its uncertainty, and its limits in mm
+SEARCH_SIGMAS: Final[float] = 4
+MIN_SEARCH_WIDTH: Final[float] = 0.3
+MAX_SEARCH_WIDTH: Final[float] = 1.5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS autofocus (
+    time REAL NOT NULL,
+    stage TEXT NOT NULL,
+    cam INTEGER NOT NULL,
+    filter TEXT,
+    diff TEXT,
+    bs TEXT,
+    mbi TEXT,
+    puplens TEXT,
+    flc TEXT,
+    flc_temp REAL,
+    focus REAL NOT NULL,
+    strehl REAL,
+    method TEXT,
+    lens REAL
+);
+CREATE INDEX IF NOT EXISTS autofocus_stage_cam_time ON autofocus (stage, cam, time);
+"""
+COLUMNS: Final[tuple[str, ...]] = (
+    "time",
+    "stage",
+    "cam",
+    *CATEGORIES,
+    "flc_temp",
+    "lens",
+    "focus",
+    "strehl",
+    "method",
+)
+_DTYPE: Final = np.dtype(
+    [
+        ("time", "f8"),
+        ("stage", "U8"),
+        ("cam", "i4"),
+        *((cat, "U32") for cat in CATEGORIES),
+        ("flc_temp", "f8"),
+        ("lens", "f8"),
+        ("focus", "f8"),
+        ("strehl", "f8"),
+        ("method", "U16"),
+    ]
+)
+
+
+def bench_state(cam: int) -> dict:
+    """Current bench state (see `BENCH_KEYS`) for a camera from redis"""
+    diff_key = f"U_DIFFL{cam}"
+    values = get_values((*BENCH_KEYS.values(), diff_key))
+    state = {name: values[key] for name, key in BENCH_KEYS.items()}
+    state["diff"] = values[diff_key]
+    for cat in CATEGORIES:
+        state[cat] = str(state[cat]).strip()
+    state["flc_temp"] = np.nan if state["flc_temp"] is None else float(state["flc_temp"])
+    return state
+
+
+@dataclass(frozen=True)
+class FocusPrediction:
+    """Predicted best focus (mm), its 1-sigma uncertainty, and the number of runs it is based on"""
+
+    focus: float
+    uncertainty: float
+    nsamples: int
+
+
+def search_width(prediction: FocusPrediction | None) -> float:
+    """Width of the focus search around a prediction (the full default window without one)"""
+    if prediction is None:
+        return MAX_SEARCH_WIDTH
+    width = 2 * SEARCH_SIGMAS * prediction.uncertainty
+    return float(np.clip(width, MIN_SEARCH_WIDTH, MAX_SEARCH_WIDTH))
+
+
+class FocusModel:
+    """
+    Linear model of the best focus as a function of the bench state.
+
+    Each categorical setting (`CATEGORIES`) enters as one-hot offsets, and the FLC temperature and
+    the lens stage position (for `LENS_DEPENDENT` stages, which the lens refocuses) as linear
+    terms. The fit is ridge-regularized (except for the intercept and the lens position), since
+    many settings are only ever used in a few combinations, and weighted by recency with an
+    exponential `half_life` (in days) so slow drifts of the bench are followed.
+
+    Parameters
+    ----------
+    ridge : float
+        Regularization of the offsets, relative to the total weight, by default 1e-2
+    half_life : float
+        Half-life of the weights of past runs, in days, by default 60
+    """
+
+    def __init__(self, ridge: float = 1e-2, half_life: float = 60):
+        self.ridge = ridge
+        self.half_life = half_life
+        self.levels: dict[str, list[str]] = {}
+        self.coef = None
+        self.temp_ref = 0
+        self.lens_ref = 0
+        self.nsamples = 0
+
+    def _design(self, rows) -> np.ndarray:
+        columns = [
+            np.ones(len(rows)),
+            np.nan_to_num(rows["flc_temp"] - self.temp_ref),
+            np.nan_to_num(rows["lens"] - self.lens_ref),
+        ]
+        for cat in CATEGORIES:
+            columns.extend(rows[cat] == level for level in self.levels[cat])
+        return np.column_stack(columns).astype("f8")
+
+    def fit(self, rows, now: float | None = None) -> "FocusModel":
+        """Fit the model to history rows (see `FocusHistory.query`)"""
+        now = rows["time"].max() if now is None else now
+        self.levels = {cat: sorted(set(rows[cat])) for cat in CATEGORIES}
+        temps = rows["flc_temp"][np.isfinite(rows["flc_temp"])]
+        self.temp_ref = float(np.mean(temps)) if len(temps) else 0
+        lenses = rows["lens"][np.isfinite(rows["lens"])]
+        self.lens_ref = float(np.mean(lenses)) if len(lenses) else 0
+        X = self._design(rows)
+        weights = 0.5 ** ((now - rows["time"]) / (self.half_life * 86400))
+        penalty = np.full(X.shape[1], self.ridge * weights.sum())
+        # the lens stage often only moves by a fraction of a mm, don't shrink its slope
+        penalty[[0, 2]] = 0
+        normal = X.T @ (weights[:, None] * X)
+        self._inverse = np.linalg.pinv(normal + np.diag(penalty))
+        self.coef = self._inverse @ (X.T @ (weights * rows["focus"]))
+        resid = rows["focus"] - X @ self.coef
+        dof = max(len(rows) - np.linalg.matrix_rank(normal), 1)
+        self.sigma = float(np.sqrt(np.sum(weights * resid**2) / weights.sum() * len(rows) / dof))
+        self._covariance = self.sigma**2 * self._inverse @ normal @ self._inverse
+        self.nsamples = len(rows)
+        return self
+
+    def predict(self, state: dict) -> FocusPrediction:
+        """
+        Predict the best focus for a bench state (see `bench_state`) and, optionally, lens stage
+        position ("lens", the mean of the history if missing). Settings never seen in the
+        history add the spread of the offsets of their category to the uncertainty.
+        """
+        lens = state.get("lens", np.nan)
+        row = np.array(
+            [(0, "", 0, *(state[cat] for cat in CATEGORIES), state["flc_temp"], lens, 0, 0, "")],
+            dtype=_DTYPE,
+        )
+        x = self._design(row)[0]
+        variance = self.sigma**2 + x @ self._covariance @ x
+        start = 3
+        for cat in CATEGORIES:
+            stop = start + len(self.levels[cat])
+            if state[cat] not in self.levels[cat] and stop > start:
+                variance += np.var(self.coef[start:stop])
+            start = stop
+        return FocusPrediction(float(x @ self.coef), float(np.sqrt(variance)), self.nsamples)
+
+
+class FocusHistory:
+    """
+    Indexed history of autofocus results in sqlite.
+
+    Every run is stored with the bench state (`bench_state`), the lens stage position for
+    `LENS_DEPENDENT` stages, the best focus, and the peak Strehl ratio, indexed by (stage, cam,
+    time). `predict` fits a `FocusModel` to the recent runs of a stage and camera to give a
+    starting point for the next autofocus.
+
+    Parameters
+    ----------
+    path : Path
+        Database file, created if needed, by default `autofocus.sqlite` in `paths.DATA_DIR`
+    """
+
+    def __init__(self, path: Path = DEFAULT_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            # histories from before the lens position was recorded
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(autofocus)")}
+            if "lens" not in columns:
+                conn.execute("ALTER TABLE autofocus ADD COLUMN lens REAL")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def add(
+        self,
+        stage: str,
+        cam: int,
+        state: dict,
+        focus: float,
+        strehl: float | None = None,
+        method: str = "",
+        time: float | None = None,
+    ):
+        """
+        Record an autofocus result with the bench state it was measured in, including the lens
+        stage position ("lens") for `LENS_DEPENDENT` stages
+        """
+        time = datetime.now(timezone.utc).timestamp() if time is None else time
+        lens = state.get("lens")
+        row = (
+            time,
+            stage,
+            int(cam),
+            *(state[cat] for cat in CATEGORIES),
+            state["flc_temp"],
+            None if lens is None or stage not in LENS_DEPENDENT else float(lens),
+            float(focus),
+            None if strehl is None else float(strehl),
+            method,
+        )
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                f"INSERT INTO autofocus ({', '.join(COLUMNS)})"
+                f" VALUES ({', '.join('?' * len(COLUMNS))})",
+                row,
+            )
+
+    def query(self, stage: str, cam: int, start=None, end=None) -> np.ndarray:
+        """Runs of a stage and camera between `start` and `end` (unix times), sorted by time"""
+        sql = f"SELECT {', '.join(COLUMNS)} FROM autofocus WHERE stage = ? AND cam = ?"
+        params = [stage, int(cam)]
+        if start is not None:
+            sql += " AND time >= ?"
+            params.append(start)
+        if end is not None:
+            sql += " AND time < ?"
+            params.append(end)
+        sql += " ORDER BY time"
+        with closing(self._connect()) as conn:
+            rows = conn.execute(sql, params).fetchall()
+        # missing strehl, temperature, and lens position become NaN
+        rows = [tuple(np.nan if v is None else v for v in row) for row in rows]
+        return np.array(rows, dtype=_DTYPE)
+
+    def predict(
+        self,
+        stage: str,
+        cam: int,
+        state: dict,
+        max_age: float = 365,
+        min_samples: int = 5,
+        now: float | None = None,
+    ) -> FocusPrediction | None:
+        """
+        Predict the best focus of a stage for a camera and bench state from the runs of the last
+        `max_age` days, or None with fewer than `min_samples` runs.
+        """
+        now = datetime.now(timezone.utc).timestamp() if now is None else now
+        rows = self.query(stage, cam, start=now - max_age * 86400, end=now + 1)
+        if len(rows) < min_samples:
+            return None
+        return FocusModel().fit(rows, now=now).predict(state)
+
+
+def predict_focus_positions(
+    history: FocusHistory | None = None, state: dict | None = None
+) -> dict[str, FocusPrediction]:
+    """
+    Predicted best focus of each focus stage (see `FOCUS_CAMERAS`), for the stages with enough
+    history.
+
+    Parameters
+    ----------
+    history : FocusHistory, optional
+        Autofocus history, by default the default database
+    state : dict, optional
+        Bench settings overriding the current bench state from redis, e.g., the target settings
+        of a configuration which is still moving, and the lens stage position ("lens"). The
+        `LENS_DEPENDENT` stages use the predicted lens focus when there is one.
+    """
+    if history is None:
+        history = FocusHistory()
+    overrides = {} if state is None else state
+    predictions = {}
+    for stage, cam in FOCUS_CAMERAS.items():
+        cam_state = {**bench_state(cam), **overrides}
+        if stage in LENS_DEPENDENT and "lens" in predictions:
+            cam_state["lens"] = predictions["lens"].focus
+        prediction = history.predict(stage, cam, cam_state)
+        if prediction is not None:
+            predictions[stage] = prediction
+    return predictions
+
+
+@click.command("vampires_focus_predict")
+@click.argument("stage", type=click.Choice(["lens", "cam"], case_sensitive=False))
+@click.option("-c", "--camera", default=1, type=int, help="Camera", show_default=True)
+@click.option("-n", "--last", default=10, type=int, help="Number of recent runs to show")
+@click.option(
+    "-l",
+    "--lens",
+    type=float,
+    help="Lens stage position for the camera stage prediction, in mm (by default the mean of the"
+    " history)",
+)
+def vampires_focus_predict(stage: str, camera: int, last: int, lens: float | None):
+    """Print the recent autofocus runs and the predicted focus for the current bench state"""
+    history = FocusHistory()
+    rows = history.query(stage, camera)[-last:]
+    for row in rows:
+        time = datetime.fromtimestamp(row["time"], timezone.utc) - timedelta(hours=10)
+        click.echo(
+            f"{time:%Y-%m-%d %H:%M} HST  {row['focus']:7.3f} mm  Strehl {row['strehl'] * 100:5.1f}%"
+            f"  {' '.join(row[cat] for cat in CATEGORIES)}  FLC {row['flc_temp']:.1f} C"
+        )
+    state = bench_state(camera)
+    if lens is not None:
+        state["lens"] = lens
+    prediction = history.predict(stage, camera, state)
+    if prediction is None:
+        click.echo(f"Not enough autofocus runs to predict the {stage} focus of VCAM{camera}")
+        return
+    click.echo(
+        f"Predicted {stage} focus: {prediction.focus:.3f} +- {prediction.uncertainty:.3f} mm"
+        f" (from {prediction.nsamples} runs, search width {search_width(prediction):.2f} mm)"
+    )
+
+
+if __name__ == "__main__":
+    vampires_focus_predict()
@@ -0,0 +1,165 @@
+from collections.abc import Callable
+from functools import lru_cache
+from typing import Final, Literal
+
+import numpy as np
+from scipy import fft
+
+from .helpers import rfft_weights
+
+__all__ = (
+    "FOCUS_METRICS",
+    "FocusMetric",
+    "brenner",
+    "ee_ratio",
+    "focus_metric",
+    "hf_power",
+    "normalized_variance",
+    "tenengrad",
+)
+
+FocusMetric = Literal["normvar", "brenner", "tenengrad", "hf_power", "ee_ratio"]
+# spatial frequencies (cycles/px) of the high-frequency band, inside the diffraction cutoff of
+# every filter (>0.27 cycles/px at 5.9 mas/px), and beyond which only noise is left
+HF_BAND: Final[tuple[float, float]] = (0.05, 0.25)
+NOISE_FREQ: Final[float] = 0.45
+
+
+def _as_cube(frames) -> np.ndarray:
+    frames = np.asarray(frames, dtype="f4")
+    return frames.reshape(-1, *frames.shape[-2:])
+
+
+def normalized_variance(frames) -> np.ndarray:
+    """Variance over mean of each frame of a (n, ny, nx) cube (or a single frame)"""
+    frames = np.asarray(frames, dtype="f4")
+    return np.var(frames, axis=(-2, -1)) / np.mean(frames, axis=(-2, -1))
+
+
+def brenner(frames, step: int = 2) -> np.ndarray:
+    """
+    Brenner gradient of each frame: mean squared difference of pixels `step` apart along both
+    axes, normalized by the squared mean so it doesn't depend on the flux.
+    """
+    cube = _as_cube(frames)
+    energy = np.mean(np.square(cube[:, step:] - cube[:, :-step]), axis=(-2, -1))
+    energy += np.mean(np.square(cube[..., step:] - cube[..., :-step]), axis=(-2, -1))
+    metric = energy / np.mean(cube, axis=(-2, -1)) ** 2
+    return metric.reshape(np.shape(frames)[:-2])
+
+
+def tenengrad(frames) -> np.ndarray:
+    """
+    Tenengrad of each frame: mean squared magnitude of the Sobel gradient, normalized by the
+    squared mean.
+    """
+    cube = _as_cube(frames)
+    # separable Sobel kernels from slices, so the frames are never smoothed into each other
+    dx = cube[..., 2:] - cube[..., :-2]
+    dy = cube[:, 2:] - cube[:, :-2]
+    gx = dx[:, :-2] + 2 * dx[:, 1:-1] + dx[:, 2:]
+    gy = dy[..., :-2] + 2 * dy[..., 1:-1] + dy[..., 2:]
+    energy = np.mean(gx**2 + gy**2, axis=(-2, -1))
+    metric = energy / np.mean(cube, axis=(-2, -1)) ** 2
+    return metric.reshape(np.shape(frames)[:-2])
+
+
+@lru_cache(maxsize=16)
+def _frequency_weights(ny: int, nx: int, band: tuple[float, float], noise: float):
+    # normalized rfft2 weights averaging the power over the band and over the noise region
+    freq = np.hypot(*np.meshgrid(fft.fftfreq(ny), fft.rfftfreq(nx), indexing="ij"))
+    hermitian = rfft_weights(nx)
+    in_band = ((freq >= band[0]) & (freq <= band[1])) * hermitian
+    in_noise = (freq > noise) * hermitian
+    in_band /= in_band.sum()
+    if in_noise.sum() > 0:
+        in_noise /= in_noise.sum()
+    for weights in (in_band, in_noise):
+        weights.flags.writeable = False
+    return in_band, in_noise
+
+
+def hf_power(frames, band: tuple[float, float] = HF_BAND, noise: float = NOISE_FREQ) -> np.ndarray:
+    """
+    High-frequency OTF power of each frame.
+
+    The mean power spectrum in the `band` of spatial frequencies (in cycles/px), minus the mean
+    power beyond `noise` (past the diffraction cutoff, so only the noise floor), relative to the
+    power at zero frequency. Uses float32 real FFTs, and the frequency masks are cached per frame
+    shape.
+    """
+    cube = _as_cube(frames)
+    spectrum = fft.rfft2(cube, workers=-1)
+    power = spectrum.real**2 + spectrum.imag**2
+    in_band, in_noise = _frequency_weights(*cube.shape[-2:], tuple(band), noise)
+    metric = np.einsum("nij,ij->n", power, in_band) - np.einsum("nij,ij->n", power, in_noise)
+    metric /= power[:, 0, 0]
+    return metric.reshape(np.shape(frames)[:-2])
+
+
+@lru_cache(maxsize=8)
+def _disk_offsets(radius: float):
+    # (dy, dx) offsets of the pixels within `radius` of a center, and their distance
+    size = int(np.ceil(radius))
+    dy, dx = np.mgrid[-size : size + 1, -size : size + 1]
+    dist = np.hypot(dy, dx)
+    mask = dist <= radius
+    offsets = dy[mask], dx[mask], dist[mask]
+    for arr in offsets:
+        arr.flags.writeable = False
+    return offsets
+
+
+def ee_ratio(frames, inner: float = 3, outer: float = 15) -> np.ndarray:
+    """
+    Encircled-energy ratio of each frame: the flux within `inner` px of the peak relative to the
+    flux within `outer` px, after subtracting the median of the frame as background.
+    """
+    cube = _as_cube(frames)
+    n, ny, nx = cube.shape
+    background = np.median(cube.reshape(n, -1), axis=1)
+    peaks = np.argmax(cube.reshape(n, -1), axis=1)
+    py, px = np.unravel_index(peaks, (ny, nx))
+    dy, dx, dist = _disk_offsets(outer)
+    # pixels past the edges are clipped to the edge, which only matters for PSFs at the edge
+    rows = np.clip(py[:, None] + dy, 0, ny - 1)
+    cols = np.clip(px[:, None] + dx, 0, nx - 1)
+    values = cube[np.arange(n)[:, None], rows, cols] - background[:, None]
+    metric = np.sum(values[:, dist <= inner], axis=1) / np.sum(values, axis=1)
+    return metric.reshape(np.shape(frames)[:-2])
+
+
+FOCUS_METRICS: Final[dict[str, Callable]] = {
+    "normvar": normalized_variance,
+    "brenner": brenner,
+    "tenengrad": tenengrad,
+    "hf_power": hf_power,
+    "ee_ratio": ee_ratio,
+}
+
+
+def focus_metric(frames, metric: FocusMetric = "normvar", **kwargs) -> np.ndarray:
+    """
+    Sharpness metric (to maximize) of each frame of a (n, ny, nx) cube, or of a single frame.
+
+    Parameters
+    ----------
+    frames : ArrayLike
+        Calibrated frames, converted to float32
+    metric : {"normvar", "brenner", "tenengrad", "hf_power", "ee_ratio"}
+        Metric name, see `FOCUS_METRICS`. Normalized variance and the gradient metrics are the
+        cheapest, and suit extended scenes like the field stop. The high-frequency power and
+        encircled-energy ratio are more robust for PSFs with a bright background or low
+        signal-to-noise.
+    **kwargs
+        Passed to the metric function
+
+    Returns
+    -------
+    ndarray
+        Metric of each frame, with the leading shape of `frames`
+    """
+    if metric not in FOCUS_METRICS:
+        msg = f"Invalid focus metric {metric!r}, expected one of {', '.join(FOCUS_METRICS)}"
+        raise ValueError(msg)
+    return FOCUS_METRICS[metric](frames, **kwargs)
@@ -0,0 +1,242 @@
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Final
+
+import numpy as np
+
+__all__ = ("FocusSearchResult", "adaptive_focus_search")
+
+# golden ratio conjugate, fraction of a bracket segment for golden-section steps
+GOLDEN: Final[float] = (3 - np.sqrt(5)) / 2
+# number of measurements closest to the optimum used in each parabolic fit, more than three
+# constrain the curvature (measurements near the vertex are only a noise level apart) and leave
+# degrees of freedom to detect where the curve isn't parabolic
+NUM_LOCAL: Final[int] = 5
+# significance of the (negative) curvature needed for a parabolic step, in standard deviations
+MIN_CURVATURE_SNR: Final[float] = 2
+
+
+@dataclass
+class FocusSearchResult:
+    """
+    Outcome of an adaptive focus search.
+
+    Attributes
+    ----------
+    position : float
+        Estimated optimal position
+    uncertainty : float
+        1-sigma uncertainty of the position (half the final bracket if no parabola was fit)
+    value : float
+        Metric at the optimum (fitted, or the best measurement)
+    positions, values, errors : ndarray
+        Every measurement in the order they were made, with the standard error of each mean
+    nmoves : int
+        Number of stage moves
+    nframes : int
+        Number of frames measured
+    wall_time : float
+        Duration of the search, in s
+    converged : bool
+        Whether the uncertainty tolerance was reached within the measurement budget
+    """
+
+    position: float
+    uncertainty: float
+    value: float
+    positions: np.ndarray
+    values: np.ndarray
+    errors: np.ndarray
+    nmoves: int
+    nframes: int
+    wall_time: float
+    converged: bool
+
+    def summary(self) -> str:
+        status = "converged" if self.converged else "did not converge"
+        return (
+            f"focus={self.position:.3f} +- {self.uncertainty:.3f} mm ({status}) after"
+            f" {len(self.positions)} measurements, {self.nmoves} moves, {self.nframes} frames,"
+            f" {self.wall_time:.1f} s"
+        )
+
+
+def _parabola_vertex(x, y, err):
+    """
+    Vertex, its 1-sigma uncertainty, and peak value of a weighted parabola (NaN if the fit is not
+    significantly concave).
+
+    Positive metrics are fit in log space, where focus curves (close to Gaussian or Lorentzian
+    in defocus) stay parabolic much further from the peak. The covariance is scaled up by the
+    reduced chi^2 when there are spare degrees of freedom, so a curve that isn't parabolic over
+    the fitted points widens the uncertainty. The vertex -b / 2a is a ratio of fit coefficients,
+    so its interval comes from Fieller's theorem, which includes the uncertainty of the curvature
+    instead of linearizing around it; the linearized error is far too small when the curvature is
+    barely measured.
+    """
+    log = np.all(y > 0)
+    if log:
+        err = err / y
+        y = np.log(y)
+    # fit around the mean position, the curvature and slope are then nearly uncorrelated
+    x0 = np.mean(x)
+    try:
+        coef, cov = np.polyfit(x - x0, y, 2, w=1 / err, cov="unscaled")
+    except np.linalg.LinAlgError:
+        return np.nan, np.inf, np.nan
+    a, b, c = coef
+    if len(x) > 3:
+        chi2 = np.sum(((np.polyval(coef, x - x0) - y) / err) ** 2) / (len(x) - 3)
+        cov *= max(chi2, 1)
+    var_a, cov_ab, var_b = cov[0, 0], cov[0, 1], cov[1, 1]
+    if a >= -MIN_CURVATURE_SNR * np.sqrt(var_a):
+        return np.nan, np.inf, np.nan
+    vertex = x0 - b / (2 * a)
+    peak = c - b**2 / (4 * a)
+    # Fieller 1-sigma interval of the ratio b / a
+    ratio = b / a
+    g = var_a / a**2
+    spread = var_b - 2 * ratio * cov_ab + ratio**2 * var_a - g * (var_b - cov_ab**2 / var_a)
+    half_width = np.sqrt(max(spread, 0)) / abs(a) / (1 - g)
+    return vertex, float(half_width / 2), np.exp(peak) if log else peak
+
+
+def adaptive_focus_search(
+    move: Callable[[float], None],
+    measure: Callable[[], np.ndarray],
+    start: float,
+    width: float = 1.5,
+    bounds: tuple[float, float] = (0, 23),
+    tol: float = 0.01,
+    max_evals: int = 12,
+) -> FocusSearchResult:
+    """
+    Find the position that maximizes a focus metric with as few measurements as possible.
+
+    First a coarse bracket is made with three points `width / 4` apart around `start`, stepping
+    outwards (growing by the golden ratio) until the best measurement is surrounded by worse ones.
+    The optimum is then refined with successive parabolic steps: a parabola is fit to the
+    `NUM_LOCAL` measurements closest to the current optimum, weighted by the standard error of
+    each metric estimate, and the next measurement is made at its vertex. Golden-section steps
+    are taken instead when the fit is not significantly concave, falls outside of the bracket, or would repeat a
+    measurement. The search stops once the uncertainty of the vertex is below `tol`, combining
+    the fit uncertainty, its change since the previous fit, and its change when the farthest of
+    the fitted measurements is left out.
+
+    Parameters
+    ----------
+    move : Callable
+        Move the stage to a position (blocking)
+    measure : Callable
+        Measure the metric (to maximize) at the current position, returning per-frame values whose
+        mean and standard error are used
+    start : float
+        Current position of the stage and center of the coarse bracket
+    width : float
+        Width of the coarse bracket, by default 1.5
+    bounds : tuple
+        Stage limits, by default (0, 23)
+    tol : float
+        Position tolerance, by default 0.01
+    max_evals : int
+        Maximum number of measurements, by default 12
+
+    Returns
+    -------
+    FocusSearchResult
+    """
+    t0 = time.monotonic()
+    lower, upper = bounds
+    positions, values, errors = [], [], []
+    state = {"position": start, "nmoves": 0, "nframes": 0}
+
+    def evaluate(position):
+        position = float(np.clip(position, lower, upper))
+        if position != state["position"]:
+            move(position)
+            state["position"] = position
+            state["nmoves"] += 1
+        frames = np.asarray(measure(), dtype="f8")
+        frames = frames[np.isfinite(frames)]
+        mean = np.mean(frames) if len(frames) else np.nan
+        err = np.std(frames, ddof=1) / np.sqrt(len(frames)) if len(frames) > 1 else np.nan
+        # floor the error so a quiet (or single-frame) measurement can't dominate the fit
+        err = max(np.nan_to_num(err, nan=0), 1e-6 * abs(np.nan_to_num(mean)), 1e-12)
+        positions.append(position)
+        values.append(np.nan_to_num(mean, nan=-np.inf))
+        errors.append(err)
+        state["nframes"] += len(frames)
+
+    ## Step 1: coarse bracket
+    step = width / 4
+    for position in (start, start - step, start + step):
+        evaluate(position)
+    while len(positions) < max_evals:
+        x = np.array(positions)
+        best = x[np.argmax(values)]
+        if best == x.min() and best > lower:
+            step /= 1 - GOLDEN
+            evaluate(best - step)
+        elif best == x.max() and best < upper:
+            step /= 1 - GOLDEN
+            evaluate(best + step)
+        else:
+            break
+
+    ## Step 2: parabolic refinement
+    converged = False
+    vertex = uncertainty = peak = np.nan
+    while True:
+        x = np.array(positions)
+        y = np.array(values)
+        err = np.array(errors)
+        ib = np.argmax(y)
+        left, right = x[x < x[ib]], x[x > x[ib]]
+        lo = left.max() if len(left) else x[ib]
+        hi = right.min() if len(right) else x[ib]
+        center = x[ib] if not lo < vertex < hi else vertex
+        local = np.argsort(np.abs(x - center))[:NUM_LOCAL]
+        local = local[np.isfinite(y[local])]
+        previous = vertex
+        model_error = 0
+        if len(local) >= 3:
+            vertex, uncertainty, peak = _parabola_vertex(x[local], y[local], err[local])
+        if len(local) > 3:
+            # refitting without the farthest measurement shows how much the vertex depends on
+            # the curve being parabolic over the whole fitted range
+            narrow, _, _ = _parabola_vertex(x[local[:-1]], y[local[:-1]], err[local[:-1]])
+            model_error = np.nan_to_num(vertex - narrow, nan=np.inf)
+        if lo < vertex < hi:
+            # the change since the previous fit also bounds the model error of the parabola
+            change = np.nan_to_num(vertex - previous, nan=np.inf)
+            uncertainty = float(np.sqrt(uncertainty**2 + change**2 + model_error**2))
+            if uncertainty < tol:
+                converged = True
+                break
+        if hi - lo < tol or len(positions) >= max_evals:
+            break
+        if lo < vertex < hi and np.min(np.abs(x - vertex)) >= tol / 2:
+            proposal = vertex
+        else:
+            # golden-section step into the larger side of the bracket
+            if hi - x[ib] > x[ib] - lo:
+                proposal = x[ib] + GOLDEN * (hi - x[ib])
+            else:
+                proposal = x[ib] - GOLDEN * (x[ib] - lo)
+        evaluate(proposal)
+
+    if not lo < vertex < hi:
+        vertex, uncertainty, peak = x[ib], (hi - lo) / 2, y[ib]
+    return FocusSearchResult(
+        position=float(vertex),
+        uncertainty=float(uncertainty),
+        value=float(peak),
+        positions=np.array(positions),
+        values=np.array(values),
+        errors=np.array(errors),
+        nmoves=state["nmoves"],
+        nframes=state["nframes"],
+        wall_time=time.monotonic() - t0,
+        converged=converged,
+    )
@@ -9,6 +9,8 @@ from astropy.nddata import Cutout2D
 from pyMilk.interfacing.isio_shmlib import SHM
 
 from vampires_control.filters import get_filter_info_dict
+from vampires_control.frame_calibration import FrameCalibrator
+from vampires_control.shm_roi import ROIReader
 from vampires_control.synthpsf import generate_pupil_field
 
 from .core_algorithm import ff_iteration
@@ -32,20 +34,31 @@ class FastAndFurious:
     cmd_shm_name: str = "dm00disp07"
 
     def __post_init__(self):
-        self.dark_shm_name = f"{self.shm_name}_dark"
         self.shm = SHM(self.shm_name)
-        self.dark_shm = SHM(self.dark_shm_name)
-        self.dark_frame = self.dark_shm.get_data()
+        # dark from the library for the current camera mode, kept in sync with the dark SHM
+        self.calibrator = FrameCalibrator(self.shm)
+        self.reader = None
         self.dm_shm = SHM(self.dm_shm_name)
         self.dm_cmd_shm = SHM(self.cmd_shm_name)
 
     def take_image(self, nframes=10):
-        frames = self.shm.multi_recv_data(nframes, output_as_cube=True)
-        calib_frames = frames - self.dark_frame
-        mean_frame = np.mean(calib_frames, axis=0)
+        self.calibrator.update()
+        # only read a window around the PSF, with margin for it to move between iterations
+        if self.reader is None:
+            self.reader = ROIReader.around_peak(
+                self.shm, 2 * self.crop_size, calibrator=self.calibrator
+            )
+        window = self.reader.windows["psf"]
+        mean_frame = self.calibrator(self.reader.read(nframes, coadd="mean")["psf"], window)
         # centroid and crop
         max_idx = np.unravel_index(np.argmax(mean_frame), mean_frame.shape)
-        crop_frame = Cutout2D(mean_frame, (max_idx[1], max_idx[0]), self.crop_size)
+        # the window may be clipped by the frame edges, pad the crop to its full size
+        crop_frame = Cutout2D(
+            mean_frame, (max_idx[1], max_idx[0]), self.crop_size, mode="partial", fill_value=0
+        )
+        # recenter the window on the PSF
+        offset = self.reader.offset("psf")
+        self.reader.set_window("psf", np.add(max_idx, offset), 2 * self.crop_size)
         return crop_frame.data
 
     def prepare_fields(self):
@@ -0,0 +1,251 @@
+import logging
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Final
+
+import click
+import numpy as np
+from astropy.io import fits
+from pyMilk.interfacing.isio_shmlib import SHM
+
+from . import paths
+from .helpers import atomic_write, cache_key
+
+__all__ = ("DARK_KEYS", "DEFAULT_BIAS", "DarkLibrary", "FrameCalibrator", "take_dark")
+
+# set up logging
+formatter = logging.Formatter("%(asctime)s|%(name)s|%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger("frame_calibration")
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.INFO)
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+
+# header keys which define a camera mode for darks
+DARK_KEYS: Final[tuple[str, ...]] = (
+    "U_CAMERA",
+    "PRD-MIN1",
+    "PRD-MIN2",
+    "PRD-RNG1",
+    "PRD-RNG2",
+    "U_DETMOD",
+    "EXPTIME",
+)
+# detector offset used when neither a master dark nor the dark SHM is available
+DEFAULT_BIAS: Final[float] = 200
+
+
+def dark_key(header) -> tuple:
+    """Camera mode of a frame from its SHM keywords or FITS header"""
+    key = []
+    for k in DARK_KEYS:
+        value = header[k]
+        if isinstance(value, str):
+            value = value.strip()
+        elif isinstance(value, float | np.floating):
+            value = round(float(value), 6)
+        else:
+            value = int(value)
+        key.append(value)
+    return tuple(key)
+
+
+class DarkLibrary:
+    """
+    Library of master darks indexed by camera mode (see `DARK_KEYS`).
+
+    Each master dark is a FITS file named after a hash of its camera mode, so looking up the dark
+    for a frame never needs a directory scan. Loaded darks are kept in memory as read-only float32
+    arrays.
+    """
+
+    def __init__(self, directory: Path = paths.DARK_DIR):
+        self.directory = Path(directory)
+        self._cache: dict[tuple, np.ndarray] = {}
+
+    def filename(self, key: tuple) -> Path:
+        params = dict(zip(DARK_KEYS, key))
+        return self.directory / f"vcam{params['U_CAMERA']}_dark_{cache_key(**params)}.fits"
+
+    def get(self, header) -> np.ndarray | None:
+        """Master dark for the camera mode of the header, or None if the library has none"""
+        key = dark_key(header)
+        if key not in self._cache:
+            path = self.filename(key)
+            if not path.exists():
+                return None
+            dark = fits.getdata(path).astype("f4")
+            dark.flags.writeable = False
+            self._cache[key] = dark
+        return self._cache[key]
+
+    def add(self, header, dark, nframes: int | None = None) -> Path:
+        """Save a master dark for the camera mode of the header"""
+        key = dark_key(header)
+        path = self.filename(key)
+        hdr = fits.Header()
+        for k, v in zip(DARK_KEYS, key):
+            hdr[k] = v
+        hdr["DATA-TYP"] = "DARK"
+        hdr["DATE"] = datetime.now(timezone.utc).isoformat()
+        if nframes is not None:
+            hdr["NFRAMES"] = nframes
+        dark = np.asarray(dark, dtype="f4")
+        atomic_write(path, lambda tmp: fits.writeto(tmp, dark, header=hdr, overwrite=True))
+        dark = dark.copy()
+        dark.flags.writeable = False
+        self._cache[key] = dark
+        logger.info(f"Saved master dark to {path}")
+        return path
+
+    def add_fits(self, filename) -> Path:
+        """Collapse a dark cube (e.g., from the nightly darks) and add it to the library"""
+        with fits.open(filename) as hdul:
+            header = hdul[0].header
+            cube = hdul[0].data.astype("f4")
+        dark = np.median(cube.reshape(-1, *cube.shape[-2:]), axis=0)
+        return self.add(header, dark, nframes=len(cube))
+
+
+class FrameCalibrator:
+    """
+    Dark, flat, and bad-pixel correction of float32 frames from a camera stream.
+
+    The master dark is looked up in the `DarkLibrary` from the stream keywords whenever the
+    camera mode changes. If the library has no match, the current `{shm}_dark` SHM is used (and
+    a constant `DEFAULT_BIAS` only if that doesn't match the frame shape either). Library darks
+    can optionally be published to the `{shm}_dark` SHM so other tools see the same dark.
+
+    Parameters
+    ----------
+    shm : SHM or str
+        Camera stream (or its name)
+    library : DarkLibrary, optional
+        Dark library, by default the one in `paths.DARK_DIR`
+    flat : ArrayLike, optional
+        Flat field (normalized to unity), matching the frame shape
+    badpix : ArrayLike, optional
+        Boolean bad-pixel mask, matching the frame shape. Bad pixels are replaced by the mean of
+        their good neighbors.
+    update_dark_shm : bool
+        Write library darks to the `{shm}_dark` SHM on mode changes, by default False
+    """
+
+    def __init__(
+        self,
+        shm: SHM | str,
+        library: DarkLibrary | None = None,
+        flat=None,
+        badpix=None,
+        update_dark_shm: bool = False,
+    ):
+        self.shm = SHM(shm) if isinstance(shm, str) else shm
+        self.library = DarkLibrary() if library is None else library
+        self.flat = None if flat is None else np.asarray(flat, dtype="f4")
+        self.badpix = None if badpix is None else np.asarray(badpix, dtype=bool)
+        self.update_dark_shm = update_dark_shm
+        self.dark = None
+        self._key = None
+        self._badpix_cache = {}
+
+    @property
+    def dark_shm_name(self) -> str:
+        return f"{self.shm.FNAME}_dark"
+
+    def update(self, header=None) -> bool:
+        """Reload the dark if the camera mode changed, returns True if it did"""
+        if header is None:
+            header = self.shm.get_keywords()
+        key = dark_key(header)
+        if key == self._key:
+            return False
+        dark = self.library.get(header)
+        if dark is None:
+            logger.warning(f"No master dark for {dict(zip(DARK_KEYS, key))}")
+            dark = self._dark_from_shm()
+        elif self.update_dark_shm:
+            # only library darks are published, never the fallbacks
+            SHM(self.dark_shm_name, (dark.shape, "f4")).set_data(dark)
+        self.dark = dark
+        self._key = key
+        return True
+
+    def _dark_from_shm(self) -> np.ndarray:
+        # the current dark SHM, or a constant bias if it is missing or doesn't match the frames
+        shape = tuple(self.shm.shape[-2:])
+        try:
+            dark = SHM(self.dark_shm_name).get_data().astype("f4")
+        except Exception as e:
+            logger.warning(f"Could not read {self.dark_shm_name}: {e}")
+            dark = None
+        if dark is None or dark.shape[-2:] != shape:
+            logger.warning(f"Using a {DEFAULT_BIAS} adu bias for {self.shm.FNAME}")
+            return np.full(shape, DEFAULT_BIAS, dtype="f4")
+        logger.info(f"Using the dark from {self.dark_shm_name}")
+        dark.flags.writeable = False
+        return dark
+
+    def __call__(self, frames, window=np.s_[:, :]):
+        """
+        Calibrate float32 `frames` (a frame or cube) in place and return them. `window` gives the
+        index slices of the frames in the full detector frame, e.g. from a `ROIReader`.
+        """
+        if self.dark is None:
+            self.update()
+        frames -= self.dark[window]
+        if self.flat is not None:
+            frames /= self.flat[window]
+        if self.badpix is not None:
+            self._fix_badpix(frames, window)
+        return frames
+
+    def _fix_badpix(self, frames, window):
+        bad, neighbors, weights = self._badpix_neighbors(window)
+        if len(bad) == 0:
+            return
+        flat_frames = frames.reshape(-1, frames.shape[-2] * frames.shape[-1])
+        flat_frames[:, bad] = np.einsum("nij,ij->ni", flat_frames[:, neighbors], weights)
+        # reshaping non-contiguous frames makes a copy
+        if not np.shares_memory(flat_frames, frames):
+            frames[...] = flat_frames.reshape(frames.shape)
+
+    def _badpix_neighbors(self, window):
+        # (flat) indices of the bad pixels, and their good 3x3 neighbors with averaging weights
+        cache_id = tuple(sl.indices(n) for sl, n in zip(window, self.badpix.shape))
+        if cache_id not in self._badpix_cache:
+            mask = self.badpix[window]
+            ny, nx = mask.shape
+            ys, xs = np.nonzero(mask)
+            dy, dx = np.mgrid[-1:2, -1:2].reshape(2, -1)
+            nys = np.clip(ys[:, None] + dy, 0, ny - 1)
+            nxs = np.clip(xs[:, None] + dx, 0, nx - 1)
+            good = ~mask[nys, nxs]
+            weights = good / np.maximum(good.sum(axis=1, keepdims=True), 1)
+            self._badpix_cache[cache_id] = (ys * nx + xs, nys * nx + nxs, weights.astype("f4"))
+        return self._badpix_cache[cache_id]
+
+
+def take_dark(data_shm_name: str, n=100, library: DarkLibrary | None = None):
+    """Take a master dark from `n` frames, save it to the library and the `{shm}_dark` SHM"""
+    data_shm = SHM(data_shm_name)
+    data = data_shm.multi_recv_data(n, output_as_cube=True)
+    dark = np.median(data.astype("f4"), axis=0, overwrite_input=True)
+    dark_shm = SHM(f"{data_shm_name}_dark", (data_shm.shape, "f4"))
+    dark_shm.set_data(dark)
+    if library is None:
+        library = DarkLibrary()
+    return library.add(data_shm.get_keywords(), dark, nframes=n)
+
+
+@click.command("vampires_master_dark")
+@click.argument("stream", type=click.Choice(["vcam1", "vcam2"]))
+@click.option("-n", "--num-frames", default=100, type=int, show_default=True)
+def vampires_master_dark(stream: str, num_frames: int):
+    """Take a master dark for the current camera mode and add it to the dark library"""
+    path = take_dark(stream, n=num_frames)
+    click.echo(f"Saved master dark to {path}")
+
+
+if __name__ == "__main__":
+    vampires_master_dark()
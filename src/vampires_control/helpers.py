@@ -1,3 +1,12 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+
 def get_dominant_filter(main_filter, diff_filter):
     # check if Halpha or SII filters are in
     if "HA" in diff_filter.upper():
@@ -23,3 +32,91 @@ def color_to_rgb(color):
     g = int(color[3:5], 16)
     b = int(color[5:7], 16)
     return r, g, b
+
+
+def cache_key(**params) -> str:
+    """Content hash of a set of model parameters, used to address cached files on disk"""
+    normed = {k: round(float(v), 6) if isinstance(v, float) else v for k, v in params.items()}
+    payload = json.dumps(normed, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+
+def atomic_write(outfile: Path, writer) -> None:
+    """Write a file through a temporary file in the same directory and rename it into place, so
+    concurrent readers never see a partially written entry."""
+    outfile.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=outfile.parent, prefix=f".{outfile.name}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        writer(tmpname)
+        Path(tmpname).replace(outfile)
+    except BaseException:
+        Path(tmpname).unlink(missing_ok=True)
+        raise
+
+
+def rfft_weights(nx: int):
+    """Weights of the rfft columns so that weighted sums match sums over the full (Hermitian)
+    frequency plane of an image `nx` pixels wide."""
+    weights = np.full(nx // 2 + 1, 2, dtype="f4")
+    weights[0] = 1
+    if nx % 2 == 0:
+        weights[-1] = 1
+    return weights
+
+
+class RingBuffer:
+    """
+    Fixed-size ring buffer of records, stored column-wise so rolling statistics are cheap.
+
+    Parameters
+    ----------
+    size : int
+        Maximum number of records kept, older records are overwritten
+    columns : Sequence[str]
+        Names of the (float) columns
+    """
+
+    def __init__(self, size: int, columns, dtype="f8"):
+        self.size = int(size)
+        self.columns = tuple(columns)
+        self._data = np.full((len(self.columns), self.size), np.nan, dtype=dtype)
+        self._index = 0
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.size)
+
+    @property
+    def total(self) -> int:
+        """Number of records ever added"""
+        return self._count
+
+    def extend(self, **values):
+        """Append records, given as one array (or scalar) per column"""
+        arrays = np.vstack(np.broadcast_arrays(*(np.atleast_1d(values[c]) for c in self.columns)))
+        n = arrays.shape[1]
+        if n > self.size:
+            arrays = arrays[:, -self.size :]
+            self._index = (self._index + n - self.size) % self.size
+            self._count += n - self.size
+            n = self.size
+        idx = (self._index + np.arange(n)) % self.size
+        self._data[:, idx] = arrays
+        self._index = (self._index + n) % self.size
+        self._count += n
+
+    def column(self, name: str):
+        """Values of a column, oldest first"""
+        row = self._data[self.columns.index(name)]
+        if self._count < self.size:
+            return row[: self._count].copy()
+        return np.roll(row, -self._index)
+
+    def to_dict(self) -> dict:
+        return {c: self.column(c) for c in self.columns}
+
+    def clear(self):
+        self._data[:] = np.nan
+        self._index = 0
+        self._count = 0
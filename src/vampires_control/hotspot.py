@@ -1,14 +1,15 @@
 from datetime import datetime, timezone
-from functools import partial
+from functools import lru_cache, partial
 from pathlib import Path
 from typing import Final, Optional, Sequence
+import logging
 import shutil
 import re
 import os
+import time
 
 import click
 import numpy as np
-import pandas as pd
 import tomli_w
 from pydantic import BaseModel, Field, computed_field
 from pyMilk.interfacing.isio_shmlib import SHM
@@ -18,12 +19,27 @@ from astropy.visualization import simple_norm
 
 from vampires_control import paths
 
-from .centroid import dft_centroid, guess_mbi_centroid
+from .centroid import DFTCentroider, guess_mbi_centroid
+from .coadd import CoaddMethod
+from .crop_optimizer import READOUT_MODELS, optimize_crop
+from .hotspot_store import HotspotStore
+from .shm_roi import ROIReader
+from .strehl import MBI_FIELDS, get_mbi_evaluator, mbi_field_slices
 from .synthpsf import create_synth_psf
 
+# daily CSV files from previous versions, see `HotspotStore.import_csv`
 DEFAULT_CSV_STORE: Final[Path] = paths.CONF_DIR / "hotspots"
 DEFAULT_CONFIG_STORE: Final[Path] = paths.CROPS_DIR
 
+# set up logging
+formatter = logging.Formatter("%(asctime)s|%(name)s|%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger("hotspot")
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.INFO)
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+
 
 class HotspotInfo(BaseModel):
     timestamp: datetime = Field(default_factory=partial(datetime.now, timezone.utc))
@@ -77,27 +93,49 @@ class HotspotInfo(BaseModel):
         return np.rad2deg(np.arctan2(self.delta_y, self.delta_x))
 
 
-def save_hotspots_to_db(hotspots: Sequence[HotspotInfo], save_dir: Path = DEFAULT_CSV_STORE):
+def save_hotspots_to_db(hotspots: Sequence[HotspotInfo], store: HotspotStore | None = None):
     """Save hostpot info to persistent data store"""
-    save_dir.mkdir(exist_ok=True)
-    date = hotspots[0].timestamp.strftime("%Y%m%d")
-    save_path = save_dir / f"{date}_{hotspots[0].cam}_hotspots.csv"
-    rows = [hs.model_dump() for hs in hotspots]
-    df = pd.DataFrame(rows)
-    df.index = df.pop("timestamp")
-    if save_path.exists():
-        df.to_csv(save_path, mode="a", header=False)
-    else:
-        df.to_csv(save_path)
+    if store is None:
+        store = HotspotStore()
+    store.add(hotspots)
+
+
+def time_to_crop_exit(hotspot: HotspotInfo, rate_x: float, rate_y: float, min_margin=20) -> float:
+    """
+    Hours until a PSF drifting at (`rate_x`, `rate_y`) px/hr comes within `min_margin` px of the
+    edge of its crop: zero if it already is, inf if it is not drifting towards any edge.
+    """
+    margins = np.array(
+        (
+            hotspot.absx - hotspot.cropx,
+            hotspot.cropx + hotspot.sizex - 1 - hotspot.absx,
+            hotspot.absy - hotspot.cropy,
+            hotspot.cropy + hotspot.sizey - 1 - hotspot.absy,
+        )
+    )
+    margins -= min_margin
+    if np.any(margins <= 0):
+        return 0.0
+    # drift rate towards each edge
+    rates = np.array((-rate_x, rate_x, -rate_y, rate_y))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        hours = np.where(rates > 0, margins / rates, np.inf)
+    return float(np.min(hours))
+
+
+@lru_cache(maxsize=8)
+def get_hotspot_centroider(filt: str, window: int = 20) -> DFTCentroider:
+    """Centroider against the synthetic PSF of a filter, shared between fits"""
+    psf = create_synth_psf(filt, 30, pixel_scale=5.9)
+    return DFTCentroider(psf, window=window)
 
 
 def fit_hotspots_standard(frame, shm: SHM, plot: bool=False) -> HotspotInfo:
     shm_kwds = shm.get_keywords()
     curfilt = shm_kwds["FILTER01"].strip()
-    psf = create_synth_psf(curfilt, 30, pixel_scale=5.9)
-    # psf = create_synth_psf(curfilt)
     ctr_guess = np.unravel_index(np.nanargmax(frame), frame.shape)
-    centroid = dft_centroid(frame, psf, ctr_guess)
+    centroids, _ = get_hotspot_centroider(curfilt)(frame, ctr_guess)
+    centroid = centroids[0]
     if plot:
         fig, ax = _plot_centroid(frame, ctr_guess, centroid)
         ax.set_title(f"{shm.FNAME}")
@@ -136,14 +174,14 @@ def fit_hotspots_mbi(frame, shm: SHM, plot: bool=False) -> dict[str, HotspotInfo
     shm_kwds = shm.get_keywords()
     cam = shm_kwds["U_CAMERA"]
     hotspots = {}
-    fields = ("F610", "F670", "F720", "F760")
+    fields = MBI_FIELDS
     psfs = {f: create_synth_psf(f, 20, pixel_scale=5.9) for f in fields}
+    # centroid all fields together
+    centroids = get_mbi_evaluator(cam).centroids(frame, psfs)
     for field in fields:
-        create_synth_psf(field)
-        ctr = guess_mbi_centroid(frame, field=field, camera=cam)
-        # centroid = cross_correlation_centroid(frame, psf, ctr)
-        centroid = dft_centroid(frame, psfs[field], ctr)
+        centroid = centroids[field]
         if plot:
+            ctr = guess_mbi_centroid(frame, field=field, camera=cam)
             _, ax = _plot_centroid(frame, ctr, centroid)
             ax.set_title(f"{shm.FNAME} - {field}")
         hotspot = HotspotInfo(
@@ -222,74 +260,178 @@ def save_configs_to_db(
     return save_path, save_path_reduced
 
 
-def generate_standard_crop_config(hotspot: HotspotInfo) -> CameraMode:
-    """Generate config file for MBI crops in camstack"""
-    ## Step 2: determine padding required to fit fieldstop (536 px, nominally)
-    size = 536
-    pad_size = size / 2
-    min_x = hotspot.absx - pad_size
-    min_y = hotspot.absy - pad_size
-    ## Step 3: round origin point (down) to nearest multiple of 4, which is
-    # required for the orcaquests
-    min_x_rounded = np.floor(min_x / 4) * 4
-    min_y_rounded = np.floor(min_y / 4) * 4
-
-    ## Step 4: assemble config object
-    # note: hard-coded width of 536
-    config = CameraMode(
-        x0=min_x_rounded,
-        y0=min_y_rounded,
-        x1=min_x_rounded + size - 1,
-        y1=min_y_rounded + size - 1,
-        tint=1e-3,
-    )
-    return config
+def generate_standard_crop_config(hotspot: HotspotInfo, readout: str = "FAST") -> CameraMode:
+    """Generate config file for standard crops in camstack"""
+    # the field stop window (536 px, nominally) around the PSF, at the highest frame rate
+    tint = 1e-3
+    crop = optimize_crop((hotspot.absy, hotspot.absx), model=READOUT_MODELS[readout], tint=tint)
+    # the frame rate is left to the camera, the readout model is only an estimate
+    logger.info(f"Predicted frame rate of the standard crop: {crop.pop('fps'):.1f} Hz")
+    return CameraMode(**crop, tint=tint)
 
 
-def _generate_mbi_crop(hotspots: dict[str, HotspotInfo]) -> CameraMode:
+def _generate_mbi_crop(hotspots: dict[str, HotspotInfo], readout: str = "FAST") -> CameraMode:
     """Generate config file for MBI crops in camstack"""
-    ## Step 1: get minimum, maximum psf centers
-    hotspot_values = hotspots.values()
-    min_cx = min(h.absx for h in hotspot_values)
-    max_cx = max(h.absx for h in hotspot_values)
-    min_cy = min(h.absy for h in hotspot_values)
-    max_cy = max(h.absy for h in hotspot_values)
     # TODO do some sanity checks here
-    ## Step 2: determine padding required to fit fieldstop (536 px, nominally)
-    pad_size = 536 / 2
-    min_x = min_cx - pad_size
-    max_x = max_cx + pad_size
-    min_y = min_cy - pad_size
-    max_y = max_cy + pad_size
-    ## Step 3: round origin point (down) to nearest multiple of 4, which is
-    # required for the orcaquests
-    min_x_rounded = np.floor(min_x / 4) * 4
-    min_y_rounded = np.floor(min_y / 4) * 4
-    ## Step 4: determine upper bound by finding ncols,nrows that
-    # are closest multiple of 4 (rounding up)
-    range_x_rounded = np.ceil((max_x - min_x_rounded) / 4) * 4
-    range_y_rounded = np.ceil((max_y - min_y_rounded) / 4) * 4
-    ## Step 5: assemble config object
+    # the field stop windows (536 px, nominally) around all PSFs, at the highest frame rate
+    tint = 1e-3
+    centers = [(h.absy, h.absx) for h in hotspots.values()]
+    crop = optimize_crop(centers, model=READOUT_MODELS[readout], tint=tint)
+    # the frame rate is left to the camera, the readout model is only an estimate
+    logger.info(f"Predicted frame rate of the MBI crop: {crop.pop('fps'):.1f} Hz")
     spots = {f: (h.absx, h.absy) for f, h in hotspots.items()}
-    mode = CameraMode(
-        x0=min_x_rounded,
-        y0=min_y_rounded,
-        x1=min_x_rounded + range_x_rounded - 1,
-        y1=min_y_rounded + range_y_rounded - 1,
-        hotspots=spots,
-        tint=1e-3,
-    )
-    return mode
+    return CameraMode(**crop, hotspots=spots, tint=tint)
 
 
-def generate_mbi_crops(hotspots: dict[str, HotspotInfo]) -> dict[str, CameraMode]:
-    mbi_mode = _generate_mbi_crop(hotspots)
+def generate_mbi_crops(
+    hotspots: dict[str, HotspotInfo], readout: str = "FAST"
+) -> dict[str, CameraMode]:
+    mbi_mode = _generate_mbi_crop(hotspots, readout=readout)
     # run again without F610 key
     del hotspots["F610"]
-    mbir_mode = _generate_mbi_crop(hotspots)
+    mbir_mode = _generate_mbi_crop(hotspots, readout=readout)
     return {"MBI": mbi_mode, "MBIR": mbir_mode}
 
 
+def mbi_enabled() -> bool:
+    return redis.RDB.hget("U_MBI", "value").lower() == "dichroics"
+
+
+class HotspotTracker:
+    """
+    Periodic hotspot fits from a VCAM stream, appended to a `HotspotStore`.
+
+    The SHM handle, field windows, PSF models, and centroiding kernels are kept between fits, so
+    each fit only costs reading `num_frames` frames. After every fit, the drift rate of each PSF
+    over the last `rate_window` seconds is extrapolated to warn when it would come within
+    `min_margin` px of the edge of the current crop within `horizon` hours.
+
+    Parameters
+    ----------
+    shm_name : str
+        Camera stream
+    num_frames : int
+        Frames coadded for each fit, by default 10
+    coadd : str
+        Streaming coadd method, see `get_coadder`, by default "median"
+    cadence : float
+        Time between fits in seconds, by default 300
+    store : HotspotStore, optional
+        Hotspot database, by default the one in `paths.DATA_DIR`
+    min_margin : float
+        Minimum distance from the PSFs to the crop edges in px, by default 20
+    horizon : float
+        Alert when the PSFs would reach `min_margin` within this many hours, by default 1
+    rate_window : float
+        Time range used for the drift rates in seconds, by default 7200
+    """
+
+    def __init__(
+        self,
+        shm_name: str,
+        num_frames: int = 10,
+        coadd: CoaddMethod = "median",
+        cadence: float = 300,
+        store: HotspotStore | None = None,
+        min_margin: float = 20,
+        horizon: float = 1,
+        rate_window: float = 7200,
+    ):
+        self.shm_name = shm_name
+        self.shm = SHM(shm_name)
+        self.reader = ROIReader(self.shm)
+        self.num_frames = num_frames
+        self.coadd = coadd
+        self.cadence = cadence
+        self.store = HotspotStore() if store is None else store
+        self.min_margin = min_margin
+        self.horizon = horizon
+        self.rate_window = rate_window
+        self.mbi = None
+
+    def update_mode(self):
+        """
+        Reopen the stream if the camera mode or crop changed, and read only the MBI field
+        windows in MBI mode, and full frames otherwise
+        """
+        if self.reader.reopen():
+            logger.info(f"{self.shm_name} changed shape or mode, reopened the stream")
+            self.shm = self.reader.shm
+            self.mbi = None
+        mbi = mbi_enabled()
+        if mbi == self.mbi:
+            return
+        if mbi:
+            cam = self.shm.get_keywords()["U_CAMERA"]
+            self.reader.windows = {
+                f: mbi_field_slices(self.reader.shape, cam, f) for f in MBI_FIELDS
+            }
+        else:
+            self.reader.windows = {"frame": np.s_[:, :]}
+        self.mbi = mbi
+
+    def fit(self) -> list[HotspotInfo]:
+        self.update_mode()
+        frame = self.reader.read_frame(self.num_frames, coadd=self.coadd)
+        if self.mbi:
+            return list(fit_hotspots_mbi(frame, self.shm).values())
+        return [fit_hotspots_standard(frame, self.shm)]
+
+    def check_crop(self, hotspot: HotspotInfo) -> dict:
+        """Drift rate (px/hr) of a PSF and the hours until it reaches the crop margin"""
+        rate_x, rate_y = self.store.drift_rate(
+            hotspot.cam, hotspot.field, window=self.rate_window, now=hotspot.timestamp
+        )
+        hours = time_to_crop_exit(hotspot, rate_x, rate_y, min_margin=self.min_margin)
+        return {
+            "absx": hotspot.absx,
+            "absy": hotspot.absy,
+            "rate_x": float(rate_x),
+            "rate_y": float(rate_y),
+            "hours_to_exit": hours,
+            "alert": hours < self.horizon,
+        }
+
+    def publish(self, checks: dict[str, dict]):
+        for field, check in checks.items():
+            logger.info(
+                "%s %s: x=%.2f y=%.2f drift=(%.2f, %.2f) px/hr",
+                self.shm_name,
+                field,
+                check["absx"],
+                check["absy"],
+                check["rate_x"],
+                check["rate_y"],
+            )
+            if check["alert"]:
+                logger.warning(
+                    "%s %s: PSF will be within %d px of the crop edge in %.1f hr, re-run "
+                    "`vampires_hotspot` to update the crop",
+                    self.shm_name,
+                    field,
+                    self.min_margin,
+                    check["hours_to_exit"],
+                )
+
+    def step(self) -> dict[str, dict]:
+        hotspots = self.fit()
+        self.store.add(hotspots)
+        checks = {hs.field: self.check_crop(hs) for hs in hotspots}
+        self.publish(checks)
+        return checks
+
+    def run(self, duration: float | None = None):
+        start = time.monotonic()
+        while duration is None or time.monotonic() - start < duration:
+            t0 = time.monotonic()
+            try:
+                self.step()
+            except Exception:
+                # e.g., while the camera stream is being recreated, try again next time
+                logger.exception(f"Hotspot fit of {self.shm_name} failed")
+            time.sleep(max(self.cadence - (time.monotonic() - t0), 0))
+
+
 def _backup_and_copy_hotspots(filename: Path, target: str):
     _root = Path("/home/scexao/src/camstack/")
     target_path = _root / "conf" / "modes" / "vampires" / target
@@ -304,13 +446,24 @@ def _backup_and_copy_hotspots(filename: Path, target: str):
 @click.argument("shm_name")
 @click.option("-n", "--num-frames", default=10, type=int)
 @click.option(
-    "-r", "--report", is_flag=True, help=f"Save crop configs to CSV file in {DEFAULT_CSV_STORE}"
+    "-k",
+    "--coadd",
+    default="median",
+    type=click.Choice(["median", "mean", "clipped"]),
+    help="Streaming coadd of the frames (median is approximate beyond 11 frames)",
+    show_default=True,
+)
+@click.option(
+    "-r",
+    "--report",
+    is_flag=True,
+    help=f"Save crop configs to TOML files in {DEFAULT_CONFIG_STORE}",
 )
 @click.option(
     "-s/-ns",
     "--save/--no-save",
     default=True,
-    help=f"Save hotspots to CSV file in {DEFAULT_CSV_STORE}",
+    help="Save hotspots to the hotspot database",
 )
 @click.option(
     "-p/-np",
@@ -318,26 +471,44 @@ def _backup_and_copy_hotspots(filename: Path, target: str):
     default=True,
     help=f"Plot centroids",
 )
+@click.option(
+    "--readout",
+    default="FAST",
+    type=click.Choice(["FAST", "SLOW"], case_sensitive=False),
+    help="Readout mode used to predict the frame rate of the crops",
+    show_default=True,
+)
 @click.option(
     "-c/-nc",
     "--copy/--no-copy",
     default=False,
     help="If true, copy crop file over to camstack (requires `--report`)"
 )
-def hotspot(shm_name: str, num_frames=10, save: bool = True, report: bool = False, plot: bool=True, copy: bool=False):
+def hotspot(
+    shm_name: str,
+    num_frames=10,
+    coadd: str = "median",
+    save: bool = True,
+    report: bool = False,
+    plot: bool = True,
+    readout: str = "FAST",
+    copy: bool = False,
+):
     if copy and not report:
         msg = "Cannot copy report over without generating report, pass `--report`"
         raise ValueError(msg)
     if copy and not os.environ.get("WHICHCOMP", "") == "5":
         msg = "Cannot copy report to camstack unless running on scexao5"
     shm = SHM(shm_name)
-    data = shm.multi_recv_data(num_frames, output_as_cube=True)
-    frame = np.median(data.astype("f4"), axis=0, overwrite_input=True)
-    mbi_status = redis.RDB.hget("U_MBI", "value")
-    if mbi_status.lower() == "dichroics":
+    reader = ROIReader(shm)
+    if mbi_enabled():
+        # only read the MBI field windows
+        cam = shm.get_keywords()["U_CAMERA"]
+        reader.windows = {f: mbi_field_slices(reader.shape, cam, f) for f in MBI_FIELDS}
+        frame = reader.read_frame(num_frames, coadd=coadd)
         hotspots = fit_hotspots_mbi(frame, shm, plot=plot)
         if report:
-            crops = generate_mbi_crops(hotspots)
+            crops = generate_mbi_crops(hotspots, readout=readout.upper())
             fname, fname_red = save_configs_to_db(crops["MBI"], crops["MBIR"], cam_name=shm_name.lower())
             if copy:
                 target = re.sub(r".*vcam", "vcam", fname.name)
@@ -347,9 +518,10 @@ def hotspot(shm_name: str, num_frames=10, save: bool = True, report: bool = Fals
                 print("Finished copying crop configs over, restart cameras to check")
         hotspot_values = list(hotspots.values())
     else:
+        frame = reader.read_frame(num_frames, coadd=coadd)
         hotspots = fit_hotspots_standard(frame, shm, plot=plot)
         if report:
-            report = generate_standard_crop_config(hotspots)
+            report = generate_standard_crop_config(hotspots, readout=readout.upper())
         hotspot_values = (hotspots,)
 
     if save:
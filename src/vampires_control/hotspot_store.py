@@ -0,0 +1,289 @@
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Final
+
+import click
+import numpy as np
+
+from . import paths
+
+__all__ = ("HotspotStore", "night_label")
+
+DEFAULT_DB: Final[Path] = paths.DATA_DIR / "hotspots.sqlite"
+# nights are labeled by the HST date of the evening they start on
+_NIGHT_OFFSET: Final = timedelta(hours=-10 - 12)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hotspots (
+    time REAL NOT NULL,
+    cam TEXT NOT NULL,
+    field TEXT NOT NULL,
+    cx REAL,
+    cy REAL,
+    cropx INTEGER,
+    cropy INTEGER,
+    sizex INTEGER,
+    sizey INTEGER,
+    absx REAL,
+    absy REAL
+);
+CREATE INDEX IF NOT EXISTS hotspots_cam_field_time ON hotspots (cam, field, time);
+"""
+COLUMNS: Final[tuple[str, ...]] = (
+    "time",
+    "cam",
+    "field",
+    "cx",
+    "cy",
+    "cropx",
+    "cropy",
+    "sizex",
+    "sizey",
+    "absx",
+    "absy",
+)
+_DTYPE: Final = np.dtype(
+    [
+        ("time", "f8"),
+        ("cam", "U8"),
+        ("field", "U8"),
+        ("cx", "f8"),
+        ("cy", "f8"),
+        ("cropx", "i4"),
+        ("cropy", "i4"),
+        ("sizex", "i4"),
+        ("sizey", "i4"),
+        ("absx", "f8"),
+        ("absy", "f8"),
+    ]
+)
+_NIGHT_DTYPE: Final = np.dtype(
+    [
+        ("night", "U10"),
+        ("field", "U8"),
+        ("n", "i4"),
+        ("start", "f8"),
+        ("end", "f8"),
+        ("absx", "f8"),
+        ("absy", "f8"),
+        ("rate_x", "f8"),
+        ("rate_y", "f8"),
+        ("shift_x", "f8"),
+        ("shift_y", "f8"),
+    ]
+)
+
+
+def _timestamp(value) -> float | None:
+    if value is None or isinstance(value, int | float):
+        return value
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def night_label(timestamps) -> np.ndarray:
+    """HST date of the start of the night for unix timestamps, e.g. "2024-05-01" """
+    times = np.asarray(timestamps, dtype="f8")
+    shifted = (times + _NIGHT_OFFSET.total_seconds()).astype("datetime64[s]")
+    return shifted.astype("datetime64[D]").astype(str)
+
+
+def _drift_rate(times, values) -> float:
+    # least-squares slope in px/hr
+    if len(times) < 2 or np.ptp(times) == 0:
+        return np.nan
+    return np.polyfit((times - times[0]) / 3600, values, 1)[0]
+
+
+class HotspotStore:
+    """
+    Time-indexed store of hotspot (PSF) positions in sqlite.
+
+    Rows are indexed by (cam, field, time), so the history of one PSF over any range of nights is
+    a single index scan. Queries return numpy structured arrays sorted by time, which convert
+    directly into a `pandas.DataFrame` if needed.
+
+    Parameters
+    ----------
+    path : Path
+        Database file, created if needed, by default `hotspots.sqlite` in `paths.DATA_DIR`
+    """
+
+    def __init__(self, path: Path = DEFAULT_DB):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            # allow reading while the daemon writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def add(self, hotspots) -> int:
+        """Append a sequence of `HotspotInfo` and return the number of rows written"""
+        rows = [
+            (
+                _timestamp(hs.timestamp),
+                hs.cam,
+                hs.field,
+                hs.cx,
+                hs.cy,
+                hs.cropx,
+                hs.cropy,
+                hs.sizex,
+                hs.sizey,
+                hs.absx,
+                hs.absy,
+            )
+            for hs in hotspots
+        ]
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(f"INSERT INTO hotspots VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+        return len(rows)
+
+    def query(self, cam=None, field=None, start=None, end=None) -> np.ndarray:
+        """
+        Hotspots of a camera and field (by default all) between `start` and `end` (datetimes or
+        unix times, by default unbounded), sorted by time.
+        """
+        clauses = []
+        params = []
+        for column, op, value in (
+            ("cam", "=", cam),
+            ("field", "=", field),
+            ("time", ">=", _timestamp(start)),
+            ("time", "<", _timestamp(end)),
+        ):
+            if value is not None:
+                clauses.append(f"{column} {op} ?")
+                params.append(value)
+        sql = f"SELECT {', '.join(COLUMNS)} FROM hotspots"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY time"
+        with closing(self._connect()) as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return np.array(rows, dtype=_DTYPE)
+
+    def fields(self, cam: str) -> list[str]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT DISTINCT field FROM hotspots WHERE cam = ? ORDER BY field", (cam,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def drift(self, cam: str, field: str, start=None, end=None) -> dict[str, np.ndarray]:
+        """
+        Detector position of a PSF relative to its first measurement in the range.
+
+        Returns
+        -------
+        dict
+            "time", "dx", and "dy" arrays (px)
+        """
+        rows = self.query(cam, field, start, end)
+        if len(rows) == 0:
+            return {"time": rows["time"], "dx": rows["absx"], "dy": rows["absy"]}
+        return {
+            "time": rows["time"],
+            "dx": rows["absx"] - rows["absx"][0],
+            "dy": rows["absy"] - rows["absy"][0],
+        }
+
+    def drift_rate(self, cam: str, field: str, window: float = 7200, now=None):
+        """
+        Linear drift rate (x, y) in px/hr of a PSF over the last `window` seconds, NaN without at
+        least two measurements.
+        """
+        now = datetime.now(timezone.utc).timestamp() if now is None else _timestamp(now)
+        rows = self.query(cam, field, start=now - window, end=now + 1)
+        return _drift_rate(rows["time"], rows["absx"]), _drift_rate(rows["time"], rows["absy"])
+
+    def nightly_drift(self, cam: str, field=None, start=None, end=None) -> np.ndarray:
+        """
+        Per-night summary of the PSF positions of a camera (and field, by default all).
+
+        For each night and field: number of measurements, first and last time, median detector
+        position, linear drift rate within the night (px/hr), and shift of the median position
+        since the previous night in the range.
+        """
+        rows = self.query(cam, field, start, end)
+        nights = night_label(rows["time"])
+        summary = []
+        for fld in np.unique(rows["field"]):
+            mask = rows["field"] == fld
+            last = None
+            for night in np.unique(nights[mask]):
+                sel = rows[mask & (nights == night)]
+                pos = np.array((np.median(sel["absx"]), np.median(sel["absy"])))
+                shift = pos - last if last is not None else (np.nan, np.nan)
+                summary.append(
+                    (
+                        night,
+                        fld,
+                        len(sel),
+                        sel["time"][0],
+                        sel["time"][-1],
+                        *pos,
+                        _drift_rate(sel["time"], sel["absx"]),
+                        _drift_rate(sel["time"], sel["absy"]),
+                        *shift,
+                    )
+                )
+                last = pos
+        return np.sort(np.array(summary, dtype=_NIGHT_DTYPE), order=("night", "field"))
+
+    def import_csv(self, directory: Path) -> int:
+        """Import the daily CSV files written by previous versions of `save_hotspots_to_db`"""
+        from .hotspot import HotspotInfo
+
+        count = 0
+        for filename in sorted(Path(directory).glob("*_hotspots.csv")):
+            data = np.genfromtxt(filename, delimiter=",", names=True, dtype=None, encoding="utf-8")
+            hotspots = [
+                HotspotInfo(
+                    timestamp=datetime.fromisoformat(row["timestamp"]),
+                    cam=row["cam"],
+                    field=row["field"],
+                    cx=row["cx"],
+                    cy=row["cy"],
+                    cropx=row["cropx"],
+                    cropy=row["cropy"],
+                    sizex=row["sizex"],
+                    sizey=row["sizey"],
+                )
+                for row in np.atleast_1d(data)
+            ]
+            count += self.add(hotspots)
+        return count
+
+
+@click.command("vampires_hotspot_drift")
+@click.argument("cam", type=click.Choice(["vcam1", "vcam2"]))
+@click.option("-f", "--field", help="Field (filter) to show, by default all")
+@click.option("-n", "--nights", default=7, type=int, help="Number of nights", show_default=True)
+def vampires_hotspot_drift(cam: str, field: str | None, nights: int):
+    """Print the nightly hotspot positions and drifts of a camera"""
+    start = datetime.now(timezone.utc) - timedelta(days=nights)
+    summary = HotspotStore().nightly_drift(cam, field=field, start=start)
+    if len(summary) == 0:
+        click.echo(f"No hotspots for {cam} in the last {nights} nights")
+        return
+    click.echo(
+        f"{'night':>10s} {'field':>6s} {'n':>4s} {'x':>8s} {'y':>8s} {'dx/dt':>7s} {'dy/dt':>7s}"
+        f" {'shift x':>8s} {'shift y':>8s}"
+    )
+    for row in summary:
+        click.echo(
+            f"{row['night']:>10s} {row['field']:>6s} {row['n']:4d} {row['absx']:8.2f}"
+            f" {row['absy']:8.2f} {row['rate_x']:7.2f} {row['rate_y']:7.2f}"
+            f" {row['shift_x']:8.2f} {row['shift_y']:8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    vampires_hotspot_drift()
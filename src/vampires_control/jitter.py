@@ -0,0 +1,371 @@
+import json
+import logging
+import threading
+import time
+import warnings
+from collections import deque
+from pathlib import Path
+from typing import Final
+
+import click
+import numpy as np
+from pyMilk.interfacing.isio_shmlib import SHM
+from scipy import ndimage, signal
+from swmain.redis import RDB
+
+from . import paths
+from .centroid import DFTCentroider, center_of_mass
+from .helpers import RingBuffer, atomic_write
+from .shm_roi import ROIReader
+
+__all__ = ("JitterAnalyzer", "jitter_redis_key", "vibration_peaks")
+
+# set up logging
+formatter = logging.Formatter("%(asctime)s|%(name)s|%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger("jitter")
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.INFO)
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+
+
+def jitter_redis_key(stream: str) -> str:
+    """Redis hash where the jitter analyzer publishes summaries for the given stream"""
+    return f"U_JITTER{stream[-1]}"
+
+
+def vibration_peaks(freqs, psd, npeaks: int = 5, contrast: float = 5) -> list[dict]:
+    """
+    Strongest narrow peaks of a power spectral density.
+
+    Peaks must stand `contrast` times above the running median of the spectrum. Their rms
+    amplitude is integrated over the three bins of the (Hann) window main lobe.
+
+    Returns
+    -------
+    list[dict]
+        "freq" and "rms" (in the square root of the PSD units times Hz) of each peak, strongest
+        first
+    """
+    freqs = np.asarray(freqs)
+    psd = np.asarray(psd)
+    if len(psd) < 5:
+        return []
+    df = freqs[1] - freqs[0]
+    baseline = ndimage.median_filter(psd, size=9, mode="nearest")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.nan_to_num(psd / baseline)
+    indices, _ = signal.find_peaks(ratio, height=contrast)
+    # endpoints are never peaks, so the main lobe is always inside the spectrum
+    power = (psd[indices - 1] + psd[indices] + psd[indices + 1]) * df
+    order = np.argsort(power)[::-1][:npeaks]
+    return [{"freq": float(freqs[indices[i]]), "rms": float(np.sqrt(power[i]))} for i in order]
+
+
+class JitterAnalyzer:
+    """
+    Tip/tilt jitter and vibration analysis from a VCAM stream.
+
+    Only a `2 * window` box around the PSF is read from each frame (see `ROIReader`). Frames are
+    read in contiguous batches of `batch`, centroided by center of mass and refined by
+    cross-correlation with a template built from the mean PSF (`DFTCentroider`), and kept in a
+    `RingBuffer` of `buffer_size` records. Every `summary_interval` seconds the y and x Welch
+    spectra are computed over the complete batches in the buffer (frames are dropped between
+    batches while they are processed, so segments never straddle batches) and summarized into the
+    rms jitter and the dominant vibration peaks. Summaries are published to redis (see
+    `jitter_redis_key`) and appended to an npz history file.
+
+    Parameters
+    ----------
+    shm_name : str
+        Camera stream
+    window : int
+        Centroid window size in pixels, by default 20
+    batch : int
+        Frames per contiguous batch, by default 1024
+    buffer_size : int
+        Number of centroids kept for the spectra, by default 16384
+    nperseg : int
+        Welch segment length, which sets the frequency resolution, by default 256
+    npeaks : int
+        Number of vibration peaks reported, by default 5
+    pxscale : float
+        Pixel scale in mas/px, by default 5.9
+    summary_interval : float
+        Time between summaries in seconds, by default 5
+    history_size : int
+        Number of summaries kept in the history file, by default 720
+    history_file : Path, optional
+        History file, by default `{stream}_jitter.npz` in `paths.JITTER_DIR`
+    """
+
+    COLUMNS: Final[tuple[str, ...]] = ("time", "batch", "cy", "cx", "flux")
+    HISTORY_COLUMNS: Final[tuple[str, ...]] = (
+        "time",
+        "fs",
+        "rms",
+        "rms_x",
+        "rms_y",
+        "cx",
+        "cy",
+        "flux",
+    )
+    # fraction of the template flux below which the PSF is considered lost
+    MIN_FLUX_RATIO: Final[float] = 0.2
+
+    def __init__(
+        self,
+        shm_name: str,
+        window: int = 20,
+        batch: int = 1024,
+        buffer_size: int = 16384,
+        nperseg: int = 256,
+        npeaks: int = 5,
+        pxscale: float = 5.9,
+        summary_interval: float = 5.0,
+        history_size: int = 720,
+        history_file: Path | None = None,
+    ):
+        self.shm_name = shm_name
+        self.shm = SHM(shm_name)
+        self.window = window
+        self.batch = batch
+        self.nperseg = min(nperseg, batch)
+        self.npeaks = npeaks
+        self.pxscale = pxscale
+        self.summary_interval = summary_interval
+        self.buffer = RingBuffer(buffer_size, self.COLUMNS)
+        self.history = RingBuffer(history_size, self.HISTORY_COLUMNS)
+        self.psd_history = deque(maxlen=history_size)
+        self.freqs = None
+        self.last_psd = None
+        if history_file is None:
+            history_file = paths.JITTER_DIR / f"{shm_name}_jitter.npz"
+        self.history_file = Path(history_file)
+        self.redis_key = jitter_redis_key(shm_name)
+        self.reader = None
+        self.centroider = None
+        self.template_flux = None
+        self._batch_index = 0
+
+    def acquire(self):
+        """Center the read window on the PSF peak and build the template from one batch"""
+        self.reader = ROIReader.around_peak(self.shm, 2 * self.window, name="psf")
+        cube = self.reader.read(self.batch)["psf"]
+        cube -= np.median(cube.reshape(len(cube), -1), axis=-1)[:, None, None]
+        mean_frame = cube.mean(axis=0)
+        self.centroider = DFTCentroider(
+            mean_frame, self.window, center=center_of_mass(mean_frame)[0]
+        )
+        self.template_flux = mean_frame.sum()
+        # spectra only make sense over a single lock
+        self.buffer.clear()
+        logger.info(f"{self.shm_name}: locked on PSF at {self.reader.windows['psf']}")
+
+    def read(self):
+        """Read the PSF window of the next batch of frames and their arrival times"""
+        cube = self.reader.read(self.batch)["psf"]
+        return cube, self.reader.times.copy()
+
+    def process(self, cube, times) -> dict[str, np.ndarray]:
+        """Centroid every frame of the batch (in full-frame pixels) and buffer the results"""
+        cube -= np.median(cube.reshape(len(cube), -1), axis=-1)[:, None, None]
+        centers, _ = self.centroider(cube, center_of_mass(cube))
+        centers += self.reader.offset("psf")
+        flux = cube.sum(axis=(-2, -1))
+        results = {"cy": centers[:, 0], "cx": centers[:, 1], "flux": flux}
+        self.buffer.extend(time=times, batch=self._batch_index, **results)
+        self._batch_index += 1
+        self._track(centers, flux)
+        return results
+
+    def _track(self, centers, flux):
+        # follow slow drifts with the read window, and re-acquire if the PSF was lost
+        if np.median(flux) < self.MIN_FLUX_RATIO * self.template_flux:
+            logger.warning(f"{self.shm_name}: lost the PSF, re-acquiring")
+            self.acquire()
+            return
+        center = np.nanmedian(centers, axis=0)
+        # the window may be clipped by the frame edges
+        shape = np.array(self.reader.window_shape("psf"))
+        window_center = np.array(self.reader.offset("psf")) + (shape - 1) / 2
+        if np.hypot(*(center - window_center)) > self.window / 4:
+            self.reader.set_window("psf", center, 2 * self.window)
+
+    def spectra(self):
+        """
+        Welch power spectral densities (px^2/Hz) of the y and x centroids, averaged over the
+        complete batches in the buffer.
+
+        Returns
+        -------
+        freqs, psd, fs
+            Frequencies (Hz), (2, nfreq) y and x spectra, and the sampling frequency (Hz), or None
+            if the buffer does not hold a complete batch yet
+        """
+        batches = self.buffer.column("batch")
+        ids, counts = np.unique(batches, return_counts=True)
+        complete = np.isin(batches, ids[counts == self.batch])
+        if not np.any(complete):
+            return None
+        times = self.buffer.column("time")[complete].reshape(-1, self.batch)
+        fs = float(np.median((self.batch - 1) / (times[:, -1] - times[:, 0])))
+        positions = np.stack(
+            [self.buffer.column(c)[complete].reshape(-1, self.batch) for c in ("cy", "cx")]
+        )
+        # fill failed centroids with the batch mean
+        means = np.nanmean(positions, axis=-1, keepdims=True)
+        positions = np.where(np.isfinite(positions), positions, means)
+        freqs, psd = signal.welch(positions, fs=fs, nperseg=self.nperseg, detrend="linear", axis=-1)
+        return freqs, psd.mean(axis=1), fs
+
+    def summary(self) -> dict | None:
+        """RMS jitter (mas, integrated over the spectra) and vibration peaks of the buffer"""
+        spectra = self.spectra()
+        if spectra is None:
+            return None
+        freqs, psd, fs = spectra
+        df = freqs[1] - freqs[0]
+        # px^2/Hz -> mas^2/Hz
+        psd = psd * self.pxscale**2
+        rms_y, rms_x = np.sqrt(np.sum(psd, axis=-1) * df)
+        self.freqs = freqs
+        self.last_psd = psd
+        return {
+            "time": float(np.nanmax(self.buffer.column("time"))),
+            "n": len(self.buffer),
+            "fs": fs,
+            "rms": float(np.hypot(rms_x, rms_y)),
+            "rms_x": float(rms_x),
+            "rms_y": float(rms_y),
+            "cx": float(np.nanmedian(self.buffer.column("cx"))),
+            "cy": float(np.nanmedian(self.buffer.column("cy"))),
+            "flux": float(np.nanmedian(self.buffer.column("flux"))),
+            "peaks": vibration_peaks(freqs, psd.sum(axis=0), npeaks=self.npeaks),
+        }
+
+    def publish(self, summary: dict):
+        mapping = {k: json.dumps(v) if k == "peaks" else v for k, v in summary.items()}
+        with RDB.pipeline() as pipe:
+            pipe.delete(self.redis_key)
+            pipe.hset(self.redis_key, mapping=mapping)
+            pipe.execute()
+        self.record(summary)
+        peaks = ", ".join(f"{p['freq']:.1f} Hz ({p['rms']:.2f} mas)" for p in summary["peaks"])
+        logger.info(
+            "%s: jitter rms=%.2f mas (x=%.2f, y=%.2f) at %.0f Hz, peaks: %s",
+            self.shm_name,
+            summary["rms"],
+            summary["rms_x"],
+            summary["rms_y"],
+            summary["fs"],
+            peaks or "none",
+        )
+
+    def record(self, summary: dict):
+        """Append a summary (and its spectra) to the history and rewrite the history file"""
+        self.history.extend(**{c: summary[c] for c in self.HISTORY_COLUMNS})
+        # a new sampling frequency changes the frequency grid
+        if self.psd_history and self.psd_history[-1].shape != self.last_psd.shape:
+            self.psd_history.clear()
+        self.psd_history.append(self.last_psd.astype("f4"))
+        arrays = self.history.to_dict()
+        psds = np.array(self.psd_history)
+        arrays.update(
+            freqs=self.freqs,
+            psd_y=psds[:, 0],
+            psd_x=psds[:, 1],
+            centroid_time=self.buffer.column("time"),
+            centroid_y=self.buffer.column("cy"),
+            centroid_x=self.buffer.column("cx"),
+        )
+
+        def writer(tmpname):
+            with Path(tmpname).open("wb") as fh:
+                np.savez(fh, **arrays)
+
+        atomic_write(self.history_file, writer)
+
+    def step(self):
+        if self.centroider is None:
+            self.acquire()
+        cube, times = self.read()
+        return self.process(cube, times)
+
+    def run(self, duration: float | None = None):
+        start = last_summary = time.monotonic()
+        while duration is None or time.monotonic() - start < duration:
+            self.step()
+            if time.monotonic() - last_summary >= self.summary_interval:
+                summary = self.summary()
+                if summary is not None:
+                    self.publish(summary)
+                last_summary = time.monotonic()
+
+
+@click.command("vampires_jitter")
+@click.argument("streams", nargs=-1, type=click.Choice(["vcam1", "vcam2"]))
+@click.option(
+    "-w", "--window", default=20, type=int, help="Centroid window, in px", show_default=True
+)
+@click.option(
+    "-b", "--batch", default=1024, type=int, help="Frames per contiguous batch", show_default=True
+)
+@click.option(
+    "-s",
+    "--buffer-size",
+    default=16384,
+    type=int,
+    help="Number of centroids used for the spectra",
+    show_default=True,
+)
+@click.option("--nperseg", default=256, type=int, help="Welch segment length", show_default=True)
+@click.option(
+    "-i",
+    "--interval",
+    default=5.0,
+    type=float,
+    help="Time between published summaries, in s",
+    show_default=True,
+)
+@click.option("-d", "--duration", type=float, help="Stop after this many seconds")
+def main(
+    streams: tuple[str, ...],
+    window: int,
+    batch: int,
+    buffer_size: int,
+    nperseg: int,
+    interval: float,
+    duration: float | None,
+):
+    """Measure tip/tilt jitter and vibrations from the camera streams (by default both)"""
+    if len(streams) == 0:
+        streams = ("vcam1", "vcam2")
+    analyzers = [
+        JitterAnalyzer(
+            stream,
+            window=window,
+            batch=batch,
+            buffer_size=buffer_size,
+            nperseg=nperseg,
+            summary_interval=interval,
+        )
+        for stream in streams
+    ]
+
+    # one thread per camera, each blocks on its own stream
+    threads = [
+        threading.Thread(target=a.run, kwargs={"duration": duration}, daemon=True)
+        for a in analyzers
+    ]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -9,5 +9,11 @@ DATA_DIR = CONF_DIR / "data"
 DATA_DIR.mkdir(exist_ok=True)
 SYNTHPSF_DIR = DATA_DIR / "psfs"
 SYNTHPSF_DIR.mkdir(exist_ok=True)
+PUPIL_DIR = DATA_DIR / "pupils"
+PUPIL_DIR.mkdir(exist_ok=True)
+DARK_DIR = DATA_DIR / "darks"
+DARK_DIR.mkdir(exist_ok=True)
+JITTER_DIR = DATA_DIR / "jitter"
+JITTER_DIR.mkdir(exist_ok=True)
 CROPS_DIR = CONF_DIR / "crops"
 CROPS_DIR.mkdir(exist_ok=True)
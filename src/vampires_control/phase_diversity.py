@@ -0,0 +1,404 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Final
+
+import click
+import hcipy as hp
+import numpy as np
+from pyMilk.interfacing.isio_shmlib import SHM
+from scipy.optimize import least_squares
+from swmain.network.pyroclient import connect
+
+from .filters import load_vampires_filter
+from .shm_roi import ROIReader
+from .strehl import get_frame_calibrator
+from .synthpsf import (
+    PIXEL_SCALE,
+    PUPIL_DIAMETER,
+    _mft_matrices,
+    generate_pupil,
+    pupil_angle_from_keywords,
+)
+
+__all__ = ("PhaseDiversity", "PhaseDiversityFocuser", "PhaseDiversityResult")
+
+# ORCA-Quest pixel pitch, which with the plate scale sets the focal ratio at the detectors (~F/20)
+PIXEL_PITCH: Final[float] = 4.6e-6  # m
+F_NUMBER: Final[float] = PIXEL_PITCH / np.deg2rad(PIXEL_SCALE / 3.6e6) / PUPIL_DIAMETER
+# focal-plane shift at the detectors per mm of lens stage travel, None until it is calibrated
+# (e.g., from the focus error measured at a few lens positions); corrections need a scale
+LENS_FOCUS_SCALE: Final[float | None] = None
+# largest lens stage move of a single correction, and the lens stage travel, in mm
+MAX_LENS_STEP: Final[float] = 0.2
+LENS_LIMITS: Final[tuple[float, float]] = (0, 23)
+# fitted (Noll) Zernike modes common to both cameras: defocus, astigmatism, coma, spherical
+NOLL_MODES: Final[tuple[int, ...]] = (4, 5, 6, 7, 8, 11)
+# LAPD defocus of VCAM1 relative to VCAM2, see `configurations.main`
+LAPD_DIVERSITY: Final[float] = 3.0  # mm
+
+# set up logging
+formatter = logging.Formatter("%(asctime)s|%(name)s|%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger("phase_diversity")
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.INFO)
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+
+
+def defocus_to_zernike(shift: float) -> float:
+    """RMS amplitude (m) of the Noll defocus mode for a focal-plane shift (m) at the detectors"""
+    return shift / (16 * np.sqrt(3) * F_NUMBER**2)
+
+
+def zernike_to_defocus(coeff: float) -> float:
+    """Focal-plane shift (m) at the detectors for a Noll defocus RMS amplitude (m)"""
+    return coeff * 16 * np.sqrt(3) * F_NUMBER**2
+
+
+@lru_cache(maxsize=4)
+def _zernike_modes(n: int, modes: tuple[int, ...]) -> np.ndarray:
+    # RMS-normalized Noll Zernikes over the pupil grid of `generate_pupil`, shape (nmodes, n, n)
+    grid = hp.make_pupil_grid(n, diameter=PUPIL_DIAMETER)
+    basis = hp.make_zernike_basis(max(modes) - 1, PUPIL_DIAMETER, grid, starting_mode=2)
+    cube = np.array([basis[m - 2].shaped for m in modes], dtype="f8")
+    cube.flags.writeable = False
+    return cube
+
+
+@dataclass(frozen=True)
+class PhaseDiversityResult:
+    """
+    Low-order aberrations fit from a focused and a defocused frame.
+
+    Attributes
+    ----------
+    defocus : float
+        Focus error of the reference camera as a focal-plane shift at the detector, in mm
+    coeffs : dict
+        RMS amplitude of each common Noll mode, in nm
+    tilts : ndarray
+        (x, y) tip/tilt RMS amplitude of each camera, in nm
+    cost : float
+        Reduced chi-squared of the fit
+    success : bool
+        Whether the least-squares fit converged
+    """
+
+    defocus: float
+    coeffs: dict
+    tilts: np.ndarray
+    cost: float
+    success: bool
+
+
+class PhaseDiversity:
+    """
+    Phase-diversity estimator of low-order aberrations from a pair of simultaneous frames.
+
+    The reference frame is in (or near) focus and the diverse frame is defocused by a known
+    focal-plane shift, which lifts the sign ambiguity of even aberrations like defocus. Both
+    frames are modeled from the `synthpsf` pupil with a common phase of a few low-order Zernikes
+    (`NOLL_MODES`) plus separate tip/tilt for each camera, propagated over a few wavelengths of
+    the filter with the cached matrix Fourier transforms. The phase is fit with
+    `scipy.optimize.least_squares`, solving for the flux and background of each frame linearly.
+
+    Parameters
+    ----------
+    filt : str
+        Filter name, used for the wavelengths of the model
+    diversity : float
+        Focal-plane shift of the diverse frame relative to the reference, in mm, by default
+        `LAPD_DIVERSITY`
+    npix : int
+        Size of the fitted cutouts, by default 64
+    pupil_angle : float
+        Pupil rotation angle, in deg
+    n : int
+        Pupil sampling, by default 128
+    nwave : int
+        Number of wavelengths across the filter, by default 3
+    """
+
+    def __init__(
+        self,
+        filt: str,
+        diversity: float = LAPD_DIVERSITY,
+        npix: int = 64,
+        pupil_angle: float = 0,
+        n: int = 128,
+        nwave: int = 3,
+    ):
+        self.filt = filt
+        self.diversity = diversity
+        self.npix = npix
+        self.amplitude = generate_pupil(n=n, angle=pupil_angle)
+        obs_filt = load_vampires_filter(filt)
+        waves = obs_filt.waveset
+        through = obs_filt.model.lookup_table
+        above_50 = np.nonzero(through >= 0.5 * np.nanmax(through))
+        waves = np.linspace(waves[above_50].min(), waves[above_50].max(), nwave)
+        self.weights = obs_filt(waves).value
+        self.waves = waves.to("m").value
+        self.mft = _mft_matrices(
+            n, npix, float(PIXEL_SCALE), tuple(self.waves.tolist()), float(PUPIL_DIAMETER)
+        )
+        self.modes = _zernike_modes(n, NOLL_MODES)
+        self.tilt_modes = _zernike_modes(n, (2, 3))
+        self.diverse_phase = defocus_to_zernike(diversity * 1e-3) * self.modes[NOLL_MODES.index(4)]
+
+    def psf(self, opd) -> np.ndarray:
+        """Polychromatic PSF (normalized to unit sum) for a pupil OPD map in m"""
+        phase = (2 * np.pi / self.waves)[:, None, None] * opd
+        field = (self.amplitude * np.exp(1j * phase)).astype("c8")
+        efield = self.mft @ field @ self.mft.swapaxes(-1, -2)
+        intensity = np.tensordot(self.weights / self.waves**2, np.abs(efield) ** 2, axes=1)
+        return intensity / intensity.sum()
+
+    def _opds(self, params):
+        # params: common mode amplitudes, then (x, y) tilts of the reference and diverse frames
+        nmodes = len(NOLL_MODES)
+        common = np.tensordot(params[:nmodes], self.modes, axes=1)
+        tilts = params[nmodes:].reshape(2, 2)
+        ref = common + np.tensordot(tilts[0], self.tilt_modes, axes=1)
+        diverse = common + self.diverse_phase + np.tensordot(tilts[1], self.tilt_modes, axes=1)
+        return ref, diverse
+
+    def models(self, params) -> np.ndarray:
+        """Reference and diverse PSF models for the fit parameters (in m)"""
+        return np.array([self.psf(opd) for opd in self._opds(params)])
+
+    def _tilt_guess(self, frame) -> np.ndarray:
+        # tip/tilt (m RMS) placing the PSF at the center of mass of the frame
+        weights = np.maximum(frame - np.median(frame), 0)
+        yy, xx = np.indices(frame.shape)
+        center = (self.npix - 1) / 2
+        dy = np.sum(weights * yy) / weights.sum() - center
+        dx = np.sum(weights * xx) / weights.sum() - center
+        # an RMS tilt `a` moves the PSF by 4 a / D radians
+        plate_scale = np.deg2rad(PIXEL_SCALE / 3.6e6)
+        return np.array((dx, dy)) * plate_scale * PUPIL_DIAMETER / 4
+
+    def fit(self, reference, diverse, read_noise: float = 1) -> PhaseDiversityResult:
+        """
+        Fit the aberrations to background-subtracted `npix` cutouts of the reference and
+        diverse frames (in the same orientation), with Poisson plus `read_noise` weights.
+        """
+        data = np.array((reference, diverse), dtype="f8")
+        sigma = np.sqrt(np.maximum(data, 0) + read_noise**2)
+        design = np.ones((2, data[0].size, 2))
+
+        def residuals(params):
+            resid = []
+            for model, frame, err, A in zip(self.models(params), data, sigma, design):
+                # flux and background of each frame are linear
+                A[:, 0] = model.ravel()
+                coef = np.linalg.lstsq(A / err.ravel()[:, None], (frame / err).ravel(), rcond=None)
+                resid.append((frame.ravel() - A @ coef[0]) / err.ravel())
+            return np.concatenate(resid)
+
+        x0 = np.zeros(len(NOLL_MODES) + 4)
+        x0[len(NOLL_MODES) :] = np.concatenate([self._tilt_guess(frame) for frame in data])
+        result = least_squares(residuals, x0, x_scale=50e-9, diff_step=1e-3)
+        nmodes = len(NOLL_MODES)
+        defocus = result.x[NOLL_MODES.index(4)]
+        dof = max(result.fun.size - result.x.size - 4, 1)
+        return PhaseDiversityResult(
+            defocus=float(zernike_to_defocus(defocus) * 1e3),
+            coeffs={f"Z{m}": float(c * 1e9) for m, c in zip(NOLL_MODES, result.x[:nmodes])},
+            tilts=result.x[nmodes:].reshape(2, 2) * 1e9,
+            cost=float(np.sum(result.fun**2) / dof),
+            success=bool(result.success),
+        )
+
+
+@lru_cache(maxsize=8)
+def get_phase_diversity(filt: str, diversity: float, npix: int, pupil_angle: float):
+    """Cached `PhaseDiversity` estimator, with the pupil angle binned to 1 deg"""
+    return PhaseDiversity(filt, diversity=diversity, npix=npix, pupil_angle=pupil_angle)
+
+
+class PhaseDiversityFocuser:
+    """
+    Focus the lens stage from VCAM2 (reference) and VCAM1 (defocused by the LAPD configuration)
+    frame pairs.
+
+    Each measurement reads `num_frames` frames of both cameras at the same time, coadds and
+    calibrates a cutout around the PSF of each, and fits a `PhaseDiversity` model. The focus
+    error is corrected in one lens move (scaled by `gain`, and limited to `max_step` and the
+    stage travel), and `run` repeats this as a focus-tracking loop. Corrections need the lens
+    focus scale, without it the focus error can only be measured.
+
+    Parameters
+    ----------
+    num_frames : int
+        Frames coadded for each measurement, by default 10
+    npix : int
+        Size of the fitted cutouts, by default 64
+    diversity : float
+        Defocus of VCAM1 relative to VCAM2, in mm of focal-plane shift, by default
+        `LAPD_DIVERSITY`
+    lens_scale : float, optional
+        Focal-plane shift per mm of lens stage travel, by default `LENS_FOCUS_SCALE`
+    max_step : float
+        Largest lens stage move of a correction, in mm, by default `MAX_LENS_STEP`
+    """
+
+    def __init__(
+        self,
+        num_frames: int = 10,
+        npix: int = 64,
+        diversity: float = LAPD_DIVERSITY,
+        lens_scale: float | None = LENS_FOCUS_SCALE,
+        max_step: float = MAX_LENS_STEP,
+    ):
+        self.num_frames = num_frames
+        self.npix = npix
+        self.diversity = diversity
+        self.lens_scale = lens_scale
+        self.max_step = max_step
+        self.shms = {cam: SHM(f"vcam{cam}") for cam in (1, 2)}
+        self.focus_stage = connect("VAMPIRES_FOCUS")
+        self._pool = ThreadPoolExecutor(max_workers=2)
+
+    def _read(self, cam: int) -> np.ndarray:
+        shm = self.shms[cam]
+        calibrator = get_frame_calibrator(f"vcam{cam}")
+        calibrator.update(shm.get_keywords())
+        reader = ROIReader.around_peak(shm, self.npix, calibrator=calibrator)
+        if reader.window_shape("psf") != (self.npix, self.npix):
+            msg = f"The vcam{cam} PSF is within {self.npix // 2} px of the frame edge"
+            raise RuntimeError(msg)
+        cutout = reader.read(self.num_frames, coadd="mean")["psf"]
+        cutout = calibrator(cutout, reader.windows["psf"])
+        # VCAM1 images are flipped vertically relative to VCAM2
+        return np.flipud(cutout) if cam == 1 else cutout
+
+    def capture(self) -> tuple[np.ndarray, np.ndarray]:
+        """Simultaneous (reference, diverse) cutouts from VCAM2 and VCAM1"""
+        reference, diverse = self._pool.map(self._read, (2, 1))
+        return reference, diverse
+
+    def measure(self) -> PhaseDiversityResult:
+        shmkwds = self.shms[2].get_keywords()
+        estimator = get_phase_diversity(
+            shmkwds["FILTER01"].strip(),
+            self.diversity,
+            self.npix,
+            float(np.round(pupil_angle_from_keywords(shmkwds) % 180)),
+        )
+        t0 = time.monotonic()
+        result = estimator.fit(*self.capture())
+        logger.info(
+            f"Focus error {result.defocus:+.3f} mm ({time.monotonic() - t0:.1f} s, reduced chi2"
+            f" {result.cost:.1f}) | "
+            + " ".join(f"{k}={v:+.0f}" for k, v in result.coeffs.items() if k != "Z4")
+            + " nm"
+        )
+        return result
+
+    def correct(self, result: PhaseDiversityResult, gain: float = 1) -> float:
+        """
+        Move the lens stage to cancel `gain` times the focus error, by at most `max_step` and
+        within `LENS_LIMITS`, returns the new position
+        """
+        if self.lens_scale is None:
+            msg = "The lens focus scale is not calibrated, set `lens_scale` to correct the focus"
+            raise ValueError(msg)
+        step = -gain * result.defocus / self.lens_scale
+        if abs(step) > self.max_step:
+            logger.warning(f"Limiting lens correction of {step:+.3f} mm to {self.max_step} mm")
+            step = np.clip(step, -self.max_step, self.max_step)
+        position = float(np.clip(self.focus_stage.get_position("lens") + step, *LENS_LIMITS))
+        self.focus_stage.move_absolute("lens", position)
+        return position
+
+    def step(self, gain: float = 1):
+        result = self.measure()
+        if not result.success:
+            logger.warning("Phase-diversity fit did not converge, not correcting")
+            return result
+        position = self.correct(result, gain)
+        logger.info(f"Moved lens focus to {position:.3f} mm")
+        return result
+
+    def run(self, gain: float = 0.5, interval: float = 5):
+        if self.lens_scale is None:
+            msg = "The lens focus scale is not calibrated, set `lens_scale` to track the focus"
+            raise ValueError(msg)
+        while True:
+            t0 = time.monotonic()
+            try:
+                self.step(gain)
+            except RuntimeError as e:
+                # the PSF is acquired again at the next step
+                logger.warning(f"{e}, not correcting")
+            time.sleep(max(interval - (time.monotonic() - t0), 0))
+
+
+@click.command("vampires_phase_diversity")
+@click.option("-n", "--num-frames", default=10, type=int, help="Frames coadded per measurement")
+@click.option("-s", "--size", default=64, type=int, help="Cutout size, in px", show_default=True)
+@click.option(
+    "-d",
+    "--diversity",
+    default=LAPD_DIVERSITY,
+    type=float,
+    help="Defocus of VCAM1 relative to VCAM2, in mm",
+    show_default=True,
+)
+@click.option(
+    "-g", "--gain", default=0.5, type=float, help="Loop gain of the corrections", show_default=True
+)
+@click.option("-i", "--interval", default=5.0, type=float, help="Loop period, in s")
+@click.option(
+    "--scale",
+    default=LENS_FOCUS_SCALE,
+    type=float,
+    help="Focal-plane shift per mm of lens stage travel, required for corrections",
+)
+@click.option(
+    "--max-step",
+    default=MAX_LENS_STEP,
+    type=float,
+    help="Largest lens move of a correction, in mm",
+    show_default=True,
+)
+@click.option("--loop/--single", default=False, help="Keep tracking the focus", show_default=True)
+def main(
+    num_frames: int,
+    size: int,
+    diversity: float,
+    gain: float,
+    interval: float,
+    scale: float | None,
+    max_step: float,
+    loop: bool,
+):
+    """Estimate (and correct) the lens focus by phase diversity in the LAPD configuration"""
+    if loop and scale is None:
+        msg = "tracking the focus needs the lens focus scale (--scale)"
+        raise click.UsageError(msg)
+    focuser = PhaseDiversityFocuser(
+        num_frames=num_frames, npix=size, diversity=diversity, lens_scale=scale, max_step=max_step
+    )
+    if loop:
+        focuser.run(gain=gain, interval=interval)
+        return
+    result = focuser.measure()
+    if not result.success:
+        click.echo("Phase-diversity fit did not converge, not correcting")
+        return
+    if scale is None:
+        click.echo("No lens focus scale (--scale) given, not correcting")
+        return
+    if click.confirm(f"Correct focus error of {result.defocus:+.3f} mm?", default=True):
+        # a single measurement is corrected in full
+        focuser.correct(result)
+
+
+if __name__ == "__main__":
+    main()
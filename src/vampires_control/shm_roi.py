@@ -0,0 +1,171 @@
+import time
+from typing import Final
+
+import numpy as np
+from pyMilk.interfacing.isio_shmlib import SHM
+from scipy.ndimage import median_filter
+
+from .centroid import cutout_slice
+from .coadd import CoaddMethod, get_coadder
+
+__all__ = ("ROIReader", "read_roi")
+
+Coadd = CoaddMethod | None
+# stream keywords of the camera mode, the stream is recreated when any of them change
+MODE_KEYS: Final[tuple[str, ...]] = ("PRD-MIN1", "PRD-MIN2", "PRD-RNG1", "PRD-RNG2", "U_DETMOD")
+
+
+class ROIReader:
+    """
+    Read regions of interest out of SHM frames as they arrive.
+
+    Instead of receiving full frames (`SHM.multi_recv_data`) and cutting out boxes afterwards,
+    each new frame is accessed without copying and only the requested windows are copied out,
+    converted to `dtype` on the fly. Coadds are streamed through a `Coadder` per window, so no
+    frame cube is ever allocated.
+
+    Parameters
+    ----------
+    shm : SHM or str
+        Stream (or stream name) to read from
+    windows : dict, optional
+        Mapping of names to (y, x) index slices, by default the full frame as "frame"
+    dtype : str
+        Output data type, by default "f4"
+
+    Attributes
+    ----------
+    times : ndarray
+        Unix time at which each frame of the last `read` was received
+
+    Examples
+    --------
+    >>> reader = ROIReader("vcam1")
+    >>> reader.set_window("psf", center=(260, 270), size=50)
+    >>> cutouts = reader.read(10, coadd="mean")
+    >>> cutouts["psf"].shape
+    (50, 50)
+    """
+
+    def __init__(self, shm: SHM | str, windows: dict | None = None, dtype="f4"):
+        self.shm = SHM(shm) if isinstance(shm, str) else shm
+        self.shape = tuple(self.shm.shape[-2:])
+        self._mode = _stream_mode(self.shm)
+        self.dtype = np.dtype(dtype)
+        if windows is None:
+            windows = {"frame": np.s_[:, :]}
+        self.windows = dict(windows)
+        self.times = np.empty(0)
+
+    @classmethod
+    def around_peak(
+        cls, shm: SHM | str, size, name: str = "psf", nframes: int = 5, calibrator=None, **kwargs
+    ) -> "ROIReader":
+        """
+        Create a reader with a window of `size` around the peak of the next `nframes` frames.
+
+        The peak is located on the median of the frames, calibrated by `calibrator` (e.g., a
+        `FrameCalibrator`) if given, and smoothed by a 3x3 median filter, so that cosmic rays
+        and hot pixels can't capture the window. The window is clipped to the frame, check
+        `window_shape` if a full-size window is needed.
+        """
+        reader = cls(shm, **kwargs)
+        frame = reader.read_frame(nframes, coadd="median")
+        if calibrator is not None:
+            frame = calibrator(frame)
+        frame = median_filter(np.nan_to_num(frame), size=3)
+        center = np.unravel_index(np.argmax(frame), frame.shape)
+        reader.windows = {}
+        reader.set_window(name, center, size)
+        return reader
+
+    def set_window(self, name: str, center, size):
+        """Add (or move) a window of `size` around the (y, x) `center`, clipped to the frame"""
+        # cutout_slice only needs the frame shape
+        self.windows[name] = cutout_slice(np.broadcast_to(0, self.shape), size, np.asarray(center))
+
+    def offset(self, name: str) -> tuple[int, int]:
+        """(y, x) index of the lower-left corner of a window in the full frame"""
+        window = self.windows[name]
+        return window[0].indices(self.shape[0])[0], window[1].indices(self.shape[1])[0]
+
+    def reopen(self) -> bool:
+        """
+        Reopen the stream if it was recreated with a different shape or camera mode (see
+        `MODE_KEYS`), returns True if it was. The windows are kept, callers should reset them.
+        """
+        shm = SHM(self.shm.FNAME)
+        mode = _stream_mode(shm)
+        if mode == self._mode:
+            return False
+        self.shm = shm
+        self.shape = tuple(shm.shape[-2:])
+        self._mode = mode
+        return True
+
+    def _next_frame(self):
+        # wait for a new frame and return a view of the SHM buffer (no copy); the windows are
+        # copied out well before the next frame is written
+        return self.shm.get_data(check=True, copy=False)
+
+    def read(self, nframes: int = 1, coadd: Coadd = None) -> dict[str, np.ndarray]:
+        """
+        Read the windows from the next `nframes` frames.
+
+        Parameters
+        ----------
+        nframes : int
+            Number of frames to read
+        coadd : {"mean", "median", "clipped", None}
+            Collapse the frames of each window with a streaming coadder (see `get_coadder`), by
+            default return (nframes, ny, nx) cubes
+
+        Returns
+        -------
+        dict
+            Cutout (cube) for each window
+        """
+        self.times = np.empty(nframes)
+        if coadd is not None:
+            coadders = {k: get_coadder(coadd) for k in self.windows}
+            for i in range(nframes):
+                frame = self._next_frame()
+                self.times[i] = time.time()
+                for name, window in self.windows.items():
+                    coadders[name].add(frame[window])
+            return {k: c.result().astype(self.dtype, copy=False) for k, c in coadders.items()}
+        outputs = {k: np.empty((nframes, *self.window_shape(k)), self.dtype) for k in self.windows}
+        for i in range(nframes):
+            frame = self._next_frame()
+            self.times[i] = time.time()
+            for name, window in self.windows.items():
+                outputs[name][i] = frame[window]
+        return outputs
+
+    def read_frame(self, nframes: int = 1, coadd: Coadd = "mean", fill_value=0) -> np.ndarray:
+        """
+        Read and coadd the windows, returned in place in a full-size frame (filled with
+        `fill_value` outside of the windows) so that full-frame coordinates are preserved.
+        """
+        cutouts = self.read(nframes, coadd=coadd)
+        frame = np.full(self.shape, fill_value, dtype=self.dtype)
+        for name, window in self.windows.items():
+            frame[window] = cutouts[name]
+        return frame
+
+    def window_shape(self, name: str) -> tuple[int, int]:
+        """(ny, nx) shape of a window, smaller than its size if it was clipped to the frame"""
+        window = self.windows[name]
+        return tuple(len(range(*sl.indices(n))) for sl, n in zip(window, self.shape))
+
+
+def _stream_mode(shm: SHM) -> tuple:
+    keywords = shm.get_keywords()
+    return (tuple(shm.shape), *(keywords.get(k) for k in MODE_KEYS))
+
+
+def read_roi(shm: SHM | str, nframes: int, center, size, coadd: Coadd = "mean", dtype="f4"):
+    """Read a single (coadded) window of `size` around `center` from the next `nframes` frames"""
+    reader = ROIReader(shm, windows={}, dtype=dtype)
+    reader.set_window("roi", center, size)
+    return reader.read(nframes, coadd=coadd)["roi"]
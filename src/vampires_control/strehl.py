@@ -1,16 +1,182 @@
+import json
+import logging
 import os
+import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
 from datetime import datetime, timezone
+from functools import cached_property, lru_cache
+from pathlib import Path
+from typing import Final
 
 import click
 import numpy as np
-import paramiko
 import sep
 from astropy.nddata import Cutout2D
 from pyMilk.interfacing.isio_shmlib import SHM
+from scipy import fft
+from swmain.redis import RDB
 
-from .centroid import dft_centroid
-from .synthpsf import create_synth_psf
+from . import paths
+from .centroid import cutout_slice, dft_centroid, dft_centroids
+from .frame_calibration import FrameCalibrator, take_dark  # noqa: F401
+from .helpers import RingBuffer, atomic_write, cache_key, rfft_weights
+from .shm_roi import ROIReader
+from .synthpsf import (
+    PUPIL_OFFSET,
+    create_synth_psf,
+    get_psf_library,
+    pupil_angle_from_keywords,
+    pupil_rotates,
+)
+
+STREHL_REFERENCE_FILE: Final[Path] = paths.SYNTHPSF_DIR / "strehl_references.json"
+
+# set up logging
+formatter = logging.Formatter("%(asctime)s|%(name)s|%(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger("strehl")
+logger.setLevel(logging.INFO)
+stream_handler = logging.StreamHandler()
+stream_handler.setLevel(logging.INFO)
+stream_handler.setFormatter(formatter)
+logger.addHandler(stream_handler)
+
+
+class PeakFinder:
+    """
+    Batched sub-pixel peak finder.
+
+    Upsamples point-source cutouts by zero-padding their Fourier transform after deconvolving the
+    pixel response (a sinc), and returns the peak of the oversampled image. This is the same
+    algorithm as `find_peak`, but all kernels are computed once per (boxsize, oversamp) and a whole
+    stack of cutouts is evaluated in one pass: a forward rfft2, the deconvolution, and an inverse
+    transform done as two small matrix products, since all but (boxsize + 1) x (boxsize / 2 + 1)
+    frequencies of the zero-padded spectrum are zero. Use `get_peak_finder` to share instances.
+
+    Parameters
+    ----------
+    boxsize : float
+        region in which most of the flux is contained (typically 20), rounded up to an even size
+    oversamp : int, optional
+        how many times to oversample the image in the FFT interpolation (at least 2), by default 8
+    """
+
+    def __init__(self, boxsize, oversamp: int = 8):
+        if oversamp < 2:
+            msg = f"Oversampling factor must be at least 2, got {oversamp}"
+            raise ValueError(msg)
+        self.boxhalf = int(np.ceil(boxsize / 2.0))
+        self.boxsize = 2 * self.boxhalf
+        self.oversamp = int(oversamp)
+        self.ext = self.boxsize * self.oversamp
+        self._rows, self.kernel = self._make_kernel()
+        self._inv_y, self._inv_x_real, self._inv_x_imag = self._make_inverse_dft()
+
+    def _sinc(self):
+        # need to deconvolve the image by dividing by a sinc in order to "undo" the sampling
+        ext = self.ext
+        fftsinc = np.zeros(ext)
+        fftsinc[0 : self.oversamp] = 1.0
+        sinc = (
+            self.boxsize
+            * np.fft.fft(fftsinc, norm="forward")
+            * np.exp(
+                1j
+                * np.pi
+                * (self.oversamp - 1)
+                * np.roll(np.arange(-ext / 2, ext / 2), int(ext / 2))
+                / ext
+            )
+        )
+        sinc = sinc.real
+        sinc = np.roll(sinc, int(ext / 2))
+        return sinc[int(ext / 2) - self.boxhalf : int(ext / 2) + self.boxhalf]
+
+    def _make_kernel(self):
+        """
+        Build the half-plane deconvolution kernel.
+
+        The full-plane algorithm keeps the real part of the inverse FFT of the deconvolved,
+        zero-padded spectrum Z. That equals the inverse real FFT of the Hermitian part
+        (Z(k) + Z*(-k)) / 2, which for a real input is the rfft2 of the cutout multiplied by the
+        real kernel returned here (frequencies -h..h along y, 0..h along x, h = boxhalf).
+        """
+        h = self.boxhalf
+        inv_sinc2d = 1 / np.outer(self._sinc(), self._sinc())  # indexed by (ky + h, kx + h)
+        ky, kx = np.meshgrid(np.arange(-h, h + 1), np.arange(0, h + 1), indexing="ij")
+        kernel = np.zeros(ky.shape)
+        # Z(k), which is only defined for -h <= k < h
+        pos = (ky <= h - 1) & (kx <= h - 1)
+        kernel[pos] += inv_sinc2d[ky[pos] + h, kx[pos] + h]
+        # Z*(-k), which is defined for -h < k <= h
+        neg = ky >= -h + 1
+        kernel[neg] += inv_sinc2d[-ky[neg] + h, -kx[neg] + h]
+        kernel *= 0.5
+        rows = np.arange(-h, h + 1) % self.boxsize
+        return rows, kernel.astype("f4")
+
+    def _make_inverse_dft(self):
+        """Inverse DFT matrices from the non-zero frequencies to the oversampled grid"""
+        h = self.boxhalf
+        pix = np.arange(self.ext)
+        inv_y = np.exp(2j * np.pi * np.outer(pix, np.arange(-h, h + 1)) / self.ext)
+        # real output along x: Hermitian frequencies counted twice, except DC and Nyquist
+        kx = np.arange(h + 1)
+        weights = np.where((kx == 0) | (2 * kx == self.ext), 1, 2)[:, None]
+        phase = 2 * np.pi * np.outer(kx, pix) / self.ext
+        inv_x_real = weights * np.cos(phase)
+        inv_x_imag = -weights * np.sin(phase)
+        return inv_y.astype("c8"), inv_x_real.astype("f4"), inv_x_imag.astype("f4")
+
+    def cutouts(self, images, xc, yc):
+        """
+        Extract (boxsize, boxsize) cutouts around the given approximate coordinates.
+
+        `images` is a single image or a stack of images, `xc` and `yc` are scalars or one
+        coordinate per image (following `find_peak`, `xc` indexes the first image axis).
+        """
+        images = np.asarray(images)
+        stack = images.reshape(-1, *images.shape[-2:])
+        nframes = stack.shape[0]
+        xc = np.broadcast_to(xc, (nframes,))
+        yc = np.broadcast_to(yc, (nframes,))
+        # define a box around the center of the star, contained by the image
+        blx = np.clip(np.floor(xc - self.boxhalf).astype(int), 0, stack.shape[-2] - self.boxsize)
+        bly = np.clip(np.floor(yc - self.boxhalf).astype(int), 0, stack.shape[-1] - self.boxsize)
+        offsets = np.arange(self.boxsize)
+        rows = (blx[:, None] + offsets)[:, :, None]
+        cols = (bly[:, None] + offsets)[:, None, :]
+        return stack[np.arange(nframes)[:, None, None], rows, cols]
+
+    def __call__(self, cutouts):
+        """
+        Return the peak of the oversampled image for each (boxsize, boxsize) cutout in the stack.
+        """
+        cutouts = np.asarray(cutouts, dtype="f4")
+        stack = cutouts.reshape(-1, self.boxsize, self.boxsize)
+        # deconvolve the image by dividing by a sinc in order to "undo" the pixelation
+        spectrum = np.fft.rfft2(stack, norm="forward")[:, self._rows] * self.kernel
+        # zero-padded inverse transform
+        partial = self._inv_y @ spectrum.astype("c8")
+        upsampled = partial.real @ self._inv_x_real + partial.imag @ self._inv_x_imag
+        peaks = np.nanmax(upsampled, axis=(-2, -1))
+        return peaks.reshape(cutouts.shape[:-2])
+
+    def find(self, images, xc, yc):
+        """Find the sub-pixel peak of each image around the approximate coordinates"""
+        peaks = self(self.cutouts(images, xc, yc))
+        return peaks.reshape(np.shape(images)[:-2])
+
+
+@lru_cache(maxsize=16)
+def _get_peak_finder(boxhalf: int, oversamp: int) -> PeakFinder:
+    return PeakFinder(2 * boxhalf, oversamp)
+
+
+def get_peak_finder(boxsize, oversamp: int = 8) -> PeakFinder:
+    """Get a (memoized) `PeakFinder` for the given box size and oversampling"""
+    return _get_peak_finder(int(np.ceil(boxsize / 2.0)), int(oversamp))
 
 
 def find_peak(image, xc, yc, boxsize, oversamp=8):
@@ -27,67 +193,201 @@ def find_peak(image, xc, yc, boxsize, oversamp=8):
 
     Marcos van Dam, October 2022, translated from IDL code of the same name
     """
+    return float(get_peak_finder(boxsize, oversamp).find(image, xc, yc))
 
-    boxhalf = np.ceil(boxsize / 2.0).astype(int)
-    boxsize = 2 * boxhalf
-    ext = np.array(boxsize * oversamp, dtype=int)
 
-    # need to deconvolve the image by dividing by a sinc in order to "undo" the sampling
-    fftsinc = np.zeros(ext)
-    fftsinc[0:oversamp] = 1.0
+def mtf_volume(frames, crop: int | None = None, center=None) -> np.ndarray:
+    """
+    Mean of the normalized modulation transfer function over the full frequency plane for each
+    frame of a (n, ny, nx) stack, using float32 real FFTs.
 
-    sinc = (
-        boxsize
-        * np.fft.fft(fftsinc, norm="forward")
-        * np.exp(
-            1j * np.pi * (oversamp - 1) * np.roll(np.arange(-ext / 2, ext / 2), int(ext / 2)) / ext
-        )
+    Parameters
+    ----------
+    frames : ArrayLike
+        Single frame or stack of frames
+    crop : int, optional
+        Only transform a (crop, crop) window around `center`, by default the whole frame
+    center : tuple, optional
+        (y, x) center of the window, by default the peak of the mean frame
+    """
+    frames = np.asarray(frames)
+    stack = frames.reshape(-1, *frames.shape[-2:])
+    if crop is not None:
+        if center is None:
+            mean_frame = np.mean(stack, axis=0)
+            center = np.unravel_index(np.nanargmax(mean_frame), mean_frame.shape)
+        stack = stack[(Ellipsis, *cutout_slice(stack, crop, np.asarray(center)))]
+    ny, nx = stack.shape[-2:]
+    mtf = np.abs(fft.rfft2(np.nan_to_num(stack.astype("f4", copy=False)), workers=-1))
+    mtf /= np.max(mtf, axis=(-2, -1), keepdims=True)
+    volume = np.einsum("nij,j->n", mtf, rfft_weights(nx)) / (ny * nx)
+    return volume.reshape(frames.shape[:-2])
+
+
+def measure_strehl_otf(image, psf_model):
+    im_volume = mtf_volume(image)
+    psf_volume = mtf_volume(psf_model)
+    return float(im_volume / psf_volume)
+
+
+@lru_cache(maxsize=64)
+def _model_mtf_volume(reference: "StrehlReference", crop: int | None, flip: bool) -> float:
+    psf = np.flipud(reference.psf) if flip else reference.psf
+    return float(mtf_volume(psf, crop=crop))
+
+
+def measure_strehl_otf_cube(
+    frames, reference: "StrehlReference", crop: int | None = 201, center=None, flip=False
+) -> np.ndarray:
+    """
+    OTF Strehl ratio time series for a (n, ny, nx) stack of frames.
+
+    The ratio of the image and model MTF volumes, where the model MTF is cached per reference
+    and crop size. No centroiding or peak finding is needed, which makes this robust for low
+    signal-to-noise or very aberrated frames.
+
+    Parameters
+    ----------
+    frames : ArrayLike
+        Background-subtracted frames
+    reference : StrehlReference
+        Model reference for the filter and pupil angle, see `get_strehl_reference`
+    crop : int, optional
+        Size of the window around the PSF, by default 201. The model is cropped identically.
+    center : tuple, optional
+        (y, x) center of the window, by default the peak of the mean frame
+    flip : bool, optional
+        Flip the model vertically (camera 1), by default False
+
+    Returns
+    -------
+    ndarray
+        Strehl ratio of each frame
+    """
+    model_volume = _model_mtf_volume(reference, crop, flip)
+    return mtf_volume(frames, crop=crop, center=center) / model_volume
+
+
+def model_normalized_peak(psf_model, phot_rad=0.5, peak_search_rad=0.1, pxscale=5.9) -> float:
+    """Peak of the PSF model normalized by its aperture flux"""
+    aper_rad_px = phot_rad / (pxscale * 1e-3)
+    peak_search_rad_px = peak_search_rad / (pxscale * 1e-3)
+    # note: our models are alrady centered
+    model_center = np.array(psf_model.shape[-2:]) / 2 - 0.5
+    # note: our models have zero background signal
+    model_flux, model_fluxerr, _ = sep.sum_circle(
+        psf_model.astype("=f4"),
+        (model_center[1],),
+        (model_center[0],),
+        aper_rad_px,
+        err=np.sqrt(np.maximum(psf_model, 0)),
     )
-    sinc = sinc.real
-    sinc = np.roll(sinc, int(ext / 2))
-    sinc = sinc[int(ext / 2) - int(boxsize / 2) : int(ext / 2) + int(boxsize / 2)]
-    sinc2d = np.outer(sinc, sinc)
+    model_peak = find_peak(psf_model, model_center[0], model_center[1], peak_search_rad_px)
+    return float(model_peak / model_flux[0])
 
-    # define a box around the center of the star
-    blx = np.floor(xc - boxhalf).astype(int)
-    bly = np.floor(yc - boxhalf).astype(int)
 
-    # make sure that the box is contained by the image
-    blx = np.clip(blx, 0, image.shape[0] - boxsize)
-    bly = np.clip(bly, 0, image.shape[1] - boxsize)
+@dataclass(frozen=True)
+class StrehlReference:
+    """
+    Model side of the Strehl ratio for a filter, aperture, and pupil angle.
 
-    # extract the star
-    subim = image[blx : blx + boxsize, bly : bly + boxsize]
+    The normalized model peak only depends on these parameters, so it is memoized in-process and
+    persisted in `STREHL_REFERENCE_FILE`. Use `get_strehl_reference` to construct references so
+    the pupil angle is binned consistently.
+    """
 
-    # deconvolve the image by dividing by a sinc in order to "undo" the pixelation
-    fftim1 = np.fft.fft2(subim, norm="forward")
-    shfftim1 = np.roll(fftim1, (-boxhalf, -boxhalf), axis=(1, 0))
-    shfftim1 /= sinc2d  # deconvolve
+    filt: str
+    npix: int = 201
+    pxscale: float = 5.9
+    phot_rad: float = 0.5
+    peak_search_rad: float = 0.1
+    pupil_angle: float = PUPIL_OFFSET
 
-    zpshfftim1 = np.zeros((oversamp * boxsize, oversamp * boxsize), dtype="complex64")
-    zpshfftim1[0:boxsize, 0:boxsize] = shfftim1
+    @cached_property
+    def psf(self):
+        if not pupil_rotates():
+            # only a single pupil angle is ever used, don't build a library of all angles
+            return create_synth_psf(
+                self.filt, self.npix, pupil_offset=self.pupil_angle, pixel_scale=self.pxscale
+            )
+        return get_psf_library(self.filt, self.npix, pixel_scale=self.pxscale)(self.pupil_angle)
 
-    zpfftim1 = np.roll(zpshfftim1, (-boxhalf, -boxhalf), axis=(1, 0))
-    subimupsamp = np.fft.ifft2(zpfftim1, norm="forward").real
+    @cached_property
+    def norm_peak(self) -> float:
+        key = cache_key(**asdict(self))
+        references = _load_strehl_references()
+        if key not in references:
+            references[key] = model_normalized_peak(
+                self.psf,
+                phot_rad=self.phot_rad,
+                peak_search_rad=self.peak_search_rad,
+                pxscale=self.pxscale,
+            )
+            _save_strehl_reference(key, references[key])
+        return references[key]
 
-    peak = np.nanmax(subimupsamp)
 
-    return peak
+@lru_cache(maxsize=256)
+def _get_strehl_reference(filt, npix, pxscale, phot_rad, peak_search_rad, pupil_angle):
+    return StrehlReference(filt, npix, pxscale, phot_rad, peak_search_rad, pupil_angle)
 
 
-def measure_strehl_otf(image, psf_model):
-    im_mtf = np.abs(np.fft.fft2(image))
-    psf_mtf = np.abs(np.fft.fft2(psf_model))
+def get_strehl_reference(
+    filt: str,
+    npix: int = 201,
+    pxscale: float = 5.9,
+    phot_rad: float = 0.5,
+    peak_search_rad: float = 0.1,
+    pupil_angle: float = PUPIL_OFFSET,
+) -> StrehlReference:
+    """Get a (memoized) `StrehlReference`, with the pupil angle binned to 1 deg"""
+    return _get_strehl_reference(
+        filt,
+        int(npix),
+        round(float(pxscale), 6),
+        round(float(phot_rad), 6),
+        round(float(peak_search_rad), 6),
+        float(np.round(pupil_angle % 180)),
+    )
+
+
+def _reference_kwargs(kwargs) -> dict:
+    # the aperture parameters of `measure_strehl` that the model side depends on
+    return {k: kwargs[k] for k in ("phot_rad", "peak_search_rad") if k in kwargs}
+
 
-    im_mtf_norm = im_mtf / np.max(im_mtf)
-    psf_mtf_norm = psf_mtf / np.max(psf_mtf)
+@lru_cache(maxsize=1)
+def _load_strehl_references() -> dict[str, float]:
+    if not STREHL_REFERENCE_FILE.exists():
+        return {}
+    with STREHL_REFERENCE_FILE.open() as fh:
+        return json.load(fh)
 
-    im_volume = np.mean(im_mtf_norm)
-    psf_volume = np.mean(psf_mtf_norm)
-    return im_volume / psf_volume
 
+def _save_strehl_reference(key: str, value: float):
+    # re-read so entries written by other processes are kept
+    references = {}
+    if STREHL_REFERENCE_FILE.exists():
+        with STREHL_REFERENCE_FILE.open() as fh:
+            references = json.load(fh)
+    references[key] = value
 
-def measure_strehl(image, psf_model, pos=None, phot_rad=0.5, peak_search_rad=0.1, pxscale=5.9):
+    def _writer(name):
+        with Path(name).open("w") as fh:
+            json.dump(references, fh, indent=1)
+
+    atomic_write(STREHL_REFERENCE_FILE, _writer)
+
+
+def measure_strehl(
+    image,
+    psf_model,
+    pos=None,
+    phot_rad=0.5,
+    peak_search_rad=0.1,
+    pxscale=5.9,
+    model_norm_peak: float | None = None,
+):
     ## Step 1: find approximate location of PSF in image
     refined_center = dft_centroid(image, psf_model, center=pos)
 
@@ -103,36 +403,23 @@ def measure_strehl(image, psf_model, pos=None, phot_rad=0.5, peak_search_rad=0.1
     peak_search_rad_px = peak_search_rad / (pxscale * 1e-3)
     image_peak = find_peak(image, refined_center[0], refined_center[1], peak_search_rad_px)
 
-    ## Step 3: Calculate flux of PSF model
-    # note: our models are alrady centered
-    model_center = np.array(psf_model.shape[-2:]) / 2 - 0.5
-    # note: our models have zero background signal
-    model_flux, model_fluxerr, _ = sep.sum_circle(
-        psf_model.astype("=f4"),
-        (model_center[1],),
-        (model_center[0],),
-        aper_rad_px,
-        err=np.sqrt(np.maximum(psf_model, 0)),
-    )
-    model_peak = find_peak(psf_model, model_center[0], model_center[1], peak_search_rad_px)
+    ## Step 3: Calculate normalized peak of PSF model, unless it was precomputed
+    if model_norm_peak is None:
+        model_norm_peak = model_normalized_peak(
+            psf_model, phot_rad=phot_rad, peak_search_rad=peak_search_rad, pxscale=pxscale
+        )
 
     ## Step 4: Calculate Strehl via normalized ratio
     image_norm_peak = image_peak / image_flux[0]
-    model_norm_peak = model_peak / model_flux[0]
     strehl = image_norm_peak / model_norm_peak
     return strehl
 
 
-def take_dark(data_shm_name: str, n=100):
-    data_shm = SHM(data_shm_name)
-    dark_shm = SHM(f"{data_shm_name}_dark", (data_shm.shape, "f4"))
-    data = data_shm.multi_recv_data(n, outputFormat=n)
-    mean_frame = np.nanmedian(data, axis=0)
-    dark_shm.set_data(mean_frame.astype("f4"))
+MBI_FIELDS: Final[tuple[str, ...]] = ("F610", "F670", "F720", "F760")
 
 
-def get_mbi_cutout(data, camera: int, field: str, reduced: bool = False):
-    hy, hx = np.array(data.shape[-2:]) / 2 - 0.5
+def _mbi_field_center(shape, camera: int, field: str, reduced: bool = False):
+    hy, hx = np.array(shape[-2:]) / 2 - 0.5
     # use cam2 as reference
     match field:
         case "F610":
@@ -154,70 +441,618 @@ def get_mbi_cutout(data, camera: int, field: str, reduced: bool = False):
         y *= 2
     # flip y axis for cam 1 indices
     if camera == 1:
-        y = data.shape[-2] - y
+        y = shape[-2] - y
+    return y, x
+
+
+def get_mbi_cutout(data, camera: int, field: str, reduced: bool = False):
+    y, x = _mbi_field_center(data.shape, camera, field, reduced=reduced)
     return Cutout2D(data, position=(x, y), size=500, mode="partial")
 
 
-def measure_strehl_mbi(image, cam: int, pxscale: float = 5.9, **kwargs):
-    filters = ("F610", "F670", "F720", "F760")
+def mbi_field_slices(shape, camera: int, field: str, reduced: bool = False, size: int = 500):
+    """Index slices of an MBI field window, clipped to the frame, for zero-copy views"""
+    y, x = _mbi_field_center(shape, camera, field, reduced=reduced)
+    # match the pixel placement of `Cutout2D`
+    lower = np.ceil(np.array((y, x)) - size / 2).astype(int)
+    upper = np.minimum(lower + size, shape[-2:])
+    lower = np.maximum(lower, 0)
+    return np.s_[lower[0] : upper[0], lower[1] : upper[1]]
+
+
+class MBIEvaluator:
+    """
+    Evaluate the MBI fields of a frame together.
+
+    The field windows are zero-copy views into the frame. The coarse peak search runs per field
+    over a thread pool (numpy releases the GIL), while the DFT centroid, photometry, and peak
+    finding are batched across all fields. Wall-clock timings of each step are kept in `timings`.
+
+    Parameters
+    ----------
+    camera : int
+        VAMPIRES camera number, used to flip the field layout
+    fields : Sequence[str]
+        MBI fields to evaluate, by default all four
+    window : int
+        Size of the field windows, by default 500
+    max_workers : int, optional
+        Number of threads, by default one per field. Use 1 to run serially.
+    """
+
+    def __init__(
+        self,
+        camera: int,
+        fields=MBI_FIELDS,
+        window: int = 500,
+        reduced: bool = False,
+        max_workers: int | None = None,
+    ):
+        self.camera = camera
+        self.fields = tuple(fields)
+        self.window = window
+        self.reduced = reduced
+        self.max_workers = len(self.fields) if max_workers is None else max_workers
+        self.timings: dict[str, dict[str, float]] = {}
+        self._executor = None
+
+    def _map(self, func, *iterables):
+        if self.max_workers <= 1:
+            return list(map(func, *iterables))
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="mbi")
+        return list(self._executor.map(func, *iterables))
+
+    def _time(self, field: str, step: str, t0: float):
+        self.timings.setdefault(field, {})[step] = time.perf_counter() - t0
+
+    def views(self, frame) -> dict[str, tuple]:
+        """Zero-copy field views and their offsets (y, x) in the frame"""
+        views = {}
+        for field in self.fields:
+            window = mbi_field_slices(
+                frame.shape, self.camera, field, reduced=self.reduced, size=self.window
+            )
+            views[field] = frame[window], (window[0].start, window[1].start)
+        return views
+
+    def centroids(self, frame, psfs: dict, window: int = 20) -> dict[str, np.ndarray]:
+        """
+        DFT centroid (y, x), in frame coordinates, of each field against its PSF model,
+        starting from the brightest pixel of each field window.
+        """
+        self.timings = {}
+        views = self.views(frame)
+
+        def coarse_center(field):
+            t0 = time.perf_counter()
+            view, offset = views[field]
+            center = np.unravel_index(np.nanargmax(view), view.shape)
+            self._time(field, "search", t0)
+            return np.add(center, offset)
+
+        centers = self._map(coarse_center, self.fields)
+        ## batched DFT centroid across fields
+        t0 = time.perf_counter()
+        refined = dft_centroids(
+            [frame] * len(self.fields), [psfs[f] for f in self.fields], centers, window=window
+        )
+        self._time("all", "centroid", t0)
+        return dict(zip(self.fields, refined))
+
+    def strehl(
+        self,
+        frame,
+        references: dict,
+        phot_rad=0.5,
+        peak_search_rad=0.1,
+        pxscale=5.9,
+    ) -> dict[str, float]:
+        """Strehl ratio of each field given its `StrehlReference`"""
+        frame = np.asarray(frame, dtype="=f4")
+        t0 = time.perf_counter()
+        centers = self.centroids(frame, {f: ref.psf for f, ref in references.items()})
+        cy, cx = np.array([centers[f] for f in self.fields]).T
+
+        ## batched photometry and peak finding across fields
+        t1 = time.perf_counter()
+        aper_rad_px = phot_rad / (pxscale * 1e-3)
+        fluxes, _, _ = sep.sum_circle(frame, cx, cy, aper_rad_px)
+        self._time("all", "photometry", t1)
+        t1 = time.perf_counter()
+        finder = get_peak_finder(peak_search_rad / (pxscale * 1e-3))
+        stack = np.broadcast_to(frame, (len(self.fields), *frame.shape))
+        peaks = finder(finder.cutouts(stack, cy, cx))
+        self._time("all", "peak", t1)
+        self._time("all", "total", t0)
+
+        norm_peaks = np.array([references[f].norm_peak for f in self.fields])
+        strehls = peaks / fluxes / norm_peaks
+        return dict(zip(self.fields, strehls.tolist()))
+
+    def format_timings(self) -> str:
+        lines = []
+        for field, steps in self.timings.items():
+            steps_str = ", ".join(f"{k}={v*1e3:.1f} ms" for k, v in steps.items())
+            lines.append(f"{field}: {steps_str}")
+        return "\n".join(lines)
+
+
+@lru_cache(maxsize=2)
+def get_mbi_evaluator(camera: int) -> MBIEvaluator:
+    return MBIEvaluator(camera)
+
+
+def measure_strehl_mbi(
+    image,
+    cam: int,
+    pxscale: float = 5.9,
+    pupil_angle: float = PUPIL_OFFSET,
+    timings: bool = False,
+    **kwargs,
+):
+    references = {
+        filt: get_strehl_reference(
+            filt, 201, pxscale=pxscale, pupil_angle=pupil_angle, **_reference_kwargs(kwargs)
+        )
+        for filt in MBI_FIELDS
+    }
+    evaluator = get_mbi_evaluator(cam)
+    results = evaluator.strehl(image, references, pxscale=pxscale, **kwargs)
+    for filt, strehl in results.items():
+        print(f"{filt}: measured Strehl {strehl*100:.01f}%")
+    if timings:
+        print(evaluator.format_timings())
+    return results
+
+
+def measure_strehl_otf_mbi(
+    cubes: dict, cam: int, pxscale: float = 5.9, pupil_angle: float = PUPIL_OFFSET, crop: int = 201
+):
     results = {}
-    for _i, filt in enumerate(filters):
-        psf = create_synth_psf(filt, 201, pixel_scale=pxscale)
-        cutout = get_mbi_cutout(image, cam, filt)
-        results[filt] = measure_strehl(cutout.data, psf, pxscale=pxscale, **kwargs)
-        print(f"{filt}: measured Strehl {results[filt]*100:.01f}%")
+    for filt, cube in cubes.items():
+        ref = get_strehl_reference(filt, 201, pxscale=pxscale, pupil_angle=pupil_angle)
+        series = measure_strehl_otf_cube(cube, ref, crop=crop, flip=cam == 1)
+        results[filt] = float(np.mean(series))
+        print(f"{filt}: measured OTF Strehl {results[filt]*100:.01f}%")
     return results
 
 
-def measure_strehl_shm(shm_name: str, psf=None, nave=10, pxscale=5.9, **kwargs):
+@lru_cache(maxsize=2)
+def get_frame_calibrator(shm_name: str) -> FrameCalibrator:
+    return FrameCalibrator(shm_name)
+
+
+@dataclass
+class StrehlFrames:
+    """Calibrated frames captured from a camera stream, with what is needed to measure them"""
+
+    data: np.ndarray | dict[str, np.ndarray]
+    cam: int
+    filt: str | None
+    pupil_angle: float
+    metric: str
+
+
+def capture_strehl_frames(shm_name: str, nave=10, metric="peak") -> StrehlFrames:
+    """
+    Read and calibrate `nave` frames of a camera stream for `measure_strehl_capture`.
+
+    With `metric="peak"` the frames are coadded, with `metric="otf"` the calibrated cube (or a
+    cube per field in MBI mode) is kept. In MBI mode only the field windows are read.
+    """
+    if metric not in ("peak", "otf"):
+        msg = f"Invalid Strehl metric {metric!r}, expected 'peak' or 'otf'"
+        raise ValueError(msg)
     shm = SHM(shm_name)
-    # dark_shm = SHM(f"{shm_name}_dark")
-    # dark = dark_shm.get_data()
     shmkwds = shm.get_keywords()
+    cam = shmkwds["U_CAMERA"]
+    calibrator = get_frame_calibrator(shm_name)
+    calibrator.update(shmkwds)
+
+    reader = ROIReader(shm)
+    is_mbi = shm.shape[0] > 1000 and shm.shape[1] > 2000
+    if is_mbi:
+        reader.windows = {f: mbi_field_slices(reader.shape, cam, f) for f in MBI_FIELDS}
+    if metric == "otf":
+        data = {k: calibrator(v, reader.windows[k]) for k, v in reader.read(nave).items()}
+    else:
+        data = calibrator(reader.read_frame(nave, coadd="mean"))
+    return StrehlFrames(
+        data=data,
+        cam=cam,
+        filt=None if is_mbi else shmkwds["FILTER01"].strip(),
+        # PSF model follows the pupil rotation
+        pupil_angle=pupil_angle_from_keywords(shmkwds),
+        metric=metric,
+    )
 
-    frames = shm.multi_recv_data(nave, output_as_cube=True)
-    image = np.mean(frames.astype("f4") - 200, axis=0)
-    if shm.shape[0] > 1000 and shm.shape[1] > 2000:
-        return measure_strehl_mbi(image, cam=shmkwds["U_CAMERA"], pxscale=pxscale, **kwargs)
 
-    curfilt = shmkwds["FILTER01"].strip()
+def measure_strehl_capture(frames: StrehlFrames, psf=None, pxscale=5.9, **kwargs):
+    """Measure the Strehl ratio of frames from `capture_strehl_frames`"""
+    cam = frames.cam
+    pupil_angle = frames.pupil_angle
+    if frames.metric == "otf":
+        if frames.filt is None:
+            return measure_strehl_otf_mbi(
+                frames.data, cam=cam, pxscale=pxscale, pupil_angle=pupil_angle, **kwargs
+            )
+        ref = get_strehl_reference(frames.filt, 201, pxscale=pxscale, pupil_angle=pupil_angle)
+        series = measure_strehl_otf_cube(frames.data["frame"], ref, flip=cam == 1, **kwargs)
+        return float(np.mean(series))
 
-    # return image
+    if frames.filt is None:
+        return measure_strehl_mbi(
+            frames.data, cam=cam, pxscale=pxscale, pupil_angle=pupil_angle, **kwargs
+        )
+    model_norm_peak = None
     if psf is None:
-        psf = create_synth_psf(curfilt, 201, pixel_scale=pxscale)
-    if shmkwds["U_CAMERA"] == 1:
+        ref = get_strehl_reference(
+            frames.filt, 201, pxscale=pxscale, pupil_angle=pupil_angle, **_reference_kwargs(kwargs)
+        )
+        psf = ref.psf
+        model_norm_peak = ref.norm_peak
+    if cam == 1:
         psf = np.flipud(psf)
-    return measure_strehl(image, psf, pxscale=pxscale, **kwargs)
+    return measure_strehl(
+        frames.data, psf, pxscale=pxscale, model_norm_peak=model_norm_peak, **kwargs
+    )
+
+
+def measure_strehl_shm(shm_name: str, psf=None, nave=10, pxscale=5.9, metric="peak", **kwargs):
+    """
+    Measure the Strehl ratio from `nave` frames of a camera stream.
+
+    With `metric="peak"` (default) the frames are coadded and the Strehl ratio is measured from
+    the normalized peak, with `metric="otf"` the mean OTF Strehl ratio of the individual frames
+    is returned (see `measure_strehl_otf_cube`). In MBI mode only the field windows are read.
+    Capturing and measuring are split into `capture_strehl_frames` and `measure_strehl_capture`
+    so the measurement can run while the next frames are taken.
+    """
+    frames = capture_strehl_frames(shm_name, nave=nave, metric=metric)
+    return measure_strehl_capture(frames, psf=psf, pxscale=pxscale, **kwargs)
+
+
+def _frame_cutouts(stack, cy, cx, half: int):
+    """
+    Extract a (2 * half + 1)^2 cutout from every frame of a stack around integer centers, with
+    pixels outside of the frame set to zero. Returns the cutouts and their y, x pixel offsets.
+    """
+    n, ny, nx = stack.shape
+    offsets = np.arange(-half, half + 1)
+    rows = np.broadcast_to(cy, (n,))[:, None] + offsets
+    cols = np.broadcast_to(cx, (n,))[:, None] + offsets
+    valid = ((rows >= 0) & (rows < ny))[:, :, None] & ((cols >= 0) & (cols < nx))[:, None, :]
+    cutouts = stack[
+        np.arange(n)[:, None, None],
+        np.clip(rows, 0, ny - 1)[:, :, None],
+        np.clip(cols, 0, nx - 1)[:, None, :],
+    ]
+    return np.where(valid, cutouts, 0), offsets
+
+
+def measure_strehl_frames(
+    frames,
+    model_norm_peak: float,
+    center=None,
+    phot_rad=0.5,
+    peak_search_rad=0.1,
+    pxscale=5.9,
+    centroid_window: int = 20,
+) -> dict[str, np.ndarray]:
+    """
+    Vectorized Strehl ratio for every frame of a (n, ny, nx) cube.
+
+    Each frame is centroided (center of mass in `centroid_window` around the coarse center), its
+    flux measured in a circular aperture of `phot_rad` arcsec, and its sub-pixel peak found with
+    a `PeakFinder`. Only the model-side normalization is needed, see `StrehlReference`.
+
+    Parameters
+    ----------
+    frames : ArrayLike
+        Background-subtracted frames
+    model_norm_peak : float
+        Normalized peak of the PSF model
+    center : tuple, optional
+        Coarse (y, x) center of the PSF, by default the peak of the mean frame
+
+    Returns
+    -------
+    dict
+        Arrays of "strehl", "peak", "flux", "cx", and "cy" with one entry per frame
+    """
+    frames = np.asarray(frames, dtype="f4")
+    stack = frames.reshape(-1, *frames.shape[-2:])
+    if center is None:
+        mean_frame = np.nanmean(stack, axis=0)
+        center = np.unravel_index(np.nanargmax(mean_frame), mean_frame.shape)
+    cy0, cx0 = np.round(center).astype(int)
+
+    ## Step 1: center of mass around the coarse center
+    box, offsets = _frame_cutouts(stack, cy0, cx0, centroid_window // 2)
+    box = np.maximum(box - np.median(box, axis=(-2, -1), keepdims=True), 0)
+    total = box.sum(axis=(-2, -1))
+    cy = cy0 + np.einsum("nij,i->n", box, offsets) / total
+    cx = cx0 + np.einsum("nij,j->n", box, offsets) / total
+    cy = np.where(np.isfinite(cy), cy, cy0)
+    cx = np.where(np.isfinite(cx), cx, cx0)
+
+    ## Step 2: aperture photometry with a sub-pixel aperture mask per frame
+    aper_rad_px = phot_rad / (pxscale * 1e-3)
+    iy = np.round(cy).astype(int)
+    ix = np.round(cx).astype(int)
+    aper, offsets = _frame_cutouts(stack, iy, ix, int(np.ceil(aper_rad_px)) + 1)
+    dy = offsets[None, :, None] - (cy - iy)[:, None, None]
+    dx = offsets[None, None, :] - (cx - ix)[:, None, None]
+    mask = dy**2 + dx**2 <= aper_rad_px**2
+    flux = np.sum(aper * mask, axis=(-2, -1), dtype="f8")
+
+    ## Step 3: sub-pixel peak
+    peak_search_rad_px = peak_search_rad / (pxscale * 1e-3)
+    peak = get_peak_finder(peak_search_rad_px).find(stack, cy, cx)
+
+    ## Step 4: Calculate Strehl via normalized ratio
+    strehl = peak / flux / model_norm_peak
+    shape = frames.shape[:-2]
+    results = {"strehl": strehl, "peak": peak, "flux": flux, "cx": cx, "cy": cy}
+    return {k: np.reshape(v, shape) for k, v in results.items()}
+
+
+def summarize_values(values, bins=None) -> dict:
+    """Robust summary statistics (and optionally a histogram) of the finite values"""
+    values = np.asarray(values)
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return {"n": 0}
+    pcts = np.percentile(values, (5, 16, 50, 84, 95))
+    summary = {
+        "n": len(values),
+        "mean": float(np.mean(values)),
+        "median": float(pcts[2]),
+        "p05": float(pcts[0]),
+        "p16": float(pcts[1]),
+        "p84": float(pcts[3]),
+        "p95": float(pcts[4]),
+    }
+    if bins is not None:
+        summary["hist"] = np.histogram(values, bins)[0].tolist()
+    return summary
+
+
+class StrehlStream:
+    """
+    Continuous Strehl estimation from a VCAM stream.
+
+    Frames (or `nave`-frame coadds) are read in batches of `batch` and measured with the
+    vectorized `measure_strehl_frames` kernel. Per-frame results are kept in a `RingBuffer` of
+    `buffer_size` records for each field (one field for standard imaging, four in MBI mode), and
+    summaries are published every `summary_interval` seconds.
+    """
+
+    COLUMNS: Final[tuple[str, ...]] = ("time", "strehl", "peak", "flux", "cx", "cy")
+    HIST_BINS: Final = np.linspace(0, 1, 51)
+
+    def __init__(
+        self,
+        shm_name: str,
+        nave: int = 1,
+        batch: int = 100,
+        buffer_size: int = 10000,
+        summary_interval: float = 1.0,
+        pxscale: float = 5.9,
+        phot_rad: float = 0.5,
+        peak_search_rad: float = 0.1,
+    ):
+        self.shm_name = shm_name
+        self.shm = SHM(shm_name)
+        self.reader = ROIReader(self.shm)
+        self.nave = nave
+        self.batch = batch
+        self.buffer_size = buffer_size
+        self.summary_interval = summary_interval
+        self.calibrator = FrameCalibrator(self.shm)
+        self.pxscale = pxscale
+        self.phot_rad = phot_rad
+        self.peak_search_rad = peak_search_rad
+        self.fields = {}
+        self.buffers = {}
+        self._model_key = None
+
+    def update_model(self, shmkwds=None):
+        """Update field windows and Strehl references if the camera configuration changed"""
+        if shmkwds is None:
+            shmkwds = self.shm.get_keywords()
+        self.calibrator.update(shmkwds)
+        camera = shmkwds["U_CAMERA"]
+        pupil_angle = pupil_angle_from_keywords(shmkwds)
+        mbi = self.shm.shape[0] > 1000 and self.shm.shape[1] > 2000
+        filters = MBI_FIELDS if mbi else (shmkwds["FILTER01"].strip(),)
+        key = (camera, mbi, filters, np.round(pupil_angle % 180))
+        if key == self._model_key:
+            return
+        fields = {}
+        for filt in filters:
+            window = mbi_field_slices(self.shm.shape, camera, filt) if mbi else np.s_[:, :]
+            ref = get_strehl_reference(
+                filt,
+                pxscale=self.pxscale,
+                phot_rad=self.phot_rad,
+                peak_search_rad=self.peak_search_rad,
+                pupil_angle=pupil_angle,
+            )
+            fields[filt] = (window, ref.norm_peak)
+            if filt not in self.buffers:
+                self.buffers[filt] = RingBuffer(self.buffer_size, self.COLUMNS)
+        self.fields = fields
+        # only read the field windows out of the stream
+        self.reader.windows = {filt: window for filt, (window, _) in fields.items()}
+        self._model_key = key
+
+    def read(self):
+        """Read the field windows of the next batch of frames (coadded by `nave`) as float32"""
+        cubes = self.reader.read(self.batch * self.nave)
+        for field, cube in cubes.items():
+            self.calibrator(cube, self.reader.windows[field])
+            if self.nave > 1:
+                cubes[field] = cube.reshape(self.batch, self.nave, *cube.shape[-2:]).mean(axis=1)
+        # receive time of each frame (mean of each coadd)
+        times = self.reader.times.reshape(self.batch, self.nave).mean(axis=1)
+        return cubes, times
+
+    def process(self, cubes: dict, times) -> dict[str, dict]:
+        """Measure every frame in each field and push results into the ring buffers"""
+        results = {}
+        for field, (_, norm_peak) in self.fields.items():
+            res = measure_strehl_frames(
+                cubes[field],
+                norm_peak,
+                phot_rad=self.phot_rad,
+                peak_search_rad=self.peak_search_rad,
+                pxscale=self.pxscale,
+            )
+            self.buffers[field].extend(time=times, **res)
+            results[field] = res
+        return results
+
+    def summary(self) -> dict[str, dict]:
+        """Rolling statistics of the buffered measurements for each field"""
+        summaries = {}
+        for field in self.fields:
+            buffer = self.buffers[field]
+            summary = summarize_values(buffer.column("strehl"), bins=self.HIST_BINS)
+            for col in ("peak", "flux", "cx", "cy"):
+                summary[f"{col}_median"] = float(np.nanmedian(buffer.column(col)))
+            summary["time"] = float(np.nanmax(buffer.column("time")))
+            summaries[field] = summary
+        return summaries
+
+    def publish(self, summaries: dict[str, dict]):
+        for field, summary in summaries.items():
+            if summary["n"] == 0:
+                continue
+            logger.info(
+                "%s %s: Strehl median=%.1f%% (16-84%%: %.1f-%.1f%%) n=%d",
+                self.shm_name,
+                field,
+                summary["median"] * 100,
+                summary["p16"] * 100,
+                summary["p84"] * 100,
+                summary["n"],
+            )
+
+    def reopen(self) -> bool:
+        """Reopen the stream if the camera mode or crop changed, returns True if it did"""
+        if not self.reader.reopen():
+            return False
+        logger.info(f"{self.shm_name} changed shape or mode, reopened the stream")
+        self.shm = self.reader.shm
+        self.calibrator = FrameCalibrator(self.shm)
+        self.buffers = {}
+        self._model_key = None
+        return True
+
+    def step(self):
+        self.reopen()
+        self.update_model()
+        cubes, times = self.read()
+        return self.process(cubes, times)
+
+    def run(self, duration: float | None = None):
+        start = last_summary = time.monotonic()
+        while duration is None or time.monotonic() - start < duration:
+            self.step()
+            if time.monotonic() - last_summary >= self.summary_interval:
+                self.publish(self.summary())
+                last_summary = time.monotonic()
+
+
+@click.command("vampires_strehl_stream")
+@click.argument("stream", type=click.Choice(["vcam1", "vcam2"]))
+@click.option(
+    "-a", "--nave", default=1, type=int, help="Number of frames per coadd", show_default=True
+)
+@click.option(
+    "-b",
+    "--batch",
+    default=100,
+    type=int,
+    help="Measurements per vectorized batch",
+    show_default=True,
+)
+@click.option(
+    "-i",
+    "--interval",
+    default=1.0,
+    type=float,
+    help="Time between published summaries, in s",
+    show_default=True,
+)
+@click.option("-d", "--duration", type=float, help="Stop after this many seconds")
+def vampires_strehl_stream(
+    stream: str, nave: int, batch: int, interval: float, duration: float | None
+):
+    strehl_stream = StrehlStream(stream, nave=nave, batch=batch, summary_interval=interval)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        strehl_stream.run(duration=duration)
 
 
 @click.command("vampires_strehl")
 @click.argument("stream", type=click.Choice(["vcam1", "vcam2"]))
-def vampires_strehl(stream: str):
+@click.option(
+    "-m",
+    "--metric",
+    default="peak",
+    type=click.Choice(["peak", "otf"]),
+    help="Strehl estimator",
+    show_default=True,
+)
+def vampires_strehl(stream: str, metric: str):
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        measure_strehl_shm(stream)
+        measure_strehl_shm(stream, metric=metric)
+
+
+def strehl_redis_key(stream: str) -> str:
+    """Redis hash where the Strehl daemon publishes summaries for the given stream"""
+    return f"U_STREHL{stream[-1]}"
+
+
+def format_strehl_summaries(summaries: dict[str, dict]) -> str:
+    lines = []
+    for field, summary in summaries.items():
+        if summary.get("n", 0) == 0:
+            lines.append(f"{field}: no measurements")
+            continue
+        lines.append(
+            f"{field}: measured Strehl {summary['median']*100:.01f}% "
+            f"(16-84%: {summary['p16']*100:.01f}-{summary['p84']*100:.01f}%, n={summary['n']})"
+        )
+    return "\n".join(lines)
 
 
 @click.command("vampires_strehl_monitor")
 @click.argument("stream", type=click.Choice(["vcam1", "vcam2"]))
-def vampires_strehl_monitor(stream: str):
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.load_system_host_keys()
-    client.connect(
-        "scexao5",
-        username="scexao",
-        disabled_algorithms={"pubkeys": ("rsa-sha2-256", "rsa-sha2-512")},
-    )
+@click.option(
+    "-r", "--rate", default=0.5, type=float, help="Refresh period, in s", show_default=True
+)
+def vampires_strehl_monitor(stream: str, rate: float):
+    """Display the Strehl summaries published by the Strehl daemon"""
+    key = strehl_redis_key(stream)
     while True:
-        stdin, stdout, stderr = client.exec_command(
-            f"/home/scexao/miniforge3/envs/vampires_control/bin/vampires_strehl {stream}"
-        )
-        output = "".join(stdout.readlines())
+        values = RDB.hgetall(key)
+        summaries = {k: json.loads(v) for k, v in values.items() if k != "time"}
         os.system("cls" if os.name == "nt" else "clear")
-        print(datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%s"))
+        print(datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f"))
         print()
-        print(output)
+        if len(values) == 0:
+            print(f"No Strehl measurements in {key}, is vampires_strehl_daemon running?")
+        else:
+            age = time.time() - float(values["time"])
+            print(format_strehl_summaries(summaries))
+            if age > 10 * rate + 5:
+                print(f"\nWARNING: last update was {age:.0f} s ago")
+        time.sleep(rate)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,17 @@
+from functools import lru_cache
+from pathlib import Path
+
+import click
 import hcipy as hp
 import numpy as np
+import tqdm.auto as tqdm
 from astropy.io import fits
 from loguru import logger
+from scipy import ndimage
 
 from . import paths
-from .filters import load_vampires_filter
+from .filters import VAMPIRES_FILTERS, load_vampires_filter
+from .helpers import atomic_write, cache_key
 
 ## constants
 PUPIL_DIAMETER = 7.92  # m
@@ -18,7 +25,13 @@ ACTUATOR_SPIDER_OFFSET = (0.521, -1.045)
 ACTUATOR_DIAMETER = 0.632  # m
 ACTUATOR_OFFSET = ((1.765, 1.431), (-0.498, -2.331))  # (x, y), m
 PUPIL_OFFSET = 90 - 38.75  # deg
+# deg, D_IMRPAP at which PUPIL_OFFSET applies in field-tracking mode, None until calibrated
+PUPIL_PAP_REF = None
+# image rotator modes in which the pupil rotates on the detector
+PUPIL_ROTATING_MODES = ("SID",)
 PIXEL_SCALE = 5.9  # mas / pix
+PSF_CACHE_SIZE = 64  # number of PSFs kept in memory
+PUPIL_CACHE_SIZE = 32  # number of pupils kept in memory
 
 # -------------------------------------------------------------------------------------------------------------
 # -------------------------------------------------------------------------------------------------------------
@@ -38,47 +51,278 @@ def create_synth_psf(
     output_directory=paths.SYNTHPSF_DIR,
     **kwargs,
 ):
+    """
+    Get a synthetic polychromatic PSF for the given filter.
+
+    PSFs are cached in-process and, if `output_directory` is not None, on disk in a
+    content-addressed store so that every combination of (filter, npix, nwave, pixel scale, pupil
+    angle, flip) lives side by side. The returned array is read-only and shared between callers,
+    copy it before modifying in place.
+    """
+    if output_directory is not None:
+        output_directory = Path(output_directory)
+    return _cached_synth_psf(
+        filt,
+        int(npix),
+        int(nwave),
+        bool(flip),
+        round(float(pupil_offset), 6),
+        round(float(pixel_scale), 6),
+        output_directory,
+    )
+
+
+@lru_cache(maxsize=PSF_CACHE_SIZE)
+def _cached_synth_psf(filt, npix, nwave, flip, pupil_offset, pixel_scale, output_directory):
     if output_directory is not None:
-        outfile = output_directory / f"VAMPIRES_{filt}_synthpsf.fits"
+        key = cache_key(
+            filt=filt,
+            npix=npix,
+            nwave=nwave,
+            flip=flip,
+            pupil_offset=pupil_offset,
+            pixel_scale=pixel_scale,
+        )
+        outfile = output_directory / f"VAMPIRES_{filt}_{key}_synthpsf.fits"
         if outfile.exists():
-            psf, hdr = fits.getdata(outfile, header=True)
-            if psf.shape == (npix, npix) and np.isclose(hdr["PXSCALE"], pixel_scale):
-                return psf
+            psf = fits.getdata(outfile).astype("=f4")
+            psf.flags.writeable = False
+            return psf
+
+    normed_field = _make_synth_psf(
+        filt, npix=npix, nwave=nwave, flip=flip, pupil_offset=pupil_offset, pixel_scale=pixel_scale
+    )
+    if output_directory is not None:
+        logger.info(f"Saving synthetic PSF to {outfile}")
+        header = fits.Header()
+        header["FILTER"] = filt
+        header["PXSCALE"] = pixel_scale, "[mas/pix] pixel plate scale"
+        header["PUPILTH"] = pupil_offset, "[deg] pupil offset angle"
+        header["NWAVE"] = nwave, "Number of wavelengths in bandpass"
+        header["FLIP"] = flip, "PSF flipped along y axis"
+        header["CACHEKEY"] = key, "Synthetic PSF cache key"
+        atomic_write(
+            outfile, lambda name: fits.writeto(name, normed_field, header=header, overwrite=True)
+        )
+    normed_field.flags.writeable = False
+    return normed_field
+
+
+def _make_synth_psf(
+    filt: str,
+    npix=51,
+    nwave=11,
+    flip: bool = True,
+    pupil_offset=PUPIL_OFFSET,
+    pixel_scale=PIXEL_SCALE,
+):
     logger.info(f"Making synthetic PSF for {filt}")
     # assume header is fixed already
     pupil_data = generate_pupil(angle=pupil_offset)
-    pupil_grid = hp.make_pupil_grid(pupil_data.shape, diameter=PUPIL_DIAMETER)
-    pupil_field = hp.Field(pupil_data.ravel(), pupil_grid)
-    # create detector grid
-    plate_scale = np.deg2rad(pixel_scale / 1e3 / 60 / 60)  # mas/px -> rad/px
-    focal_grid = hp.make_uniform_grid((npix, npix), (plate_scale * npix, plate_scale * npix))
-    prop = hp.FraunhoferPropagator(pupil_grid, focal_grid)
 
     obs_filt = load_vampires_filter(filt)
     waves = obs_filt.waveset
     through = obs_filt.model.lookup_table
     above_50 = np.nonzero(through >= 0.5 * np.nanmax(through))
     waves = np.linspace(waves[above_50].min(), waves[above_50].max(), nwave)
-
-    field_sum = 0
     throughputs = obs_filt(waves)
-    for wave, through in zip(waves, throughputs, strict=True):
-        wf = hp.Wavefront(pupil_field, wave.to("m").value)
-        focal_plane = prop(wf).intensity * through.value
-        field_sum += focal_plane.shaped
-    field_sum /= np.sum(throughputs)
+
+    field_sum = polychromatic_psf(
+        pupil_data,
+        waves.to("m").value,
+        throughputs.value,
+        npix=npix,
+        pixel_scale=pixel_scale,
+    )
 
     normed_field = (field_sum / field_sum.max()).astype("f4")
     if flip:
-        normed_field = np.flip(normed_field, axis=-2)
+        normed_field = np.flip(normed_field, axis=-2).copy()
+    return normed_field
+
+
+def pupil_angle_from_keywords(header) -> float:
+    """
+    Pupil angle (deg) of the synthetic PSF model for a frame.
+
+    In pupil-tracking mode the pupil is fixed at `PUPIL_OFFSET`. When the image rotator is field
+    tracking (`D_IMRMOD` in `PUPIL_ROTATING_MODES`), the pupil rotation is followed with the pupil
+    position angle (`D_IMRPAP`) relative to `PUPIL_PAP_REF`. Until that reference is calibrated
+    the fixed `PUPIL_OFFSET` is always returned.
+    """
+    pap = header.get("D_IMRPAP")
+    mode = str(header.get("D_IMRMOD", "")).strip().upper()
+    if PUPIL_PAP_REF is None or pap is None or mode not in PUPIL_ROTATING_MODES:
+        return PUPIL_OFFSET
+    return PUPIL_OFFSET + float(pap) - PUPIL_PAP_REF
+
+
+def pupil_rotates() -> bool:
+    """Whether model pupil angles other than `PUPIL_OFFSET` are used (`PUPIL_PAP_REF` is set)"""
+    return PUPIL_PAP_REF is not None
+
+
+class PSFLibrary:
+    """
+    Synthetic PSFs for a single filter precomputed on a grid of pupil angles.
+
+    The intensity PSF of a real pupil is centrosymmetric, so rotating the pupil by 180° gives the
+    same PSF and the grid only needs to cover [0, 180). Models for arbitrary angles are served
+    from the nearest grid point, optionally rotated by the residual angle, so no propagation is
+    needed once the library is built. Use `get_psf_library` to share libraries within a process.
+    """
+
+    def __init__(
+        self,
+        filt: str,
+        npix: int = 201,
+        nwave: int = 11,
+        flip: bool = True,
+        pixel_scale: float = PIXEL_SCALE,
+        angle_step: float = 2.0,
+        output_directory=paths.SYNTHPSF_DIR,
+    ):
+        self.filter = filt
+        self.npix = int(npix)
+        self.pixel_scale = float(pixel_scale)
+        self.angle_step = float(angle_step)
+        self.angles = np.arange(0, 180, self.angle_step)
+        if output_directory is not None:
+            output_directory = Path(output_directory)
+        self.cube = _cached_psf_library(
+            filt,
+            self.npix,
+            int(nwave),
+            bool(flip),
+            round(self.pixel_scale, 6),
+            round(self.angle_step, 6),
+            output_directory,
+        )
+
+    def nearest_index(self, angle: float) -> int:
+        return int(np.round((angle % 180) / self.angle_step)) % len(self.angles)
+
+    def __call__(self, angle: float = PUPIL_OFFSET, interpolate: bool = True):
+        """
+        Get the PSF model for the given pupil angle (deg).
+
+        With `interpolate` the nearest PSF is rotated by the residual angle, otherwise the nearest
+        PSF is returned directly (read-only).
+        """
+        idx = self.nearest_index(angle)
+        psf = self.cube[idx]
+        # wrap residual into [-90, 90) since the grid is 180 deg periodic
+        resid = (angle - self.angles[idx] + 90) % 180 - 90
+        if not interpolate or np.isclose(resid, 0):
+            return psf
+        rotated = ndimage.rotate(psf, resid, reshape=False, order=3, mode="constant")
+        return rotated / rotated.max()
+
+
+@lru_cache(maxsize=16)
+def get_psf_library(filt: str, npix: int = 201, pixel_scale: float = PIXEL_SCALE, **kwargs):
+    """Get a (memoized) `PSFLibrary` for the given filter"""
+    return PSFLibrary(filt, npix=npix, pixel_scale=pixel_scale, **kwargs)
+
+
+@lru_cache(maxsize=8)
+def _cached_psf_library(filt, npix, nwave, flip, pixel_scale, angle_step, output_directory):
+    angles = np.arange(0, 180, angle_step)
     if output_directory is not None:
-        logger.info(f"Saving synthetic PSF to {outfile}")
+        key = cache_key(
+            filt=filt,
+            npix=npix,
+            nwave=nwave,
+            flip=flip,
+            pixel_scale=pixel_scale,
+            angle_step=angle_step,
+        )
+        outfile = output_directory / f"VAMPIRES_{filt}_{key}_psflib.fits"
+        if outfile.exists():
+            cube = fits.getdata(outfile).astype("=f4")
+            cube.flags.writeable = False
+            return cube
+
+    logger.info(f"Making synthetic PSF library for {filt} ({len(angles)} pupil angles)")
+    cube = np.empty((len(angles), npix, npix), dtype="f4")
+    for i, angle in enumerate(tqdm.tqdm(angles, desc=f"{filt} PSF library", leave=False)):
+        cube[i] = _make_synth_psf(
+            filt, npix=npix, nwave=nwave, flip=flip, pupil_offset=angle, pixel_scale=pixel_scale
+        )
+    if output_directory is not None:
+        logger.info(f"Saving synthetic PSF library to {outfile}")
         header = fits.Header()
         header["FILTER"] = filt
         header["PXSCALE"] = pixel_scale, "[mas/pix] pixel plate scale"
-        header["PUPILTH"] = pupil_offset, "[deg] pupil offset angle"
-        fits.writeto(outfile, normed_field, header=header, overwrite=True)
-    return normed_field
+        header["ANGSTEP"] = angle_step, "[deg] pupil angle grid step"
+        header["NWAVE"] = nwave, "Number of wavelengths in bandpass"
+        header["FLIP"] = flip, "PSF flipped along y axis"
+        header["CACHEKEY"] = key, "Synthetic PSF cache key"
+        atomic_write(outfile, lambda name: fits.writeto(name, cube, header=header, overwrite=True))
+    cube.flags.writeable = False
+    return cube
+
+
+@lru_cache(maxsize=32)
+def _mft_matrices(
+    n: int, npix: int, pixel_scale: float, wavelengths: tuple[float, ...], diameter: float
+):
+    """
+    Stack of 1-D matrix Fourier transforms from a pupil with `n` pixels across `diameter` (m) to
+    a focal plane with `npix` pixels of `pixel_scale` (mas/px), one per wavelength (m).
+
+    Returns a read-only complex64 array with shape (nwave, npix, n)
+    """
+    pupil_coords = (np.arange(n) - n / 2 + 0.5) * diameter / n
+    plate_scale = np.deg2rad(pixel_scale / 3.6e6)  # mas/px -> rad/px
+    focal_coords = (np.arange(npix) - npix / 2 + 0.5) * plate_scale
+    waves = np.asarray(wavelengths)
+    phase = -2 * np.pi * np.multiply.outer(focal_coords, pupil_coords)
+    mft = np.exp(1j * phase[None] / waves[:, None, None]).astype("c8")
+    mft.flags.writeable = False
+    return mft
+
+
+def polychromatic_psf(
+    pupil, wavelengths, weights, npix: int, pixel_scale=PIXEL_SCALE, diameter=PUPIL_DIAMETER
+):
+    """
+    Evaluate a polychromatic PSF from a pupil amplitude using batched matrix Fourier transforms.
+
+    The whole bandpass is propagated at once as E = A(λ) P A(λ)^T with the per-wavelength MFT
+    matrices A(λ) stacked along the first axis, in complex64.
+
+    Parameters
+    ----------
+    pupil : ArrayLike
+        Square pupil amplitude spanning `diameter`
+    wavelengths : ArrayLike
+        Wavelengths, in m
+    weights : ArrayLike
+        Spectral weight (e.g., filter throughput) for each wavelength
+    npix : int
+        Output size in pixels
+    pixel_scale : float, optional
+        Detector plate scale in mas/px. Default is 5.9
+    diameter : float, optional
+        Pupil diameter, in m. Default is 7.92
+
+    Returns
+    -------
+    NDArray
+        Throughput-weighted average intensity with shape (npix, npix)
+    """
+    pupil = np.asarray(pupil)
+    waves = np.atleast_1d(np.asarray(wavelengths, dtype="f8"))
+    mft = _mft_matrices(
+        pupil.shape[-1], int(npix), float(pixel_scale), tuple(waves.tolist()), float(diameter)
+    )
+    efield = mft @ pupil.astype("c8") @ mft.swapaxes(-1, -2)
+    intensity = efield.real**2 + efield.imag**2
+    # Fraunhofer propagation scales the intensity as 1 / lambda^2
+    weights = np.atleast_1d(np.asarray(weights, dtype="f8"))
+    psf = np.tensordot(weights / waves**2, intensity, axes=1)
+    return psf / np.sum(weights)
 
 
 def generate_pupil_field(
@@ -90,6 +334,70 @@ def generate_pupil_field(
     oversample: int = 8,
     spiders: bool = True,
     actuators: bool = True,
+    output_directory=paths.PUPIL_DIR,
+):
+    pupil_diameter = PUPIL_DIAMETER * outer
+    # make grid over full diameter so undersized pupils look undersized
+    max_diam = PUPIL_DIAMETER if outer <= 1 else pupil_diameter
+    grid = hp.make_pupil_grid(n, diameter=max_diam)
+    if output_directory is not None:
+        output_directory = Path(output_directory)
+    pupil_data = _cached_pupil(
+        int(n),
+        round(float(outer), 6),
+        round(float(inner), 6),
+        round(float(scale), 6),
+        round(float(angle), 6),
+        int(oversample),
+        bool(spiders),
+        bool(actuators),
+        output_directory,
+    )
+    return hp.Field(pupil_data.copy(), grid)
+
+
+@lru_cache(maxsize=PUPIL_CACHE_SIZE)
+def _cached_pupil(n, outer, inner, scale, angle, oversample, spiders, actuators, output_directory):
+    params = dict(
+        n=n,
+        outer=outer,
+        inner=inner,
+        scale=scale,
+        angle=angle,
+        oversample=oversample,
+        spiders=spiders,
+        actuators=actuators,
+    )
+    if output_directory is not None:
+        outfile = output_directory / f"SCExAO_pupil_{cache_key(**params)}.npz"
+        if outfile.exists():
+            with np.load(outfile) as npz:
+                pupil_data = npz["pupil"]
+            pupil_data.flags.writeable = False
+            return pupil_data
+
+    pupil_data = np.asarray(_evaluate_pupil_field(**params))
+    if output_directory is not None:
+        logger.debug(f"Saving pupil model to {outfile}")
+
+        def _writer(name):
+            with Path(name).open("wb") as fh:
+                np.savez_compressed(fh, pupil=pupil_data, **params)
+
+        atomic_write(outfile, _writer)
+    pupil_data.flags.writeable = False
+    return pupil_data
+
+
+def _evaluate_pupil_field(
+    n: int = 256,
+    outer: float = 1,
+    inner: float = INNER_RATIO,
+    scale: float = 1,
+    angle: float = 0,
+    oversample: int = 8,
+    spiders: bool = True,
+    actuators: bool = True,
 ):
     pupil_diameter = PUPIL_DIAMETER * outer
     # make grid over full diameter so undersized pupils look undersized
@@ -204,12 +512,48 @@ spiders : bool, optional
     Add spiders to pupil. Default is True
 actuators : bool, optional
     Add bad actuator masks and spider. Default is True
+output_directory : Path, optional
+    Directory for the on-disk pupil cache, if None the pupil is only cached in memory. Default is {paths.PUPIL_DIR}
 
 Notes
 -----
+Pupils are cached in memory and on disk (as compressed npz files), keyed by all of the parameters above. Use `vampires_pupil_cache` to prebuild a grid of pupil angles.
+
 The smallest element in the SCExAO pupil is the bad actuator spider, which is approximately {ACTUATOR_SPIDER_WIDTH*1e3:.1f} mm wide. This is about 0.7\% of the telescope diameter, which means you need to have a miinimum of ~142 pixels across the aperture to sample this element.
 
 """
+
+
+@click.command("vampires_pupil_cache")
+@click.option("--start", default=0.0, type=float, help="First pupil angle, in deg", show_default=True)
+@click.option("--stop", default=180.0, type=float, help="Last pupil angle, in deg", show_default=True)
+@click.option("--step", default=1.0, type=float, help="Pupil angle step, in deg", show_default=True)
+@click.option("-n", default=256, type=int, help="Grid size in pixels", show_default=True)
+@click.option("--oversample", default=8, type=int, help="Supersampling factor", show_default=True)
+def prebuild_pupil_cache(start: float, stop: float, step: float, n: int, oversample: int):
+    """Prebuild the on-disk pupil cache over a grid of pupil angles"""
+    angles = np.arange(start, stop + step / 2, step)
+    for angle in tqdm.tqdm(angles, desc="Pupil angle"):
+        generate_pupil_field(n=n, angle=angle, oversample=oversample)
+    click.echo(f"Cached {len(angles)} pupils in {paths.PUPIL_DIR}")
+
+
+@click.command("vampires_psf_library")
+@click.argument("filters", nargs=-1)
+@click.option("-n", "--npix", default=201, type=int, help="PSF size in pixels", show_default=True)
+@click.option("--step", default=2.0, type=float, help="Pupil angle step, in deg", show_default=True)
+@click.option(
+    "--pxscale", default=PIXEL_SCALE, type=float, help="Pixel scale in mas/px", show_default=True
+)
+def prebuild_psf_library(filters, npix: int, step: float, pxscale: float):
+    """Prebuild pupil-angle PSF libraries (all VAMPIRES filters by default)"""
+    if len(filters) == 0:
+        filters = sorted(VAMPIRES_FILTERS)
+    for filt in filters:
+        get_psf_library(filt, npix=npix, pixel_scale=pxscale, angle_step=step)
+        click.echo(f"Finished PSF library for {filt}")
+
+
 # from skimage import transform
 # from .centroid import cross_correlation_centroid, cutout_slice
 # from scipy import optimize
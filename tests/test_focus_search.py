@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from vampires_control.focus_search import adaptive_focus_search
+
+
+def simulate(true, sigma=0.4, offset=0.1, amp=0.5, noise=0.0, nframes=10, seed=None):
+    """Stage `move` and `measure` callbacks for a Gaussian-plus-offset focus curve"""
+    rng = np.random.default_rng(seed)
+    stage = {"position": 10.0}
+
+    def move(position):
+        stage["position"] = position
+
+    def measure():
+        value = offset + amp * np.exp(-0.5 * ((stage["position"] - true) / sigma) ** 2)
+        return value + rng.normal(0, noise, nframes)
+
+    return move, measure
+
+
+def test_noiseless():
+    move, measure = simulate(10.23)
+    result = adaptive_focus_search(move, measure, 10.0, tol=0.01)
+    assert result.converged
+    assert result.uncertainty < 0.01
+    assert result.position == pytest.approx(10.23, abs=0.03)
+    assert len(result.positions) <= 12
+
+
+@pytest.mark.parametrize("noise", [0.005, 0.01, 0.02])
+def test_noisy_coverage(noise):
+    tol = 0.01
+    rng = np.random.default_rng(42)
+    errors, uncertainties = [], []
+    for seed in range(200):
+        true = rng.uniform(9.5, 10.5)
+        move, measure = simulate(
+            true,
+            sigma=rng.uniform(0.2, 0.6),
+            offset=rng.uniform(0, 0.3),
+            amp=rng.uniform(0.3, 0.8),
+            noise=noise,
+            seed=seed,
+        )
+        result = adaptive_focus_search(move, measure, 10.0, tol=tol)
+        if result.converged:
+            errors.append(result.position - true)
+            uncertainties.append(result.uncertainty)
+    errors = np.abs(errors)
+    assert len(errors) >= 20
+    # a converged search is (almost) never far off, and its 1-sigma uncertainty is honest
+    assert np.mean(errors > 3 * tol) < 0.03
+    assert np.mean(errors < np.array(uncertainties)) > 0.6